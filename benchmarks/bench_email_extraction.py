@@ -0,0 +1,39 @@
+import argparse
+import time
+
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame, get_lists_of_emails, extract_addresses
+
+from synthetic import skautis_export
+
+"""
+Compare the per-row `get_lists_of_emails` apply with the columnar `extract_addresses`.
+
+    python benchmarks/bench_email_extraction.py --rows 100000
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    args = parser.parse_args()
+
+    cols = NeededColumns()
+    df = PaymentsDataFrame.prepare_needed_columns(skautis_export(args.rows), cols)
+
+    start = time.perf_counter()
+    per_row = df.apply(get_lists_of_emails, args=(cols.emails,), axis=1)
+    per_row_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columnar = extract_addresses(df, cols.emails)
+    columnar_time = time.perf_counter() - start
+
+    assert per_row.valid_addresses.tolist() == columnar.valid_addresses.tolist()
+    assert per_row.invalid_addresses.tolist() == columnar.invalid_addresses.tolist()
+
+    print(f"{args.rows} rows: apply {per_row_time:.2f}s, columnar {columnar_time:.2f}s, "
+          f"speedup {per_row_time / columnar_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.sheet_snapshot import read_snapshot, write_snapshot
+
+from synthetic import skautis_export
+
+"""
+Compare the fetched sheet kept as a csv of strings with the typed parquet snapshot: size on disk, reload time,
+memory of the needed columns and the time to build `PaymentsDataFrame` from the reloaded frame.
+
+    python benchmarks/bench_snapshot.py --rows 100000
+"""
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    cols = NeededColumns()
+    sheet_df = skautis_export(args.rows, cols=cols)
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path, parquet_path = os.path.join(tmp, 'sheet.csv'), os.path.join(tmp, 'sheet.parquet')
+        sheet_df.to_csv(csv_path, index=False)
+        write_snapshot(sheet_df, parquet_path, cols)
+
+        csv_df, csv_read = timed(pd.read_csv, csv_path, dtype=str, keep_default_na=False)
+        snapshot_df, snapshot_read = timed(read_snapshot, parquet_path)
+        csv_pdf, csv_prepare = timed(PaymentsDataFrame, csv_df, cols)
+        snapshot_pdf, snapshot_prepare = timed(PaymentsDataFrame, snapshot_df, cols)
+
+        assert csv_pdf.df_emailable_unpaid.index.equals(snapshot_pdf.df_emailable_unpaid.index)
+        assert csv_pdf.df_emailable_unpaid.valid_addresses.tolist() == \
+            snapshot_pdf.df_emailable_unpaid.valid_addresses.tolist()
+
+        for name, path, df, read, prepare in [('csv', csv_path, csv_df, csv_read, csv_prepare),
+                                              ('parquet', parquet_path, snapshot_df, snapshot_read, snapshot_prepare)]:
+            memory = df.loc[:, list(cols.colnames())].memory_usage(deep=True).sum()
+            print(f"{name:8} {os.path.getsize(path) / 1e6:7.2f} MB on disk, read {1e3 * read:7.1f} ms, "
+                  f"{memory / 1e6:7.2f} MB in memory, PaymentsDataFrame {1e3 * prepare:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
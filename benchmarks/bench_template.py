@@ -0,0 +1,49 @@
+import argparse
+import importlib.resources as resources
+import time
+
+import html2text
+
+from prispevky.email_template import EmailTemplate, TEMPLATE_FIELDS, STS_TEMPLATE_FIELDS
+
+"""
+Rendering time of the email template, str.format + html2text per message vs the compiled `EmailTemplate`.
+
+    python benchmarks/bench_template.py --messages 10000
+"""
+
+
+def sample_values(i: int) -> dict:
+    return dict(troop='Bobříci', payment_message=f'Prispevky Podzim 2025 - BCI Novak Jan {i}',
+                variable_symbol=f'{411000 + i}', specific_symbol='251244', amount_czk=900,
+                human_account_number='000000-2101999393/2010', human_due_date='24. 10. 2025',
+                qr_code_cid=f'1760{i}.1.abc@example.com', number_of_sts_phones='2')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--template', default='email_template_sts.html')
+    args = parser.parse_args()
+
+    with open(resources.files('prispevky.templates')/args.template, 'rt', encoding='utf-8') as f:
+        html = f.read()
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        html_message = html.format(**sample_values(i))
+        html2text.html2text(html_message)
+    per_message_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    template = EmailTemplate(html, TEMPLATE_FIELDS + STS_TEMPLATE_FIELDS)
+    for i in range(args.messages):
+        template.render(**sample_values(i))
+    compiled_time = time.perf_counter() - start
+
+    print(f"{args.messages} messages: format + html2text {per_message_time:.2f}s, "
+          f"compiled {compiled_time:.2f}s, speedup {per_message_time / compiled_time:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+"""
+Import time budget of the package, measured with `python -X importtime`.
+
+Importing any module must not read the config, authenticate or load the google discovery client,
+and must fit into the time budget. Exits with 1 when the budget is broken.
+
+    python benchmarks/import_time.py --budget-ms 1000
+
+tests/test_import_time.py runs the same checks under pytest, the budgets with `pytest -m slow`.
+"""
+
+MODULES = ['prispevky', 'prispevky.config', 'prispevky.payment_data', 'prispevky.payment_info',
+           'prispevky.qr_code', 'prispevky.gsheet', 'prispevky.mailer', 'prispevky.journal', 'prispevky.campaign',
+           'prispevky.sheet_snapshot', 'prispevky.bounces']
+
+# modules that are slow to import or have side effects, they may only be imported when used
+FORBIDDEN = ['googleapiclient.discovery', 'google_auth_oauthlib', 'google.oauth2.credentials']
+
+# total import time including third party libraries and of the prispevky modules themselves, in ms
+BUDGET_MS = 1000
+OWN_BUDGET_MS = 50
+
+CHECK = """
+import sys, {module}
+from prispevky.config import _default_config
+assert _default_config.cache_info().currsize == 0, 'config was read on import'
+loaded = [m for m in {forbidden!r} if m in sys.modules]
+assert not loaded, f'imported on import: {{loaded}}'
+"""
+
+
+def measure(module):
+    """Returns (total import time, import time of the package itself) in ms."""
+    # prispevky is imported from the source tree when not installed, without importing it here
+    src = Path(__file__).resolve().parents[1]/'src'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(src), os.environ.get('PYTHONPATH', '')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHECK.format(module=module, forbidden=FORBIDDEN)],
+                          capture_output=True, text=True, env=env)
+    if proc.returncode != 0:
+        raise AssertionError(f"{module}: {proc.stderr.strip().splitlines()[-1]}")
+    total = own = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = [v.strip() for v in line[len('import time:'):].split('|')]
+        total += int(self_us)
+        if name.startswith('prispevky'):
+            own += int(self_us)
+    return total / 1000, own / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS,
+                        help='total import time including third party libraries')
+    parser.add_argument('--own-budget-ms', type=float, default=OWN_BUDGET_MS,
+                        help='import time of the prispevky modules themselves')
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        try:
+            total, own = measure(module)
+        except AssertionError as e:
+            print(f"FAIL {e}")
+            failed = True
+            continue
+        over = total > args.budget_ms or own > args.own_budget_ms
+        failed |= over
+        print(f"{'FAIL' if over else 'ok  '} {module:25} total {total:7.1f} ms, own {own:5.1f} ms")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from google.auth.credentials import AnonymousCredentials
+
+from prispevky.config import API_ENDPOINT_ENV
+from prispevky.fake_google import FakeGoogleServer
+from prispevky.gsheet import Sheets
+from prispevky.mailer import Mailer, PaymentEmail
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.payment_info import PaymentInfo
+from prispevky.qr_code import QRCode, QR_CACHE, qr_platba_string, render_png
+
+from synthetic import skautis_export
+
+"""
+Benchmark suite of the whole payment pipeline on synthetic Skautis exports.
+
+Every stage is timed and, in a second run under tracemalloc, its peak memory is recorded. Results are
+compared with the stored baseline and the script exits with 1 when a stage got slower or hungrier than
+the tolerance allows.
+
+    python benchmarks/run.py                     # 1k, 10k and 100k rows, compare with baseline.json
+    python benchmarks/run.py --sizes 1000 --save-baseline
+"""
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+class Stages:
+    """Pipeline stages on one synthetic export, each returns the number of processed items."""
+
+    def __init__(self, size: int, max_items: int, google: FakeGoogleServer):
+        self.cols = NeededColumns()
+        self.sheet_df = skautis_export(size, cols=self.cols)
+        self.pdf = PaymentsDataFrame(self.sheet_df, self.cols)
+        self.rows = [row for _, row in self.pdf.df_emailable_unpaid.iterrows()]
+        self.payment_infos = PaymentInfo.from_dataframe(self.pdf.df_emailable_unpaid, self.cols)
+        # the expensive per-message stages only run on a sample, results are compared per item
+        self.sample = list(zip(self.rows, self.payment_infos))[:max_items]
+        self.codes = [qr_platba_string(pi) for _, pi in self.sample]
+        self.emails = [PaymentEmail(pi, row.valid_addresses[:2]).msg for row, pi in self.sample]
+        # the Google APIs are served by the local fake, see prispevky.fake_google
+        self.spreadsheet_id = f"benchmark-{size}"
+        self.sheet_name = 'PlatbyPodzim'
+        google.add_dataframe(self.spreadsheet_id, self.sheet_name, self.sheet_df)
+
+    def payments_dataframe(self):
+        PaymentsDataFrame(self.sheet_df, self.cols)
+        return len(self.sheet_df)
+
+    def payment_info_from_df_row(self):
+        for row in self.rows:
+            PaymentInfo.from_df_row(row, self.cols)
+        return len(self.rows)
+
+    def payment_info_from_dataframe(self):
+        PaymentInfo.from_dataframe(self.pdf.df_emailable_unpaid, self.cols)
+        return len(self.rows)
+
+    def qr_platba_string(self):
+        for pi in self.payment_infos:
+            qr_platba_string(pi)
+        return len(self.payment_infos)
+
+    def qr_get_image_bytes(self):
+        for code in self.codes:
+            QRCode(code).get_image_bytes()
+        return len(self.codes)
+
+    def qr_render_png(self):
+        for code in self.codes:
+            render_png(code)
+        return len(self.codes)
+
+    def create_email(self):
+        QR_CACHE.clear()
+        for row, pi in self.sample:
+            PaymentEmail(pi, row.valid_addresses[:2])
+        return len(self.sample)
+
+    def encode_email_to_gmail_message(self):
+        for email in self.emails:
+            Mailer.encode_email_to_gmail_message(email)
+        return len(self.emails)
+
+    def fetch_fake_sheet(self):
+        df = Sheets(self.spreadsheet_id, credentials=AnonymousCredentials()).get_dataframe(self.sheet_name)
+        return len(df)
+
+    def send_mock_gmail(self):
+        mailer = Mailer(credentials=AnonymousCredentials(), user_id='me')
+        mailer.rate_limiter.rate = 1e9
+        for email in self.emails:
+            mailer.send_message(email)
+        return len(self.emails)
+
+    names = ['fetch_fake_sheet', 'payments_dataframe', 'payment_info_from_df_row', 'payment_info_from_dataframe',
+             'qr_platba_string', 'qr_get_image_bytes', 'qr_render_png', 'create_email', 'encode_email_to_gmail_message',
+             'send_mock_gmail']
+
+
+def measure(stage, memory: bool) -> dict:
+    gc.collect()
+    start = time.perf_counter()
+    n_items = stage()
+    seconds = time.perf_counter() - start
+    result = dict(items=n_items, seconds=seconds, us_per_item=1e6 * seconds / max(n_items, 1))
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        stage()
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            # a new stage or size must be added with --save-baseline, otherwise it is never checked
+            regressions.append(f"{key}: missing in the baseline")
+            continue
+        for metric in ('us_per_item', 'peak_mb'):
+            if metric in result and metric in baseline[key] and \
+                    result[metric] > tolerance * baseline[key][metric] and result[metric] - baseline[key][metric] > 1:
+                regressions.append(f"{key} {metric}: {baseline[key][metric]:.1f} -> {result[metric]:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--stages', nargs='+', default=Stages.names, choices=Stages.names)
+    parser.add_argument('--max-items', type=int, default=1_000,
+                        help='number of messages for the per-message stages (QR image, email, encoding, send)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.3, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    results = {}
+    with FakeGoogleServer() as google:
+        os.environ[API_ENDPOINT_ENV] = google.url
+        for size in args.sizes:
+            stages = Stages(size, args.max_items, google)
+            for name in args.stages:
+                result = measure(getattr(stages, name), memory=not args.no_memory)
+                results[f"{name}[{size}]"] = result
+                print(f"{name + f'[{size}]':40} {result['items']:7d} items {result['seconds']:8.3f}s "
+                      f"{result['us_per_item']:10.1f} us/item" +
+                      (f" {result['peak_mb']:8.1f} MB peak" if 'peak_mb' in result else ''))
+
+    if args.save_baseline:
+        baseline = dict(python=sys.version, machine=platform.machine(), results=results)
+        with open(args.baseline, 'wt', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=1)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'rt', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from google.auth.credentials import AnonymousCredentials
+
+import prispevky
+from prispevky.config import API_ENDPOINT_ENV
+from prispevky.mailer import Mailer
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.pipeline import payment_emails, send_stream
+from prispevky.qr_code import QR_CACHE, QRSettings
+
+from synthetic import skautis_export
+
+"""
+Checks that memory stays flat while streaming many messages through `Mailer.send_many` to the local fake
+Gmail (see prispevky.fake_google), which runs in a subprocess so that only the sending side is traced.
+
+The traced memory is sampled as results come in. After the warm-up (connections, discovery documents, a full
+QR cache, shrunk here so that it fills early) the average must not grow by more than --max-growth-mb until
+the end. Exits with 1 otherwise. tests/test_send_memory.py runs it for 10k messages (`pytest -m slow`).
+
+    python benchmarks/send_memory.py --messages 10000
+"""
+
+
+def start_fake_google() -> (subprocess.Popen, str):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    # the package may be imported from the source tree, e.g. under pytest, without being installed
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(Path(prispevky.__file__).parents[1]),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    server = subprocess.Popen([sys.executable, '-m', 'prispevky.fake_google', '--port', str(port)],
+                              stdout=subprocess.DEVNULL, env=env)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return server, f"http://127.0.0.1:{port}/"
+
+
+def send_traced(n_messages: int, workers: int = 4, batch_size: int = None, n_samples: int = 20,
+                qr_cache: int = 256, fast_qr: bool = False):
+    """
+    Streams n_messages synthetic payment emails to a fake Gmail in a subprocess under tracemalloc.
+    Returns the report, [(messages sent, traced bytes)] samples, the peak traced bytes and the seconds taken.
+    """
+    cols = NeededColumns()
+    # about two thirds of the synthetic rows are emailable and unpaid
+    pdf = PaymentsDataFrame(skautis_export(n_messages * 3 // 2 + 100, cols=cols), cols)
+    rows = pdf.df_emailable_unpaid.head(n_messages)
+    if len(rows) < n_messages:
+        raise ValueError(f"Only {len(rows)} unpaid rows generated")
+    QR_CACHE.maxsize = qr_cache
+    QR_CACHE.settings = QRSettings(fast=True) if fast_qr else None
+    QR_CACHE.clear()
+
+    samples = []
+    every = max(1, n_messages // n_samples)
+
+    def on_result(i, result):
+        if (i + 1) % every == 0:
+            samples.append((i + 1, tracemalloc.get_traced_memory()[0]))
+
+    server, url = start_fake_google()
+    endpoint = os.environ.get(API_ENDPOINT_ENV)
+    os.environ[API_ENDPOINT_ENV] = url
+    try:
+        mailer = Mailer(credentials=AnonymousCredentials(), user_id='me')
+        mailer.rate_limiter.rate = 1e9
+        tracemalloc.start()
+        start = time.perf_counter()
+        report = send_stream(mailer, payment_emails(rows, cols, n_recipients=2), on_result=on_result,
+                             workers=workers, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        server.terminate()
+        if endpoint is None:
+            del os.environ[API_ENDPOINT_ENV]
+        else:
+            os.environ[API_ENDPOINT_ENV] = endpoint
+    return report, samples, peak, seconds
+
+
+def growth_after_warmup(samples) -> (float, int):
+    """MB the traced memory grew after the warm-up and over how many messages."""
+    # the first quarter is the warm-up, the second one is compared with the last one, on average because
+    # the memory of the messages in flight varies
+    quarter = max(1, len(samples) // 4)
+    warm, last = samples[quarter:2 * quarter], samples[-quarter:]
+    growth = (sum(current for _, current in last) / len(last) - sum(current for _, current in warm) / len(warm)) / 1e6
+    return growth, last[len(last) // 2][0] - warm[len(warm) // 2][0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, help='send with HTTP batch requests instead of media uploads')
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--qr-cache', type=int, default=256, help='size of the QR image cache')
+    parser.add_argument('--fast-qr', action='store_true', help='render the QR codes with the fast path')
+    parser.add_argument('--max-growth-mb', type=float, default=2.0)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    try:
+        report, samples, peak, seconds = send_traced(args.messages, args.workers, args.batch_size, args.samples,
+                                                     args.qr_cache, args.fast_qr)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    print(report.summary())
+    print(f"{seconds:.1f}s under tracemalloc, peak {peak / 1e6:.1f} MB")
+    for n, current in samples:
+        print(f"{n:8d} messages {current / 1e6:8.2f} MB")
+    growth, messages = growth_after_warmup(samples)
+    print(f"Growth after warm-up: {growth:.2f} MB ({1e6 * growth / max(messages, 1):.1f} B/message)")
+    sys.exit(1 if report.failed or growth > args.max_growth_mb else 0)
+
+
+if __name__ == '__main__':
+    main()
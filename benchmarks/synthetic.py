@@ -0,0 +1,54 @@
+import random
+
+import pandas as pd
+from unidecode import unidecode
+
+from prispevky.payment_data import NeededColumns
+from prispevky.payment_info import TROOPS
+
+"""
+Synthetic Skautis-like exports for benchmarking.
+"""
+
+FIRST_NAMES = ['Jan', 'Petr', 'Marie', 'Eliška', 'Tomáš', 'Žofie', 'Vojtěch', 'Anna', 'Jiří', 'Kateřina']
+LAST_NAMES = ['Novák', 'Svobodová', 'Dvořák', 'Černá', 'Procházka', 'Kučerová', 'Veselý', 'Horáková']
+DOMAINS = ['seznam.cz', 'gmail.com', 'email.cz', 'skaut.cz', 'centrum.cz']
+
+
+def random_email(rng: random.Random, name: str) -> str:
+    return f"{unidecode(name).lower()}.{rng.randrange(10000)}@{rng.choice(DOMAINS)}"
+
+
+def random_email_cell(rng: random.Random, name: str, shared: str) -> str:
+    r = rng.random()
+    if r < 0.3:
+        return ''
+    if r < 0.4:
+        # parents often share one address
+        return shared
+    if r < 0.5:
+        return f"{random_email(rng, name)}, {shared}"
+    if r < 0.52:
+        return 'neplatny email'
+    return random_email(rng, name)
+
+
+def skautis_export(n_rows: int, seed: int = 0, cols: NeededColumns = None) -> pd.DataFrame:
+    """DataFrame of strings shaped like `Sheets.get_dataframe` output of a Skautis export."""
+    rng = random.Random(seed)
+    cols = cols if cols is not None else NeededColumns()
+    troop_names = list(TROOPS)
+    rows = []
+    for i in range(n_rows):
+        name = f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}"
+        shared = random_email(rng, 'rodina')
+        due = rng.choice(['700', '900', '1200'])
+        row = {cols.name: name,
+               cols.troop: rng.choice(troop_names),
+               cols.reg_num: f"{411000 + i}",
+               cols.amount_due: due,
+               cols.amount_paid: rng.choice(['', '', due, '300'])}
+        for col in cols.emails:
+            row[col] = random_email_cell(rng, name.split()[1], shared)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=cols.colnames())
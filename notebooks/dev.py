@@ -1,6 +1,7 @@
 #%%
 import logging
 from prispevky.gsheet import *
+from prispevky.gsheet import SPREADSHEET_ID
 from prispevky.mailer import *
 from prispevky.qr_code import *
 from prispevky.payment_data import *
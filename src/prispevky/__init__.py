@@ -1,2 +1,3 @@
 def main() -> None:
-    print("Hello from prispevky!")
+    from prispevky.cli import main as cli_main
+    cli_main()
@@ -0,0 +1,234 @@
+import asyncio
+import base64
+import email
+import email.policy
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+from googleapiclient import errors
+
+from prispevky.google_services import get_service
+from prispevky.journal import SendJournal
+from prispevky.mailer import SendReport
+from prispevky.metrics import METRICS
+
+"""
+Delivery status of the sent messages, from the bounces (non-delivery reports) Gmail puts in the inbox.
+
+A bounce lands in the Gmail thread of the bounced message. `BounceWatcher` follows the mailbox with incremental
+`history.list` calls from the history id stored in the journal, so each poll returns only the messages added to
+the inbox since the previous one, and fetches the headers only of those in a thread of a sent message. The failed
+addresses are recorded in the journal with the variable symbol of the thread and the next runs treat them as
+invalid (see `journal.bounced_addresses`).
+
+`send_and_watch` polls in an asyncio task while the messages are being sent in a worker thread:
+
+    with SendJournal(path) as journal:
+        watcher = BounceWatcher(journal, user_id=mailer.user_id)
+        report = send_and_watch(lambda: send_spool(mailer, spool, journal=journal), watcher, linger=60)
+"""
+
+# key of the last synced mailbox history id in the journal meta table
+HISTORY_ID = 'gmail_history_id'
+BOUNCE_HEADERS = ['Content-Type', 'X-Failed-Recipients']
+
+
+def is_bounce(headers: dict) -> bool:
+    """headers: lower case names to values"""
+    content_type = headers.get('content-type', '').lower()
+    return 'x-failed-recipients' in headers or (content_type.startswith('multipart/report')
+                                                 and 'delivery-status' in content_type)
+
+
+def _without_type(value) -> str:
+    # 'rfc822; address', 'smtp; 550 ...'
+    return str(value).split(';', 1)[-1].strip()
+
+
+def failure_reason(block) -> Optional[str]:
+    """Status and Diagnostic-Code of a recipient block of a delivery-status part, e.g. '5.1.1 550 5.1.1 The ...'"""
+    reason = []
+    if block.get('Status'):
+        reason.append(str(block['Status']).strip())
+    if block.get('Diagnostic-Code'):
+        reason.append(_without_type(block['Diagnostic-Code']))
+    return ' '.join(reason) or None
+
+
+def failed_recipients(raw: bytes) -> List[Tuple[str, Optional[str]]]:
+    """(address, reason) of the failed recipients in the delivery-status part of a bounce."""
+    msg = email.message_from_bytes(raw, policy=email.policy.default)
+    failed = []
+    for part in msg.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        # the first block is about the message, the others about one recipient each
+        for block in part.get_payload()[1:]:
+            recipient = block.get('Final-Recipient') or block.get('Original-Recipient')
+            if recipient is not None and str(block.get('Action', '')).lower() == 'failed':
+                failed.append((_without_type(recipient), failure_reason(block)))
+    return failed
+
+
+class BounceWatcher:
+    def __init__(self, journals: Union[SendJournal, Sequence[SendJournal]], credentials=None, user_id: str = 'me',
+                 interval: float = 30.0):
+        """
+        Args:
+          journals: journals of the messages being sent, e.g. one per job of a campaign
+          credentials: defaults to the credentials of the logged in user
+          user_id: the mailbox the messages are sent from
+          interval: seconds between the polls of `watch`
+        """
+        self.journals = [journals] if isinstance(journals, SendJournal) else list(journals)
+        self.credentials = credentials
+        self.user_id = user_id
+        self.interval = interval
+        self.history_id = None
+        # (variable symbol, address, reason) of the bounces found by this watcher
+        self.bounces = []
+        # inbox messages of the previous poll in no known thread, their send may not have been recorded yet
+        self._unmatched = []
+
+    def _service(self):
+        # polls run in different threads, each uses its own service
+        return get_service('gmail', 'v1', self.credentials)
+
+    def _current_history_id(self) -> str:
+        METRICS.inc('gmail_api_calls')
+        return self._service().users().getProfile(userId=self.user_id).execute()['historyId']
+
+    def _save(self):
+        for journal in self.journals:
+            journal.set_meta(HISTORY_ID, self.history_id)
+
+    def start(self) -> str:
+        """Resume from the history id stored in the journals, or start from now."""
+        stored = [int(history_id) for history_id in (journal.get_meta(HISTORY_ID) for journal in self.journals)
+                  if history_id is not None]
+        self.history_id = str(min(stored)) if stored else self._current_history_id()
+        self._save()
+        return self.history_id
+
+    def _match(self, thread_id: str) -> Optional[Tuple[SendJournal, str]]:
+        for journal in self.journals:
+            vs = journal.thread_variable_symbol(thread_id)
+            if vs is not None:
+                return journal, vs
+        return None
+
+    def _added_messages(self, service) -> Tuple[List[dict], str]:
+        """Messages added to the inbox since the history id, and the current history id."""
+        added, page_token = [], None
+        while True:
+            METRICS.inc('gmail_api_calls')
+            response = service.users().history().list(userId=self.user_id, startHistoryId=self.history_id,
+                                                      labelId='INBOX', historyTypes='messageAdded',
+                                                      pageToken=page_token, maxResults=500).execute()
+            for record in response.get('history', []):
+                added.extend(item['message'] for item in record.get('messagesAdded', []))
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                return added, response['historyId']
+
+    def _record(self, service, message: dict, journal: SendJournal, vs: str) -> int:
+        METRICS.inc('gmail_api_calls')
+        metadata = service.users().messages().get(userId=self.user_id, id=message['id'], format='metadata',
+                                                  metadataHeaders=BOUNCE_HEADERS).execute()
+        headers = {header['name'].lower(): header['value'] for header in metadata['payload'].get('headers', [])}
+        if not is_bounce(headers):
+            # e.g. a reply of a parent
+            return 0
+        # the reasons are only in the delivery-status part
+        METRICS.inc('gmail_api_calls')
+        raw = service.users().messages().get(userId=self.user_id, id=message['id'], format='raw').execute()
+        failed = failed_recipients(base64.urlsafe_b64decode(raw['raw']))
+        if not failed and 'x-failed-recipients' in headers:
+            # a bounce without a delivery-status part
+            failed = [(address.strip(), None) for address in headers['x-failed-recipients'].split(',')]
+        new = 0
+        for address, reason in failed:
+            if journal.record_bounce(vs, address, message['id'], reason):
+                logging.warning(f"Email {vs} to {address} bounced: {reason}")
+                self.bounces.append((vs, address.lower(), reason))
+                new += 1
+        return new
+
+    def poll(self) -> int:
+        """One incremental sync of the inbox, returns the number of new bounces."""
+        if self.history_id is None:
+            self.start()
+        service = self._service()
+        METRICS.inc('bounce_polls')
+        try:
+            added, history_id = self._added_messages(service)
+        except errors.HttpError as error:
+            if error.resp.status != 404:
+                raise
+            # history ids are kept for about a week
+            logging.warning(f"Gmail history id {self.history_id} expired, bounces received since are not matched")
+            self.history_id = self._current_history_id()
+            self._save()
+            return 0
+        retry, self._unmatched, new = self._unmatched, [], 0
+        for message in retry + added:
+            match = self._match(message['threadId'])
+            if match is not None:
+                new += self._record(service, message, *match)
+            elif len(retry) == 0 or message not in retry:
+                self._unmatched.append(message)
+        self.history_id = history_id
+        self._save()
+        METRICS.inc('bounces', new)
+        return new
+
+    async def _poll_logged(self):
+        try:
+            await asyncio.to_thread(self.poll)
+        except (errors.HttpError, OSError) as error:
+            logging.warning(f"Polling for bounces failed, trying again later: {error}")
+
+    async def watch(self, stop: asyncio.Event):
+        """Poll every interval until stop is set, then once more."""
+        while not stop.is_set():
+            await self._poll_logged()
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+        await self._poll_logged()
+
+
+async def dispatch(send: Callable[[], SendReport], watcher: BounceWatcher, linger: float = 0.0) -> SendReport:
+    """
+    Run send (e.g. `SendJournal.send`) in a worker thread while the watcher polls for bounces,
+    and keep watching linger seconds after the last message was sent.
+    """
+    try:
+        await asyncio.to_thread(watcher.start)
+    except (errors.HttpError, OSError) as error:
+        logging.warning(f"Cannot read the Gmail history, sending without watching for bounces: {error}")
+        return await asyncio.to_thread(send)
+    stop = asyncio.Event()
+    watching = asyncio.create_task(watcher.watch(stop))
+    try:
+        report = await asyncio.to_thread(send)
+        await asyncio.sleep(linger)
+    finally:
+        stop.set()
+        await watching
+    return report
+
+
+def send_and_watch(send: Callable[[], SendReport], watcher: BounceWatcher, linger: float = 0.0) -> SendReport:
+    """
+    Blocking `dispatch`. When an event loop is already running in this thread, e.g. in Jupyter, it blocks that
+    loop and dispatches in a new loop in another thread; in async code await `dispatch` instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(dispatch(send, watcher, linger))
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, dispatch(send, watcher, linger)).result()
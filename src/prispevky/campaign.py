@@ -0,0 +1,218 @@
+import collections
+import configparser
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple
+
+from prispevky.bounces import BounceWatcher, send_and_watch
+from prispevky.config import get_config, use_config
+from prispevky.gsheet import Sheets
+from prispevky.journal import SendJournal, bounced_addresses, journal_filename
+from prispevky.mailer import Mailer, SendReport
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.pipeline import payment_emails
+from prispevky.settings import check_sheet, get_settings
+
+"""
+Payments of several units or sheets in one process.
+
+Every job is a spreadsheet, a sheet and the config of its unit. The sheets are fetched concurrently,
+each in a thread with the job's config active (see `config.use_config`). All jobs share the credentials,
+the QR cache and one `Mailer`, whose rate limiter and sending threads take the messages of the jobs in
+round-robin order, so that a large unit does not hold back the small ones. Every job has its own journal.
+Addresses that bounced in any job are not used again, with `bounce_wait` the bounces are watched for in the
+journals of all jobs while sending (see `prispevky.bounces`).
+
+A campaign file lists the jobs, one section per job:
+
+    [vodni-skauti]
+    ; relative to the campaign file
+    config = vodni_skauti.cfg
+    ; optional, spreadsheet.id and spreadsheet.sheet_name from the config by default
+    spreadsheet_id = 1cCLFMvATZGM79NIq3ApinJZ4qEj-KoR8lKe6m_Z8Ao0
+    sheet = PlatbyPodzim2025
+"""
+
+
+@dataclass
+class Job:
+    name: str
+    config_paths: Tuple[str, ...]
+    spreadsheet_id: str = None
+    sheet: str = None
+
+    def __post_init__(self):
+        with self.config():
+            config = get_config()
+            if self.spreadsheet_id is None:
+                self.spreadsheet_id = config['spreadsheet']['id']
+            if self.sheet is None:
+                self.sheet = config['spreadsheet']['sheet_name']
+            # a broken config fails when the campaign is read, not when its job is sent
+            get_settings()
+
+    def config(self):
+        """Context manager activating the config of the job."""
+        return use_config(self.config_paths)
+
+
+def read_jobs(path: str) -> List[Job]:
+    campaign = configparser.ConfigParser()
+    with open(path, 'rt', encoding='utf-8') as f:
+        campaign.read_file(f)
+    directory = os.path.dirname(os.path.abspath(path))
+    return [Job(name, (os.path.join(directory, section['config']),),
+                spreadsheet_id=section.get('spreadsheet_id'), sheet=section.get('sheet'))
+            for name, section in campaign.items() if name != configparser.DEFAULTSECT]
+
+
+@dataclass
+class JobRun:
+    job: Job
+    pdf: PaymentsDataFrame = None
+    needed_cols: NeededColumns = None
+    error: Exception = None
+    results: collections.Counter = field(default_factory=collections.Counter)
+
+
+def round_robin(iterators) -> Iterator:
+    """Items of all iterators, one from each in turn."""
+    queue = collections.deque(iter(iterator) for iterator in iterators)
+    while queue:
+        iterator = queue.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+        yield item
+        queue.append(iterator)
+
+
+def in_config(job: Job, iterator: Iterator) -> Iterator:
+    """Advance iterator with the config of job active, also when it is consumed from another context."""
+    while True:
+        with job.config():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class Campaign:
+    def __init__(self, jobs: List[Job], workdir: str = 'runs', credentials=None):
+        """
+        Args:
+          workdir: the sheet cache is shared, journals are kept in `workdir/<job name>`
+          credentials: shared by all jobs, defaults to the credentials of the logged in user
+        """
+        names = [job.name for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Job names must be unique: {names}")
+        self.jobs = jobs
+        self.workdir = workdir
+        if credentials is None:
+            # loaded once here, before the fetching threads would each start the login
+            from prispevky.google_authentication import get_credentials
+            credentials = get_credentials()
+        self.credentials = credentials
+        self.runs: Dict[str, JobRun] = {}
+        self.bounced = frozenset()
+        # of the last send watching for bounces
+        self.watcher = None
+
+    def run_dir(self, job: Job) -> str:
+        return os.path.join(self.workdir, job.name)
+
+    def journal_path(self, job: Job, testmode: bool = False) -> str:
+        return os.path.join(self.run_dir(job), journal_filename(testmode))
+
+    def _fetch_one(self, job: Job) -> JobRun:
+        with job.config():
+            try:
+                sheets = Sheets(job.spreadsheet_id, credentials=self.credentials,
+                                cache_dir=os.path.join(self.workdir, 'cache'))
+                df = sheets.get_dataframe(job.sheet)
+                needed_cols = NeededColumns()
+                check_sheet(df, needed_cols)
+                return JobRun(job, PaymentsDataFrame(df, needed_cols, self.bounced), needed_cols)
+            except Exception as e:
+                logging.error(f"Fetching job {job.name} ({job.spreadsheet_id}, {job.sheet}) failed: {e!r}")
+                return JobRun(job, error=e)
+
+    def fetch(self, workers: int = None) -> Dict[str, JobRun]:
+        """Fetch and prepare the sheets of all jobs concurrently. Failed jobs are kept with their error."""
+        self.bounced = bounced_addresses(self.workdir)
+        with ThreadPoolExecutor(max_workers=workers or len(self.jobs), thread_name_prefix='fetch') as pool:
+            self.runs = {run.job.name: run for run in pool.map(self._fetch_one, self.jobs)}
+        return self.runs
+
+    def send(self, mailer: Mailer = None, n_recipients: int = 2, testmode: bool = False, limit: int = None,
+             retry_pending: bool = False, bounce_wait: float = None, bounce_interval: float = 30.0,
+             **send_kwargs) -> SendReport:
+        """
+        Send the unpaid emails of all fetched jobs through one mailer, taking the jobs in turns.
+
+        Args:
+          mailer: defaults to a mailer of the shared credentials sending as the authenticated user
+          limit: send at most this many emails per job
+          bounce_wait: watch for bounces while sending and this many seconds after it, None not to watch
+          bounce_interval: seconds between the checks for bounces
+          send_kwargs: passed to `Mailer.send_many`
+        """
+        mailer = mailer if mailer is not None else Mailer(credentials=self.credentials, user_id='me')
+        runs = [run for run in self.runs.values() if run.error is None]
+        journals = {}
+        # (job run, journal, variable symbol, hash) of messages given to the mailer and waiting for a result
+        attempted = {}
+        try:
+            for run in runs:
+                os.makedirs(self.run_dir(run.job), exist_ok=True)
+                journals[run.job.name] = SendJournal(self.journal_path(run.job, testmode))
+
+            def job_messages(run: JobRun):
+                journal = journals[run.job.name]
+                rows = run.pdf.df_emailable_unpaid
+                rows = rows.head(limit) if limit is not None else rows
+                emails = payment_emails(rows, run.needed_cols, n_recipients=n_recipients, testmode=testmode)
+                for payment_email, msg_hash in journal.pending(emails, retry_pending):
+                    yield run, journal, payment_email, msg_hash
+
+            def messages():
+                jobs_messages = [in_config(run.job, job_messages(run)) for run in runs]
+                for i, (run, journal, payment_email, msg_hash) in enumerate(round_robin(jobs_messages)):
+                    attempted[i] = (run, journal, payment_email.variable_symbol, msg_hash)
+                    yield payment_email.raw
+
+            def on_result(i, result):
+                run, journal, vs, msg_hash = attempted.pop(i)
+                journal.record_result(vs, msg_hash, result)
+                run.results['sent' if result['send_status'] == "OK" else 'failed'] += 1
+
+            send_kwargs.setdefault('keep_results', False)
+            if bounce_wait is None:
+                report = mailer.send_many(messages(), on_result=on_result, **send_kwargs)
+            else:
+                self.watcher = BounceWatcher(list(journals.values()), credentials=mailer.credentials,
+                                             user_id=mailer.user_id, interval=bounce_interval)
+                report = send_and_watch(lambda: mailer.send_many(messages(), on_result=on_result, **send_kwargs),
+                                        self.watcher, linger=bounce_wait)
+        finally:
+            for journal in journals.values():
+                journal.close()
+        for run in runs:
+            logging.info(f"Job {run.job.name}: {dict(run.results)}")
+        return report
+
+    def summary(self) -> str:
+        lines = []
+        for name, run in self.runs.items():
+            if run.error is not None:
+                lines.append(f"{name}: fetch failed: {run.error!r}")
+            else:
+                lines.append(f"{name}: {len(run.pdf.df_emailable_unpaid)} unpaid, "
+                             f"{len(run.pdf.df_emailable_paid)} paid, {len(run.pdf.df_missing_email)} missing email"
+                             + (f", sent {dict(run.results)}" if run.results else ''))
+        return '\n'.join(lines)
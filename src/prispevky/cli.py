@@ -0,0 +1,281 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+from prispevky.config import get_config, set_config_paths
+
+"""
+Command line workflow replacing the notebook:
+
+    prispevky fetch              # download the sheet into the run directory (parquet snapshot with pyarrow)
+    prispevky plan               # show who will get an email
+    prispevky render --workers 8 # render the emails into the spool for review
+    prispevky send --yes         # send the spool, skipping already sent emails, and watch for bounces
+    prispevky bounces            # record the bounces received since the last send or check
+    prispevky status             # summary of the spool and the send journal
+    prispevky remind --yes       # send reminders only to people whose balance changed or who are due again
+    prispevky campaign --jobs units.cfg --yes  # fetch the sheets of several units at once and send them all
+    prispevky send --yes --metrics metrics.prom --profile qr_render  # stage timings, counters and a profile
+
+Modules are imported inside the commands so that the CLI starts quickly.
+"""
+
+
+def run_dir(args) -> str:
+    return os.path.join(args.workdir, args.sheet)
+
+
+def sheet_data_path(args, data_format: str = 'csv') -> str:
+    return os.path.join(run_dir(args), f'sheet.{data_format}')
+
+
+def spool_dir(args) -> str:
+    return os.path.join(run_dir(args), 'spool')
+
+
+def journal_path(args) -> str:
+    from prispevky.journal import journal_filename
+    return os.path.join(run_dir(args), journal_filename(args.test))
+
+
+def reminders_path(args) -> str:
+    from prispevky.reminders import snapshot_filename
+    # shared by all sheets, each reminder wave usually comes from a new export
+    return os.path.join(args.workdir, snapshot_filename(args.test))
+
+
+def load_payments(args):
+    import pandas as pd
+    from prispevky.journal import bounced_addresses
+    from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+    from prispevky.settings import check_sheet
+
+    if os.path.exists(sheet_data_path(args, 'parquet')):
+        from prispevky.sheet_snapshot import read_snapshot
+        df = read_snapshot(sheet_data_path(args, 'parquet'))
+    elif os.path.exists(sheet_data_path(args)):
+        df = pd.read_csv(sheet_data_path(args), dtype=str, keep_default_na=False)
+    else:
+        sys.exit(f"No data for sheet '{args.sheet}', run `prispevky fetch` first.")
+    needed_cols = NeededColumns()
+    try:
+        # all rows are checked before anything is rendered or sent
+        check_sheet(df, needed_cols)
+    except ValueError as e:
+        # PreflightError or a broken config
+        sys.exit(f"Fix the sheet or the config first: {e}")
+    # addresses that bounced in any earlier run are not used again
+    pdf = PaymentsDataFrame(df, needed_cols, bounced_addresses(args.workdir))
+    if args.limit is not None:
+        pdf.df_emailable_unpaid = pdf.df_emailable_unpaid.head(args.limit)
+    return pdf, needed_cols
+
+
+def fetch(args):
+    from prispevky.gsheet import Sheets
+    from prispevky.payment_data import NeededColumns
+    from prispevky.settings import format_problems, preflight
+    from prispevky.sheet_snapshot import parquet_available, write_snapshot
+
+    data_format = args.format or ('parquet' if parquet_available() else 'csv')
+    if data_format == 'parquet' and not parquet_available():
+        sys.exit("Parquet snapshots need pyarrow, install it (`uv sync --extra parquet`) or fetch with --format csv.")
+    sheets = Sheets(get_config()['spreadsheet']['id'], cache_dir=os.path.join(args.workdir, 'cache'))
+    df = sheets.get_dataframe(args.sheet)
+    problems = preflight(df, NeededColumns())
+    if len(problems):
+        print(f"{len(problems)} problems in the sheet, fix them before sending:\n{format_problems(problems)}")
+        if data_format == 'parquet':
+            # the typed snapshot cannot hold them, the csv keeps the sheet as it is
+            data_format = 'csv'
+    os.makedirs(run_dir(args), exist_ok=True)
+    if data_format == 'parquet':
+        write_snapshot(df, sheet_data_path(args, 'parquet'))
+    else:
+        df.to_csv(sheet_data_path(args), index=False)
+    # the other format would be stale
+    for other in {'csv', 'parquet'} - {data_format}:
+        if os.path.exists(sheet_data_path(args, other)):
+            os.remove(sheet_data_path(args, other))
+    print(f"Fetched {len(df)} rows of '{args.sheet}' to {sheet_data_path(args, data_format)}")
+
+
+def plan(args):
+    pdf, needed_cols = load_payments(args)
+    unpaid = pdf.df_emailable_unpaid
+    print(f"Missing email: {len(pdf.df_missing_email)}, paid: {len(pdf.df_emailable_paid)}, "
+          f"to send: {len(unpaid)}")
+    for _, row in unpaid.iterrows():
+        amount = row[needed_cols.amount_due] - row[needed_cols.amount_paid]
+        recipients = ', '.join(address.addr_spec for address in row.valid_addresses[:args.recipients])
+        print(f"{row[needed_cols.reg_num]:>12} {amount:>8} Kč  {row[needed_cols.name]:30} {recipients}")
+
+
+def render(args):
+    from prispevky.spool import render_spool
+
+    pdf, needed_cols = load_payments(args)
+    manifest = render_spool(pdf, needed_cols, spool_dir(args), workers=args.workers,
+                            n_recipients=args.recipients, testmode=args.test)
+    print(f"Rendered {len(manifest)} emails to {spool_dir(args)}")
+
+
+def send(args):
+    from prispevky.bounces import BounceWatcher, send_and_watch
+    from prispevky.journal import SendJournal
+    from prispevky.mailer import Mailer
+    from prispevky.spool import send_spool, verify_spool
+
+    if not os.path.exists(spool_dir(args)):
+        sys.exit("Nothing to send, run `prispevky render` first.")
+    try:
+        manifest = verify_spool(spool_dir(args))
+    except ValueError as error:
+        sys.exit(str(error))
+    if manifest['testmode'] != args.test:
+        sys.exit(f"The spool was rendered with testmode={manifest['testmode']}, render it again.")
+    if not args.yes:
+        sys.exit(f"Would send up to {len(manifest['emails'])} emails from {spool_dir(args)}, "
+                 f"rerun with --yes to send them.")
+    mailer = Mailer()
+    with SendJournal(journal_path(args)) as journal:
+        # bounces are collected while sending, and for --bounce-wait seconds after it
+        watcher = BounceWatcher(journal, user_id=mailer.user_id, interval=args.bounce_interval)
+        report = send_and_watch(lambda: send_spool(mailer, spool_dir(args), journal=journal, workers=args.workers),
+                                watcher, linger=args.bounce_wait)
+    print(report.summary())
+    print_bounces(watcher.bounces)
+    if report.failed:
+        sys.exit(1)
+
+
+def print_bounces(bounces):
+    if bounces:
+        print(f"{len(bounces)} bounced, these addresses will not be used again:")
+    for vs, address, reason in bounces:
+        print(f"{vs:>12} {address}  {reason or ''}")
+
+
+def bounces(args):
+    from prispevky.bounces import BounceWatcher
+    from prispevky.journal import SendJournal
+
+    if not os.path.exists(journal_path(args)):
+        sys.exit("Nothing sent from this sheet yet.")
+    with SendJournal(journal_path(args)) as journal:
+        watcher = BounceWatcher(journal)
+        watcher.poll()
+        print_bounces(watcher.bounces)
+        print(f"{len(journal.bounces())} bounces recorded in total")
+
+
+def status(args):
+    from prispevky.journal import SendJournal
+    from prispevky.spool import read_manifest
+
+    if os.path.exists(spool_dir(args)):
+        manifest = read_manifest(spool_dir(args))
+        print(f"Spool: {len(manifest['emails'])} emails, testmode={manifest['testmode']}")
+    else:
+        print("Spool: not rendered")
+    if os.path.exists(journal_path(args)):
+        with SendJournal(journal_path(args)) as journal:
+            print(f"Journal: {journal.summary()}")
+    else:
+        print("Journal: nothing sent")
+
+
+def remind(args):
+    from prispevky.journal import SendJournal
+    from prispevky.mailer import Mailer
+    from prispevky.reminders import ReminderSnapshot
+
+    pdf, needed_cols = load_payments(args)
+    interval = datetime.timedelta(days=args.interval_days)
+    with ReminderSnapshot(reminders_path(args)) as snapshot:
+        if not args.yes:
+            due = snapshot.due_rows(pdf.df_emailable_unpaid, needed_cols, interval)
+            sys.exit(f"Would send {len(due)} reminders, rerun with --yes to send them.")
+        with SendJournal(journal_path(args)) as journal:
+            report = snapshot.send(Mailer(), pdf, needed_cols, interval, n_recipients=args.recipients,
+                                   testmode=args.test, journal=journal, workers=args.workers)
+    print(report.summary())
+    if report.failed:
+        sys.exit(1)
+
+
+def campaign(args):
+    from prispevky.campaign import Campaign, read_jobs
+
+    if args.jobs is None:
+        sys.exit("Give the campaign file listing the jobs with --jobs.")
+    campaign = Campaign(read_jobs(args.jobs), workdir=args.workdir)
+    campaign.fetch()
+    if not args.yes:
+        print(campaign.summary())
+        sys.exit("Rerun with --yes to send the emails of all jobs.")
+    report = campaign.send(n_recipients=args.recipients, testmode=args.test, limit=args.limit,
+                           bounce_wait=args.bounce_wait, bounce_interval=args.bounce_interval, workers=args.workers)
+    print(campaign.summary())
+    print(report.summary())
+    print_bounces(campaign.watcher.bounces)
+    if report.failed or any(run.error is not None for run in campaign.runs.values()):
+        sys.exit(1)
+
+
+COMMANDS = dict(fetch=fetch, plan=plan, render=render, send=send, bounces=bounces, status=status, remind=remind,
+                campaign=campaign)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='prispevky', description="Payment emails with QR codes from g-sheets")
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--config', help="config file, defaults to the packaged config_prispevky.cfg")
+    parser.add_argument('--sheet', help="sheet name, defaults to spreadsheet.sheet_name from the config")
+    parser.add_argument('--workdir', default='runs', help="directory for fetched data, spools and journals")
+    parser.add_argument('--limit', type=int, help="only process the first N unpaid rows")
+    parser.add_argument('--test', action='store_true', help="cc the sender instead of the troop leaders")
+    parser.add_argument('--workers', type=int, default=4, help="rendering processes and sending threads")
+    parser.add_argument('--recipients', type=int, default=2, help="send to at most N addresses per person")
+    parser.add_argument('--yes', action='store_true', help="really send the emails")
+    parser.add_argument('--interval-days', type=float, default=14,
+                        help="remind: send again to unchanged balances after this many days")
+    parser.add_argument('--format', choices=['csv', 'parquet'],
+                        help="fetch: format of the fetched data, parquet (typed snapshot) if pyarrow is installed")
+    parser.add_argument('--bounce-wait', type=float, default=0,
+                        help="send, campaign: keep watching for bounces this many seconds after sending")
+    parser.add_argument('--bounce-interval', type=float, default=30,
+                        help="send, campaign: seconds between the checks for bounces while sending")
+    parser.add_argument('--jobs', help="campaign: file with one section per job, see prispevky.campaign")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="write the stage timings and counters of the run, Prometheus text for .prom/.txt, json "
+                             "otherwise")
+    parser.add_argument('--profile', metavar='STAGE', action='append', default=[],
+                        help="profile the stage (e.g. qr_render) with cProfile into workdir/profiles, repeatable")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format="[%(levelname)s] %(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+    if args.config is not None:
+        set_config_paths([args.config])
+    if args.sheet is None:
+        args.sheet = get_config()['spreadsheet']['sheet_name']
+    if args.metrics is None and not args.profile:
+        COMMANDS[args.command](args)
+        return
+
+    from prispevky.metrics import METRICS
+    METRICS.enable(profile_stages=args.profile)
+    try:
+        COMMANDS[args.command](args)
+    finally:
+        # also for the commands exiting with an error
+        if args.metrics is not None:
+            METRICS.write(args.metrics)
+        if args.profile:
+            METRICS.dump_profiles(os.path.join(args.workdir, 'profiles'))
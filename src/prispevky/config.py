@@ -1,4 +1,7 @@
 import configparser
+import contextlib
+import contextvars
+import functools
 import os
 import importlib.resources as resources
 
@@ -16,4 +19,97 @@ def read_config(config_paths):
 
 CONFIG_FILEPATH =  resources.files('prispevky.cfg')/'config_prispevky.cfg'
 # CONFIG_FILEPATH = './cfg/config_test.cfg'
-CONFIG = read_config([CONFIG_FILEPATH,])
+_config_paths = [CONFIG_FILEPATH,]
+
+
+# paths and config of the current job, see `use_config`
+_active_config = contextvars.ContextVar('prispevky_config', default=None)
+
+
+@functools.cache
+def _default_config() -> configparser.ConfigParser:
+    return read_config(_config_paths)
+
+
+@functools.cache
+def load_config(config_paths: tuple) -> configparser.ConfigParser:
+    return read_config(list(config_paths))
+
+
+def get_config() -> configparser.ConfigParser:
+    """The config of the current job if one is active (see `use_config`), otherwise the config of the process.
+    The config is read on first use, not on import."""
+    active = _active_config.get()
+    return active[1] if active is not None else _default_config()
+
+
+def get_config_paths():
+    active = _active_config.get()
+    return list(active[0]) if active is not None else list(_config_paths)
+
+
+def set_config_paths(config_paths):
+    """Use a different config from now on, the config and everything derived from it is read again."""
+    global _config_paths
+    _config_paths = list(config_paths)
+    _default_config.cache_clear()
+    for cache_clear in _derived_caches:
+        cache_clear()
+
+
+@contextlib.contextmanager
+def use_config(config_paths):
+    """
+    Within the block, `get_config` returns the config read from config_paths. The config is local to the
+    current thread (context), so that jobs with different configs can run concurrently in one process.
+    """
+    config_paths = tuple(str(path) for path in config_paths)
+    token = _active_config.set((config_paths, load_config(config_paths)))
+    try:
+        yield
+    finally:
+        _active_config.reset(token)
+
+
+# cache_clear of the `cache_per_config` functions, cleared by `set_config_paths`
+_derived_caches = []
+
+
+def cache_per_config(func):
+    """Like functools.cache for a function without arguments that depends on the config, cached for each config."""
+    results = {}
+
+    @functools.wraps(func)
+    def cached():
+        config = get_config()
+        # the config is kept with the result, so that its id is not reused by another config
+        if id(config) not in results:
+            results[id(config)] = (config, func())
+        return results[id(config)][1]
+
+    cached.cache_clear = results.clear
+    _derived_caches.append(results.clear)
+    return cached
+
+
+# base URL of the Google APIs, for testing against a local fake (see `prispevky.fake_google`)
+API_ENDPOINT_ENV = 'PRISPEVKY_GOOGLE_API_URL'
+
+
+def get_api_endpoint():
+    """
+    Base URL replacing https://*.googleapis.com/ for all Google APIs, from the PRISPEVKY_GOOGLE_API_URL
+    environment variable or api_endpoint in the [google] section of the config. None for the real APIs.
+    """
+    endpoint = os.environ.get(API_ENDPOINT_ENV) or get_config().get('google', 'api_endpoint', fallback=None)
+    if not endpoint:
+        return None
+    return endpoint if endpoint.endswith('/') else endpoint + '/'
+
+
+def __getattr__(name):
+    # `CONFIG` is kept for backwards compatibility, but `from prispevky.config import CONFIG` reads the config
+    # immediately, so the package itself uses get_config()
+    if name == 'CONFIG':
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
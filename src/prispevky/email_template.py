@@ -0,0 +1,76 @@
+import string
+from typing import Iterable, Tuple
+
+import html2text
+
+"""
+Email template compiled once per run.
+
+The HTML template is parsed once and the plain text alternative of its static parts is produced by html2text
+once, with unique markers in place of the fields. Rendering a message then only splices the per-person values
+into both versions with str.format. The values are spliced into the text as they are, without the markdown
+escapes html2text would add (e.g. '4\\. přístav' for '4. přístav').
+"""
+
+# Fields provided by `PaymentEmail.create_email`
+TEMPLATE_FIELDS = ('troop', 'payment_message', 'variable_symbol', 'specific_symbol', 'amount_czk',
+                   'human_account_number', 'human_due_date', 'qr_code_cid')
+# Additional fields provided when the config has the [sts] section
+STS_TEMPLATE_FIELDS = ('number_of_sts_phones',)
+
+MARKER = 'zzprispevkyfield{}zz'
+
+
+def format_field(field_name: str, conversion: str, format_spec: str) -> str:
+    conversion = f"!{conversion}" if conversion else ''
+    format_spec = f":{format_spec}" if format_spec else ''
+    return f"{{{field_name}{conversion}{format_spec}}}"
+
+
+class EmailTemplate:
+    def __init__(self, html: str, fields: Iterable[str]):
+        """
+        Args:
+          html: template with `{field}` placeholders, as for str.format
+          fields: names of the fields that will be provided to `render`
+
+        Raises:
+          ValueError: if the template uses a placeholder that is not in fields
+        """
+        self.html = html
+        self.fields = tuple(fields)
+
+        parsed = list(string.Formatter().parse(html))
+        self.placeholders = {field_name for _, field_name, _, _ in parsed if field_name is not None}
+        missing = self.placeholders - set(self.fields)
+        if missing:
+            raise ValueError(f"Email template uses placeholders that are not provided: {sorted(missing)}, "
+                             f"available are: {list(self.fields)}")
+
+        # html with a unique marker for each replacement field, converted to text once
+        marked_html = []
+        fields_by_marker = {}
+        for literal_text, field_name, format_spec, conversion in parsed:
+            marked_html.append(literal_text)
+            if field_name is not None:
+                marker = MARKER.format(len(fields_by_marker))
+                marked_html.append(marker)
+                fields_by_marker[marker] = format_field(field_name, conversion, format_spec)
+
+        text = self._html2text(''.join(marked_html))
+        text = text.replace('{', '{{').replace('}', '}}')
+        # fields in attributes dropped by html2text are simply not in the text version
+        for marker, field in fields_by_marker.items():
+            text = text.replace(marker, field)
+        self.text = text
+
+    @staticmethod
+    def _html2text(html: str) -> str:
+        converter = html2text.HTML2Text()
+        # no line wrapping, so that the line breaks do not depend on the length of the spliced values
+        converter.body_width = 0
+        return converter.handle(html)
+
+    def render(self, **values) -> Tuple[str, str]:
+        """Returns the (plain text, html) versions of the message."""
+        return self.text.format(**values), self.html.format(**values)
@@ -0,0 +1,465 @@
+import argparse
+import base64
+import collections
+import csv
+import email.parser
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prispevky.gsheet import split_a1_range
+
+"""
+Local stand-in for the parts of the Google APIs used by prispevky, for offline load testing and profiling.
+
+Implements Sheets v4 spreadsheets.get, values.get and values.batchGet, Drive v3 files.get (the version),
+Gmail v1 messages.send (json and media upload), getProfile, history.list and messages.get, and the HTTP batch
+endpoint. Requests can be delayed, sends over a quota are answered with 429 and any request can fail with a 5xx
+at a given rate. Sends to bouncing addresses succeed and a delivery status notification lands in the inbox in
+the thread of the sent message, like the ones of Gmail.
+
+Point the clients to it with the PRISPEVKY_GOOGLE_API_URL environment variable (or api_endpoint in the
+[google] config section), they then use anonymous credentials:
+
+    python -m prispevky.fake_google --port 8080 --sheet <spreadsheet id> PlatbyPodzim2025 sheet.csv \
+        --latency 0.05 --sends-per-second 2.5 --error-rate 0.01 --bounce nobody@example.com
+    PRISPEVKY_GOOGLE_API_URL=http://127.0.0.1:8080/ prispevky fetch
+
+or in process:
+
+    with FakeGoogleServer(latency=0.05) as google:
+        google.add_dataframe(spreadsheet_id, sheet_name, df)
+        os.environ['PRISPEVKY_GOOGLE_API_URL'] = google.url
+"""
+
+SHEET_RANGE = re.compile(r"^(?:'((?:[^']|'')*)'|([^!']*))!(.*)$")
+
+BOUNCE_TEMPLATE = """\
+From: Mail Delivery Subsystem <mailer-daemon@googlemail.com>
+To: {sender}
+Subject: Delivery Status Notification (Failure)
+X-Failed-Recipients: {address}
+MIME-Version: 1.0
+Content-Type: multipart/report; boundary="{boundary}"; report-type=delivery-status
+
+--{boundary}
+Content-Type: text/plain; charset="UTF-8"
+
+Address not found
+
+Your message wasn't delivered to {address} because the address couldn't be found, or is unable to \
+receive mail.
+
+--{boundary}
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; googlemail.com
+
+Final-Recipient: rfc822; {address}
+Action: failed
+Status: 5.1.1
+Diagnostic-Code: smtp; 550 5.1.1 The email account that you tried to reach does not exist.
+
+--{boundary}--
+"""
+
+
+def column_index(letters: str) -> int:
+    """'A' -> 0, 'AZ' -> 51"""
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def split_head(data: bytes):
+    """Headers and the rest of a MIME part or an HTTP message, with either line ending."""
+    match = re.search(rb'\r?\n\r?\n', data)
+    if match is None:
+        return data, b''
+    return data[:match.start()], data[match.end():]
+
+
+def multipart_parts(content_type: str, body: bytes):
+    """(headers, content bytes) of the parts of a multipart body, the contents are returned unparsed."""
+    boundary = email.message_from_string(f"Content-Type: {content_type}\n\n").get_param('boundary')
+    parts = []
+    for part in body.split(b'--' + boundary.encode())[1:]:
+        if part.startswith(b'--'):
+            break
+        head, content = split_head(part.lstrip(b'\r\n'))
+        # the line break before the next boundary belongs to the boundary
+        content = content[:-2] if content.endswith(b'\r\n') else content[:-1] if content.endswith(b'\n') else content
+        parts.append((email.parser.BytesHeaderParser().parsebytes(head), content))
+    return parts
+
+
+class FakeGoogleError(Exception):
+    def __init__(self, code: int, message: str, status: str):
+        super().__init__(message)
+        self.code = code
+        self.body = dict(error=dict(code=code, message=message, status=status))
+
+
+class FakeGoogle:
+    """State and the request handling of the fake APIs, independent of the HTTP server."""
+
+    def __init__(self, latency: float = 0.0, sends_per_second: float = None, error_rate: float = 0.0,
+                 reject_addresses=(), bounce_addresses=(), bounce_delay: float = 0.0, keep_messages: bool = False,
+                 batch_errors=(), seed: int = None):
+        """
+        Args:
+          latency: seconds added to every request
+          sends_per_second: Gmail sends over this rate (with a one second burst) are answered with 429
+          error_rate: probability that a request fails with 500 or 503
+          reject_addresses: messages to these addresses are rejected with 400
+          bounce_addresses: messages to these addresses are sent, a bounce arrives bounce_delay seconds later
+          keep_messages: keep the raw sent messages in `messages`, otherwise only count them
+          batch_errors: statuses of the next batch requests that fail as a whole, e.g. [503] fails the first one
+        """
+        self.latency = latency
+        self.sends_per_second = sends_per_second
+        self.error_rate = error_rate
+        self.reject_addresses = {address.lower() for address in reject_addresses}
+        self.bounce_addresses = {address.lower() for address in bounce_addresses}
+        self.bounce_delay = bounce_delay
+        self.keep_messages = keep_messages
+        self.batch_errors = collections.deque(batch_errors)
+        self.spreadsheets = {}
+        self.versions = {}
+        self.messages = []
+        # the mailbox: message metadata (and the raw bytes of the received bounces) by id, and the
+        # messageAdded history records, as (history id, message id)
+        self.mailbox = {}
+        self.history = []
+        self.history_id = 1000
+        # history records up to this id were dropped, older start ids are answered with 404
+        self.history_expired = 1000
+        self._bounces = []
+        self.stats = collections.Counter()
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = sends_per_second
+        self._refilled = time.monotonic()
+
+    def add_sheet(self, spreadsheet_id: str, sheet_name: str, rows):
+        """Rows of cell values, the first one is the header."""
+        with self._lock:
+            self.spreadsheets.setdefault(spreadsheet_id, {})[sheet_name] = [[str(cell) for cell in row] for row in rows]
+            self.versions[spreadsheet_id] = self.versions.get(spreadsheet_id, 0) + 1
+
+    def add_dataframe(self, spreadsheet_id: str, sheet_name: str, df):
+        self.add_sheet(spreadsheet_id, sheet_name, [list(df.columns)] + df.fillna('').astype(str).values.tolist())
+
+    def add_csv(self, spreadsheet_id: str, sheet_name: str, path: str):
+        with open(path, 'rt', encoding='utf-8', newline='') as f:
+            self.add_sheet(spreadsheet_id, sheet_name, list(csv.reader(f)))
+
+    # -- dispatch --
+
+    def handle(self, method: str, url: str, headers, body: bytes):
+        """Returns (status, content type, response body bytes)."""
+        path, _, query = url.partition('?')
+        path = urllib.parse.unquote(path)
+        params = urllib.parse.parse_qs(query)
+        if method == 'POST' and path.rstrip('/') in ('/batch', '/batch/gmail/v1'):
+            # every part is delayed and may fail on its own, the batch request itself only with batch_errors
+            return self._batch(headers, body)
+        if self.latency:
+            time.sleep(self.latency)
+        self.stats['requests'] += 1
+        try:
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats['injected_errors'] += 1
+                raise self._random.choice([FakeGoogleError(500, "Backend Error", 'INTERNAL'),
+                                           FakeGoogleError(503, "The service is currently unavailable.",
+                                                           'UNAVAILABLE')])
+            response = self._route(method, path, params, headers, body)
+            return 200, 'application/json; charset=UTF-8', json.dumps(response).encode('utf-8')
+        except FakeGoogleError as error:
+            self.stats[f"status_{error.code}"] += 1
+            return error.code, 'application/json; charset=UTF-8', json.dumps(error.body).encode('utf-8')
+
+    def _route(self, method, path, params, headers, body):
+        parts = path.strip('/').split('/')
+        if method == 'GET' and parts[:2] == ['v4', 'spreadsheets'] and len(parts) >= 3:
+            spreadsheet_id = parts[2]
+            if len(parts) == 3:
+                return self._spreadsheet(spreadsheet_id)
+            if len(parts) == 4 and parts[3] == 'values:batchGet':
+                return dict(spreadsheetId=spreadsheet_id,
+                            valueRanges=[self._values(spreadsheet_id, a1) for a1 in params.get('ranges', [])])
+            if len(parts) == 5 and parts[3] == 'values':
+                return self._values(spreadsheet_id, parts[4])
+        if method == 'GET' and parts[:3] == ['drive', 'v3', 'files'] and len(parts) == 4:
+            if parts[3] not in self.spreadsheets:
+                raise FakeGoogleError(404, f"File not found: {parts[3]}.", 'NOT_FOUND')
+            return dict(version=str(self.versions[parts[3]]))
+        if parts[:1] == ['upload']:
+            # media uploads
+            parts = parts[1:]
+        if parts[:3] == ['gmail', 'v1', 'users'] and len(parts) >= 5:
+            if method == 'POST' and parts[4:] == ['messages', 'send']:
+                return self._send(params, headers, body)
+            if method == 'GET' and parts[4:] == ['profile']:
+                return self._profile(parts[3])
+            if method == 'GET' and parts[4:] == ['history']:
+                return self._history(params)
+            if method == 'GET' and len(parts) == 6 and parts[4] == 'messages':
+                return self._message(parts[5], params)
+        raise FakeGoogleError(404, f"Not found: {method} {path}", 'NOT_FOUND')
+
+    # -- sheets --
+
+    def _spreadsheet(self, spreadsheet_id):
+        if spreadsheet_id not in self.spreadsheets:
+            raise FakeGoogleError(404, "Requested entity was not found.", 'NOT_FOUND')
+        sheets = []
+        for index, (title, rows) in enumerate(self.spreadsheets[spreadsheet_id].items()):
+            sheets.append(dict(properties=dict(
+                sheetId=index, title=title, index=index, sheetType='GRID',
+                gridProperties=dict(rowCount=len(rows), columnCount=max((len(row) for row in rows), default=0)))))
+        return dict(spreadsheetId=spreadsheet_id, sheets=sheets)
+
+    def _values(self, spreadsheet_id, a1):
+        if spreadsheet_id not in self.spreadsheets:
+            raise FakeGoogleError(404, "Requested entity was not found.", 'NOT_FOUND')
+        match = SHEET_RANGE.match(a1)
+        sheet_name = (match.group(1).replace("''", "'") if match.group(1) is not None else match.group(2)) \
+            if match else None
+        rows = self.spreadsheets[spreadsheet_id].get(sheet_name)
+        if rows is None:
+            raise FakeGoogleError(400, f"Unable to parse range: {a1}", 'INVALID_ARGUMENT')
+        try:
+            col_from, row_from, col_to, row_to = split_a1_range(match.group(3))
+        except ValueError:
+            raise FakeGoogleError(400, f"Unable to parse range: {a1}", 'INVALID_ARGUMENT')
+        first, last = column_index(col_from), column_index(col_to)
+        values = []
+        for row in rows[row_from - 1:row_to]:
+            row = row[first:last + 1]
+            # like the API, trailing empty cells and rows are omitted
+            while row and row[-1] == '':
+                row = row[:-1]
+            values.append(row)
+        while values and not values[-1]:
+            values.pop()
+        response = dict(range=a1, majorDimension='ROWS')
+        if values:
+            response['values'] = values
+        return response
+
+    # -- gmail --
+
+    def _take_send_quota(self):
+        if self.sends_per_second is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.sends_per_second, self._tokens + (now - self._refilled) * self.sends_per_second)
+            self._refilled = now
+            if self._tokens < 1:
+                raise FakeGoogleError(429, "User-rate limit exceeded.", 'RESOURCE_EXHAUSTED')
+            self._tokens -= 1
+
+    def _send(self, params, headers, body):
+        upload_type = params.get('uploadType', [None])[0]
+        if upload_type == 'media':
+            raw = body
+        elif upload_type == 'multipart':
+            # json metadata part followed by the message part
+            raw = multipart_parts(headers['Content-Type'], body)[1][1]
+        else:
+            raw = base64.urlsafe_b64decode(json.loads(body)['raw'])
+        self._take_send_quota()
+        headers = email.parser.BytesParser().parsebytes(raw, headersonly=True)
+        recipients = ','.join(headers.get_all('To', []) + headers.get_all('Cc', [])).lower()
+        if any(address in recipients for address in self.reject_addresses):
+            raise FakeGoogleError(400, "Invalid To header", 'INVALID_ARGUMENT')
+        message_id = f"{next(self._ids):016x}"
+        with self._lock:
+            self.stats['messages_sent'] += 1
+            if self.keep_messages:
+                self.messages.append(raw)
+            self._add_to_mailbox(dict(id=message_id, threadId=message_id, labelIds=['SENT']))
+            for address in self.bounce_addresses:
+                if address in recipients:
+                    bounce = BOUNCE_TEMPLATE.format(sender=headers['From'], address=address,
+                                                    boundary=f"report_{message_id}")
+                    self._bounces.append((time.monotonic() + self.bounce_delay, message_id,
+                                          bounce.replace('\n', '\r\n').encode('utf-8')))
+        return dict(id=message_id, threadId=message_id, labelIds=['SENT'])
+
+    def _add_to_mailbox(self, message: dict):
+        self.history_id += 1
+        message['historyId'] = str(self.history_id)
+        self.mailbox[message['id']] = message
+        self.history.append((self.history_id, message['id']))
+
+    def _deliver_bounces(self):
+        """Bounces that are due go to the inbox, in the thread of the bounced message."""
+        with self._lock:
+            now = time.monotonic()
+            due = [bounce for bounce in self._bounces if bounce[0] <= now]
+            self._bounces = [bounce for bounce in self._bounces if bounce[0] > now]
+            for _, thread_id, raw in due:
+                self.stats['bounces'] += 1
+                self._add_to_mailbox(dict(id=f"{next(self._ids):016x}", threadId=thread_id,
+                                          labelIds=['INBOX', 'UNREAD'], raw=raw))
+
+    def expire_history(self):
+        """Drop the history so far, like Gmail does after about a week."""
+        with self._lock:
+            self.history = []
+            self.history_expired = self.history_id
+
+    def _profile(self, user_id):
+        self._deliver_bounces()
+        return dict(emailAddress=user_id, messagesTotal=len(self.mailbox), historyId=str(self.history_id))
+
+    def _history(self, params, page_size=100):
+        self._deliver_bounces()
+        try:
+            start = int(params['startHistoryId'][0])
+        except (KeyError, ValueError):
+            raise FakeGoogleError(400, "Invalid startHistoryId", 'INVALID_ARGUMENT')
+        if start < self.history_expired:
+            raise FakeGoogleError(404, "Requested entity was not found.", 'NOT_FOUND')
+        label = params.get('labelId', [None])[0]
+        offset = int(params.get('pageToken', ['0'])[0])
+        with self._lock:
+            records = [(history_id, self.mailbox[message_id]) for history_id, message_id in self.history
+                       if history_id > start and (label is None or label in self.mailbox[message_id]['labelIds'])]
+            response = dict(historyId=str(self.history_id))
+        page = records[offset:offset + page_size]
+        if page:
+            response['history'] = [
+                dict(id=str(history_id),
+                     messages=[dict(id=message['id'], threadId=message['threadId'])],
+                     messagesAdded=[dict(message=dict(id=message['id'], threadId=message['threadId'],
+                                                      labelIds=message['labelIds']))])
+                for history_id, message in page]
+        if offset + page_size < len(records):
+            response['nextPageToken'] = str(offset + page_size)
+        return response
+
+    def _message(self, message_id, params):
+        message = self.mailbox.get(message_id)
+        if message is None:
+            raise FakeGoogleError(404, "Requested entity was not found.", 'NOT_FOUND')
+        self.stats['messages_get'] += 1
+        raw = message.get('raw', b'')
+        response = dict(id=message['id'], threadId=message['threadId'], labelIds=message['labelIds'],
+                        historyId=message['historyId'], sizeEstimate=len(raw))
+        if params.get('format', ['full'])[0] == 'raw':
+            response['raw'] = base64.urlsafe_b64encode(raw).decode('ascii')
+            return response
+        wanted = {name.lower() for name in params.get('metadataHeaders', [])}
+        headers = email.parser.BytesParser().parsebytes(raw, headersonly=True)
+        response['payload'] = dict(mimeType=headers.get_content_type(),
+                                   headers=[dict(name=name, value=str(value)) for name, value in headers.items()
+                                            if not wanted or name.lower() in wanted])
+        return response
+
+    def _batch(self, headers, body):
+        self.stats['batches'] += 1
+        with self._lock:
+            status = self.batch_errors.popleft() if self.batch_errors else None
+        if status is not None:
+            self.stats[f"batch_status_{status}"] += 1
+            error = FakeGoogleError(status, "Batch request failed.", 'UNAVAILABLE' if status >= 500 else 'ERROR')
+            return status, 'application/json; charset=UTF-8', json.dumps(error.body).encode('utf-8')
+        boundary = f"batch_{next(self._ids):016x}"
+        parts = []
+        for part_headers, request in multipart_parts(headers['Content-Type'], body):
+            head, request_body = split_head(request)
+            request_line, *header_lines = head.decode('utf-8').splitlines()
+            method, url, _ = request_line.split(' ', 2)
+            request_headers = dict(line.split(': ', 1) for line in header_lines if ': ' in line)
+            status, response_type, response_body = self.handle(method, url, request_headers, request_body)
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\n"
+                         f"Content-ID: <response-{part_headers['Content-ID'].strip('<>')}>\r\n\r\n"
+                         f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                         f"Content-Type: {response_type}\r\nContent-Length: {len(response_body)}\r\n\r\n"
+                         .encode('utf-8') + response_body + b"\r\n")
+        return 200, f'multipart/mixed; boundary={boundary}', b''.join(parts) + f"--{boundary}--\r\n".encode()
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real APIs, with the response written in one segment (no Nagle / delayed ACK stalls)
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = 1 << 16
+
+    def _respond(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, content_type, response = self.server.google.handle(self.command, self.path, self.headers, body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGoogleServer(FakeGoogle):
+    """`FakeGoogle` served over HTTP on localhost in a background thread, use as a context manager."""
+
+    def __init__(self, port: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), FakeGoogleHandler)
+        self.server.daemon_threads = True
+        self.server.google = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m prispevky.fake_google',
+                                     description="Local fake of the Google APIs used by prispevky")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--sheet', nargs=3, action='append', default=[],
+                        metavar=('SPREADSHEET_ID', 'SHEET_NAME', 'CSV'), help="serve the csv as a sheet")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--sends-per-second', type=float, help="answer sends over this rate with 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability of a 5xx answer")
+    parser.add_argument('--reject', nargs='*', default=[], help="reject messages to these addresses with 400")
+    parser.add_argument('--bounce', nargs='*', default=[], help="send a bounce for messages to these addresses")
+    parser.add_argument('--bounce-delay', type=float, default=0.0, help="seconds until a bounce arrives")
+    args = parser.parse_args(argv)
+
+    google = FakeGoogleServer(port=args.port, latency=args.latency, sends_per_second=args.sends_per_second,
+                              error_rate=args.error_rate, reject_addresses=args.reject,
+                              bounce_addresses=args.bounce, bounce_delay=args.bounce_delay)
+    for spreadsheet_id, sheet_name, path in args.sheet:
+        google.add_csv(spreadsheet_id, sheet_name, path)
+    print(f"Serving fake Google APIs at {google.url}, stop with Ctrl+C")
+    try:
+        google.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        google.server.server_close()
+        print(dict(google.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,20 @@
+import functools
+import logging
 import os
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 import importlib.resources as resources
-from prispevky.config import CONFIG
+from prispevky.config import get_api_endpoint, get_config
 
 """
 Based on 
 https://developers.google.com/docs/api/quickstart/python
 
 To allow access:
-1. go to https://console.cloud.google.com, enable g-sheet and g-mail apis
+1. go to https://console.cloud.google.com, enable g-sheet and g-mail apis (and drive api for the sheet cache)
 2. go to OAuth consent screen -> internal -> fill fields and continue
 3. go to Credentials -> Create credentials -> OAuth client ID -> fill fields -> download json
+
+Credentials are loaded (and possibly refreshed or generated in the browser) on first use, not on import.
 """
 
 
@@ -21,30 +22,91 @@ To allow access:
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
           'https://www.googleapis.com/auth/gmail.readonly',
           'https://www.googleapis.com/auth/gmail.send']
+# Only to check whether a spreadsheet changed since it was cached (see `gsheet.Sheets.get_revision`). Asked
+# for when a new token is generated, but not required: an older token.json without it works, just uncached.
+DRIVE_METADATA_SCOPE = 'https://www.googleapis.com/auth/drive.metadata.readonly'
+OPTIONAL_SCOPES = [DRIVE_METADATA_SCOPE]
+
+TOKEN_FILENAME = 'token.json'
+
+
+def credentials_folder():
+    return resources.files('prispevky.authentication')
+
+
+def default_credentials_file():
+    return credentials_folder()/get_config()['credentials']['filename']
+
 
-CREDENTIALS_FOLDER = resources.files('prispevky.authentication')
-CREDENTIALS = CREDENTIALS_FOLDER/CONFIG['credentials']['filename']
-TOKEN_FILE = CREDENTIALS_FOLDER/'token.json'
+def has_scope(credentials, scope: str) -> bool:
+    """False for user credentials granted without the scope, credentials without scopes (e.g. anonymous) have it."""
+    scopes = getattr(credentials, 'scopes', None)
+    return scopes is None or scope in scopes
+
+
+def load_or_generate_credentials(scopes, credentials_file=None, optional_scopes=()):
+    """
+    Args:
+      scopes: required, a token.json without them is replaced by logging in again
+      optional_scopes: asked for when logging in, an existing token.json is used without them
+    """
+    # google auth libraries are slow to import, only import them when authenticating
+    from google.auth.exceptions import RefreshError
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    if credentials_file is None:
+        credentials_file = default_credentials_file()
+    token_file = credentials_folder()/TOKEN_FILENAME
 
-def load_or_generate_credentials(scopes, credentials_file=CREDENTIALS):
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists(TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, scopes)
+    if os.path.exists(token_file):
+        # with the scopes it was granted, refreshing it with other scopes fails
+        creds = Credentials.from_authorized_user_file(token_file)
+        missing = set(scopes) - set(creds.scopes or ())
+        if missing:
+            logging.warning(f"{TOKEN_FILENAME} was granted without {sorted(missing)}, log in again.")
+            creds = None
+    if creds and creds.valid:
+        return creds
+    if creds and creds.expired and creds.refresh_token:
+        try:
+            creds.refresh(Request())
+        except RefreshError as error:
+            logging.warning(f"Refreshing {TOKEN_FILENAME} failed, log in again: {error}")
+            creds = None
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                credentials_file, scopes)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open(TOKEN_FILE, 'wt', encoding='utf-8') as token:
-            token.write(creds.to_json())
+        flow = InstalledAppFlow.from_client_secrets_file(
+            credentials_file, list(scopes) + [scope for scope in optional_scopes if scope not in scopes])
+        creds = flow.run_local_server(port=0)
+    # Save the credentials for the next run
+    with open(token_file, 'wt', encoding='utf-8') as token:
+        token.write(creds.to_json())
     return creds
 
 
-GOOGLE_CREDENTIALS = load_or_generate_credentials(SCOPES)
+@functools.cache
+def get_credentials():
+    if get_api_endpoint() is not None:
+        # a local fake of the APIs (see prispevky.fake_google) does not need a login
+        from google.auth.credentials import AnonymousCredentials
+        return AnonymousCredentials()
+    return load_or_generate_credentials(SCOPES, optional_scopes=OPTIONAL_SCOPES)
+
+
+def __getattr__(name):
+    # backwards compatible module attributes, evaluated lazily
+    if name == 'GOOGLE_CREDENTIALS':
+        return get_credentials()
+    if name == 'CREDENTIALS':
+        return default_credentials_file()
+    if name == 'TOKEN_FILE':
+        return credentials_folder()/TOKEN_FILENAME
+    if name == 'CREDENTIALS_FOLDER':
+        return credentials_folder()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,114 @@
+import functools
+import json
+import threading
+
+from prispevky.config import get_api_endpoint
+from prispevky.google_authentication import get_credentials
+
+"""
+Google API services are built on first use, `googleapiclient.discovery` is slow to import.
+
+The discovery documents shipped with googleapiclient (static discovery) are read and parsed once per process.
+Each thread gets its own keep-alive httplib2 transport, httplib2 is not thread safe, and its own service
+objects on top of it, so repeated calls from one thread reuse the TLS connection. All threads share the
+credentials, which are refreshed by one thread at a time (batch requests refresh them through googleapiclient).
+
+With an api endpoint configured (see `config.get_api_endpoint`), the root URL of the discovery documents is
+replaced by it, so that the API calls, media uploads and batch requests all go to e.g. `prispevky.fake_google`.
+"""
+
+# seconds, without a timeout a stalled connection blocks the worker forever
+HTTP_TIMEOUT = 60
+
+_local = threading.local()
+_refresh_lock = threading.Lock()
+
+
+@functools.cache
+def discovery_document(name: str, version: str, root_url: str = None) -> dict:
+    from googleapiclient.discovery_cache import get_static_doc
+    doc = get_static_doc(name, version)
+    if doc is None:
+        raise ValueError(f"No static discovery document for {name} {version}")
+    doc = json.loads(doc)
+    if root_url is not None:
+        doc['rootUrl'] = root_url
+    return doc
+
+
+def refresh_shared(credentials, request, token):
+    """
+    Refresh credentials used from several threads, one thread at a time. token is the one the caller saw,
+    a thread that waited for another thread's refresh reuses the new token instead of refreshing again.
+    """
+    with _refresh_lock:
+        if credentials.token == token or not credentials.valid:
+            credentials.refresh(request)
+
+
+@functools.cache
+def _authorized_http_class():
+    from google_auth_httplib2 import AuthorizedHttp
+    from google.auth.transport import DEFAULT_REFRESH_STATUS_CODES
+
+    class SharedRefreshHttp(AuthorizedHttp):
+        """
+        AuthorizedHttp for credentials shared by the transports of several threads, refreshed with
+        `refresh_shared` before the request and after a 401, instead of by each thread on its own.
+        The credentials themselves are not modified.
+        """
+
+        def __init__(self, credentials, http):
+            # the refreshes after a 401 are done here, not by AuthorizedHttp
+            super().__init__(credentials, http=http, refresh_status_codes=())
+
+        def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+            token = self.credentials.token
+            if not self.credentials.valid:
+                refresh_shared(self.credentials, self._request, token)
+                token = self.credentials.token
+            position = body.tell() if hasattr(body, 'tell') and hasattr(body, 'seek') else None
+            response, content = super().request(uri, method, body=body, headers=headers, **kwargs)
+            if response.status in DEFAULT_REFRESH_STATUS_CODES:
+                refresh_shared(self.credentials, self._request, token)
+                if position is not None:
+                    body.seek(position)
+                response, content = super().request(uri, method, body=body, headers=headers, **kwargs)
+            return response, content
+
+    return SharedRefreshHttp
+
+
+def thread_http(credentials):
+    """Authorized keep-alive transport of the current thread for credentials."""
+    import httplib2
+
+    transports = _local.__dict__.setdefault('transports', {})
+    # credentials are kept in the value so that their id is not reused while cached
+    if id(credentials) not in transports:
+        http = _authorized_http_class()(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        transports[id(credentials)] = (credentials, http)
+    return transports[id(credentials)][1]
+
+
+def build_service(name: str, version: str, credentials=None, root_url: str = None):
+    """New service on the transport of the current thread, use it only from this thread."""
+    from googleapiclient.discovery import build_from_document
+    if credentials is None:
+        credentials = get_credentials()
+    return build_from_document(discovery_document(name, version, root_url), http=thread_http(credentials))
+
+
+def get_service(name: str, version: str, credentials=None):
+    """
+    Service of the current thread, built once per thread and credentials.
+    Defaults to the credentials of the logged in user.
+    """
+    if credentials is None:
+        credentials = get_credentials()
+    services = _local.__dict__.setdefault('services', {})
+    root_url = get_api_endpoint()
+    key = (name, version, id(credentials), root_url)
+    if key not in services:
+        services[key] = (credentials, build_service(name, version, credentials, root_url))
+    return services[key][1]
@@ -1,51 +1,211 @@
 from __future__ import print_function
 
+import hashlib
+import json
+import logging
+import os
+import re
+
 import pandas as pd
-from googleapiclient.discovery import build
+from googleapiclient import errors
+
+from prispevky.config import get_config
+from prispevky.google_authentication import DRIVE_METADATA_SCOPE, get_credentials, has_scope
+from prispevky.google_services import get_service
+from prispevky.metrics import METRICS
+
+A1_RANGE = re.compile(r"([A-Z]+)(\d*):([A-Z]+)(\d*)")
 
-from prispevky.config import CONFIG
-from prispevky.google_authentication import GOOGLE_CREDENTIALS
 
-# The ID and range of a sample spreadsheet.
-SPREADSHEET_ID = CONFIG['spreadsheet']['id']
-SHEET_NAME = CONFIG['spreadsheet']['sheet_name']
+def __getattr__(name):
+    # The ID and range of a sample spreadsheet, read from the config on first use.
+    if name == 'SPREADSHEET_ID':
+        return get_config()['spreadsheet']['id']
+    if name == 'SHEET_NAME':
+        return get_config()['spreadsheet']['sheet_name']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
+def split_a1_range(a1_range: str):
+    """'A2:AZ' -> ('A', 2, 'AZ', None)"""
+    match = A1_RANGE.fullmatch(a1_range)
+    if match is None:
+        raise ValueError(f"Unsupported range '{a1_range}', expected e.g. 'A2:AZ' or 'A2:AZ100'")
+    col_from, row_from, col_to, row_to = match.groups()
+    return col_from, int(row_from or 1), col_to, int(row_to) if row_to else None
+
 
 class Sheets:
-    def __init__(self, sheet_id):
+    def __init__(self, sheet_id, credentials=None, cache_dir=None):
+        """
+        Args:
+          cache_dir: if set, fetched values are cached there and reused while the spreadsheet is unchanged
+        """
         self.sheet_id = sheet_id
-        self.creds = GOOGLE_CREDENTIALS
-        self.service = build('sheets', 'v4', credentials=self.creds)
+        self.creds = credentials
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.service = self._service('sheets', 'v4')
+        self._metadata = None
+        self._drive_service = None
 
-    def get_available_sheet_info(self):
-        sheet_metadata = self.service.spreadsheets().get(spreadsheetId=self.sheet_id).execute()
+    def _service(self, name, version):
+        return get_service(name, version, self.creds)
 
-        properties = sheet_metadata.get('sheets')
+    def get_metadata(self, refresh=False):
+        if self._metadata is None or refresh:
+            METRICS.inc('sheets_api_calls')
+            self._metadata = self.service.spreadsheets().get(spreadsheetId=self.sheet_id,
+                                                             fields='sheets.properties').execute()
+        return self._metadata
+
+    def get_available_sheet_info(self):
+        properties = self.get_metadata().get('sheets')
         for item in properties:
-            sheet_id = (item.get("properties").get('sheetId'))
             print(item)
 
     def get_sheet_names(self):
-        sheet_metadata = self.service.spreadsheets().get(spreadsheetId=self.sheet_id).execute()
-        properties = sheet_metadata.get('sheets')
+        properties = self.get_metadata().get('sheets')
 
         return [prop['properties']['title'] for prop in properties]
 
-    def get_dataframe(self, sheet_name: str,
-                      colnames_range: str = "A1:AZ",
-                      values_range: str = "A2:AZ"):
-        column_names = self.service.spreadsheets().values().get(spreadsheetId=self.sheet_id,
-                                                                range=f"'{sheet_name}'!{colnames_range}").execute()
-        values = self.service.spreadsheets().values().get(spreadsheetId=self.sheet_id,
-                                                          range=f"'{sheet_name}'!{values_range}").execute()
+    def get_row_count(self, sheet_name: str) -> int:
+        for prop in self.get_metadata().get('sheets'):
+            if prop['properties']['title'] == sheet_name:
+                return prop['properties']['gridProperties']['rowCount']
+        raise KeyError(f"No sheet '{sheet_name}' in {self.get_sheet_names()}")
+
+    def get_revision(self):
+        """
+        Version of the spreadsheet file, increases with every change. One cheap Drive metadata call.
+        Returns None when it can't be read and the sheet is then fetched without the cache: for a token.json
+        granted without the drive.metadata.readonly scope or with the Drive API not enabled in the project.
+        """
+        if not has_scope(self.creds if self.creds is not None else get_credentials(), DRIVE_METADATA_SCOPE):
+            logging.warning(f"The token was granted without {DRIVE_METADATA_SCOPE}, fetching without the cache "
+                            f"(delete token.json and log in again to use it).")
+            return None
+        if self._drive_service is None:
+            self._drive_service = self._service('drive', 'v3')
+        METRICS.inc('drive_api_calls')
+        try:
+            return self._drive_service.files().get(fileId=self.sheet_id, fields='version').execute()['version']
+        except errors.HttpError as error:
+            logging.warning(f"Can't read spreadsheet version, not using the cache "
+                            f"(is the Drive API enabled in the Google Cloud project?): {error}")
+            return None
+
+    def batch_get(self, sheet_name: str, ranges):
+        """Values of all the ranges of one sheet in a single request."""
+        with METRICS.stage('sheets_fetch'):
+            response = self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.sheet_id, ranges=[f"'{sheet_name}'!{a1_range}" for a1_range in ranges]).execute()
+        values = [value_range.get('values', []) for value_range in response['valueRanges']]
+        METRICS.inc('sheets_api_calls')
+        METRICS.inc('sheet_rows_fetched', sum(len(rows) for rows in values))
+        return values
 
-        return pd.DataFrame(values['values'], columns=column_names['values'][0])
+    def _cache_path(self, sheet_name, colnames_range, values_range):
+        key = hashlib.sha256(f"{self.sheet_id}|{sheet_name}|{colnames_range}|{values_range}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key[:32]}.json")
+
+    def _load_cache(self, path):
+        if self.cache_dir is None or not os.path.exists(path):
+            return None
+        with open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_cache(self, path, revision, header, values):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(dict(revision=revision, header=header, values=values), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _get_chunked(self, sheet_name, colnames_range, values_range, chunk_rows):
+        col_from, row_from, col_to, row_to = split_a1_range(values_range)
+        if row_to is None:
+            row_to = self.get_row_count(sheet_name)
+        header_rows = None
+        values = []
+        for start in range(row_from, row_to + 1, chunk_rows):
+            end = min(start + chunk_rows - 1, row_to)
+            chunk_range = f"{col_from}{start}:{col_to}{end}"
+            if header_rows is None:
+                header_rows, chunk = self.batch_get(sheet_name, [colnames_range, chunk_range])
+            else:
+                chunk, = self.batch_get(sheet_name, [chunk_range])
+            # trailing empty rows of a chunk are omitted by the API, pad to keep the rows aligned
+            values.extend(chunk + [[]] * (end - start + 1 - len(chunk)))
+        while values and not values[-1]:
+            values.pop()
+        return header_rows, values
+
+    def _get_appended(self, sheet_name, colnames_range, values_range, cached_values):
+        """Header and the cached values with the rows appended since, None if the last cached row changed."""
+        logging.warning(f"Fetching '{sheet_name}' incrementally, edits of the already fetched rows are not seen.")
+        col_from, row_from, col_to, row_to = split_a1_range(values_range)
+        last_cached_row = row_from + len(cached_values) - 1
+        header_rows, rows = self.batch_get(
+            sheet_name, [colnames_range, f"{col_from}{last_cached_row}:{col_to}{row_to or ''}"])
+        if rows[:1] != cached_values[-1:]:
+            logging.warning(f"The last fetched row of '{sheet_name}' changed, fetching the whole sheet.")
+            return None
+        logging.info(f"Fetched {len(rows) - 1} rows appended to '{sheet_name}' since the last fetch.")
+        return header_rows, cached_values + rows[1:]
+
+    def get_values(self, sheet_name: str,
+                   colnames_range: str = "A1:AZ1",
+                   values_range: str = "A2:AZ",
+                   chunk_rows: int = None,
+                   incremental: bool = False):
+        """
+        Returns the header row and the list of value rows.
+
+        Args:
+          chunk_rows: fetch the values in chunks of this many rows, for large sheets
+          incremental: only fetch the rows appended since the cached fetch. UNSAFE for sheets whose existing rows
+            are edited, e.g. paid amounts filled in later: those edits are NOT seen and the cached, stale values
+            are returned. Only the last cached row is fetched again, a full fetch is done if it changed (rows
+            inserted or deleted above it), edits elsewhere go unnoticed. Use it only for append-only sheets.
+        """
+        cache_path = cached = revision = None
+        if self.cache_dir is not None:
+            cache_path = self._cache_path(sheet_name, colnames_range, values_range)
+            cached = self._load_cache(cache_path)
+            revision = self.get_revision()
+            if cached is not None and revision is not None and cached['revision'] == revision:
+                logging.info(f"Sheet '{sheet_name}' is unchanged since the last fetch, using the cache.")
+                METRICS.inc('sheet_cache_hits')
+                return cached['header'], cached['values']
+
+        appended = None
+        if incremental and cached is not None and cached['values']:
+            appended = self._get_appended(sheet_name, colnames_range, values_range, cached['values'])
+        if appended is not None:
+            header_rows, values = appended
+        elif chunk_rows:
+            header_rows, values = self._get_chunked(sheet_name, colnames_range, values_range, chunk_rows)
+        else:
+            header_rows, values = self.batch_get(sheet_name, [colnames_range, values_range])
+        header = header_rows[0]
+
+        if cache_path is not None:
+            self._save_cache(cache_path, revision, header, values)
+        return header, values
+
+    def get_dataframe(self, sheet_name: str,
+                      colnames_range: str = "A1:AZ1",
+                      values_range: str = "A2:AZ",
+                      chunk_rows: int = None,
+                      incremental: bool = False):
+        header, values = self.get_values(sheet_name, colnames_range, values_range,
+                                         chunk_rows=chunk_rows, incremental=incremental)
+        return pd.DataFrame(values, columns=header)
 
 
 if __name__ == '__main__':
-    sheets = Sheets(SPREADSHEET_ID)
+    sheets = Sheets(get_config()['spreadsheet']['id'])
     # sheets.get_available_sheet_info()
 
-    sheet_metadata = sheets.service.spreadsheets().get(spreadsheetId=sheets.sheet_id).execute()
-    properties = sheet_metadata.get('sheets')
+    properties = sheets.get_metadata().get('sheets')
@@ -0,0 +1,213 @@
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from email.message import EmailMessage
+from typing import FrozenSet, Iterable, Iterator, Optional, Tuple, Union
+
+from prispevky.mailer import Mailer, PaymentEmail, SendReport
+
+"""
+Append-only journal of sent emails, one record per send attempt keyed by the variable symbol.
+
+Every attempt is committed before and after the send, so after a crash or lost token the next run
+knows who was already mailed. Reruns skip sent recipients and retry only failures.
+
+The Gmail thread of every sent message is kept, so that bounces arriving in it (see `prispevky.bounces`) are
+matched back to the variable symbol. Bounced addresses are recorded and treated as invalid by the next runs.
+"""
+
+SENT = 'SENT'
+FAILED = 'FAILED'
+# send was started but the result was never recorded, the message may or may not have been sent
+PENDING = 'PENDING'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sends (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    variable_symbol TEXT NOT NULL,
+    message_hash TEXT NOT NULL,
+    gmail_id TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    thread_id TEXT
+);
+CREATE TABLE IF NOT EXISTS bounces (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    variable_symbol TEXT NOT NULL,
+    address TEXT NOT NULL,
+    gmail_id TEXT NOT NULL,
+    reason TEXT,
+    created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (gmail_id, address)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def message_hash(msg: Union[EmailMessage, bytes]) -> str:
+    """
+    Identifies the exact bytes sent, the same as the sha256 of the message in the spool manifest. It is not
+    stable across renderings of the same content: the MIME boundaries and the Content-ID of the QR image are
+    random, so it tells which rendering was sent and can't be used to find out whether the content changed.
+    """
+    return hashlib.sha256(bytes(msg)).hexdigest()
+
+
+def journal_filename(testmode: bool = False) -> str:
+    # test sends must not mark the people as mailed for the real run
+    return 'journal_test.sqlite' if testmode else 'journal.sqlite'
+
+
+class SendJournal:
+    def __init__(self, path: str):
+        self.path = path
+        # the sending results and the bounce watcher come from different threads, one at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        if 'thread_id' not in {column[1] for column in self.conn.execute('PRAGMA table_info(sends)')}:
+            # journals written before the threads were kept
+            self.conn.execute('ALTER TABLE sends ADD COLUMN thread_id TEXT')
+        self.conn.commit()
+        # latest record for each variable symbol, rows are append-only so the last id wins
+        self.state = {}
+        # variable symbol of each Gmail thread started by a sent message
+        self.threads = {}
+        for vs, msg_hash, gmail_id, status, thread_id in self.conn.execute(
+                'SELECT variable_symbol, message_hash, gmail_id, status, thread_id FROM sends ORDER BY id'):
+            self.state[vs] = dict(message_hash=msg_hash, gmail_id=gmail_id, status=status)
+            if thread_id is not None:
+                self.threads[thread_id] = vs
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, variable_symbol: str, msg_hash: str, status: str, gmail_id: str = None, error: str = None,
+               thread_id: str = None):
+        with self._lock:
+            self.conn.execute('INSERT INTO sends (variable_symbol, message_hash, gmail_id, status, error, thread_id) '
+                              'VALUES (?, ?, ?, ?, ?, ?)',
+                              (variable_symbol, msg_hash, gmail_id, status, error, thread_id))
+            self.conn.commit()
+            self.state[variable_symbol] = dict(message_hash=msg_hash, gmail_id=gmail_id, status=status)
+            if thread_id is not None:
+                self.threads[thread_id] = variable_symbol
+
+    def status(self, variable_symbol: str):
+        record = self.state.get(variable_symbol)
+        return record['status'] if record else None
+
+    def should_send(self, variable_symbol: str, retry_pending: bool = False) -> bool:
+        status = self.status(variable_symbol)
+        if status == PENDING and not retry_pending:
+            logging.warning(f"Send of {variable_symbol} was interrupted, skipping it. "
+                            f"Check the sent folder and rerun with retry_pending=True if it was not sent.")
+            return False
+        return status != SENT
+
+    def summary(self):
+        counts = {}
+        for record in self.state.values():
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+        n_bounces = len(self.bounces())
+        if n_bounces:
+            counts['BOUNCED'] = n_bounces
+        return counts
+
+    def thread_variable_symbol(self, thread_id: str) -> Optional[str]:
+        with self._lock:
+            return self.threads.get(thread_id)
+
+    def record_bounce(self, variable_symbol: str, address: str, gmail_id: str, reason: str = None) -> bool:
+        """Record that the message to address bounced, False if this bounce was already recorded."""
+        with self._lock:
+            cursor = self.conn.execute('INSERT OR IGNORE INTO bounces (variable_symbol, address, gmail_id, reason) '
+                                       'VALUES (?, ?, ?, ?)',
+                                       (variable_symbol, address.lower(), gmail_id, reason))
+            self.conn.commit()
+            return cursor.rowcount > 0
+
+    def bounces(self) -> list:
+        """(variable symbol, address, reason) of the recorded bounces."""
+        with self._lock:
+            return self.conn.execute('SELECT variable_symbol, address, reason FROM bounces ORDER BY id').fetchall()
+
+    def bounced_addresses(self) -> FrozenSet[str]:
+        """Lower case addresses that bounced, to be treated as invalid."""
+        return frozenset(address for _, address, _ in self.bounces())
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+            self.conn.commit()
+
+    def pending(self, payment_emails: Iterable[PaymentEmail],
+                retry_pending: bool = False) -> Iterator[Tuple[PaymentEmail, str]]:
+        """The emails not yet sent with their message hashes, each is recorded as pending before it is yielded."""
+        for payment_email in payment_emails:
+            vs = payment_email.variable_symbol
+            if not self.should_send(vs, retry_pending):
+                logging.info(f"Skipping {vs}, already {self.status(vs)}.")
+                continue
+            msg_hash = message_hash(payment_email.raw)
+            self.record(vs, msg_hash, PENDING)
+            yield payment_email, msg_hash
+
+    def record_result(self, variable_symbol: str, msg_hash: str, result: dict):
+        """Record the result of `Mailer.send_message`."""
+        if result['send_status'] == "OK":
+            sent_msg = result['sent_msg']
+            self.record(variable_symbol, msg_hash, SENT, gmail_id=sent_msg['id'], thread_id=sent_msg.get('threadId'))
+        elif result.get('ambiguous'):
+            # e.g. a timeout, the message may have been sent: it stays pending and is resent only with
+            # retry_pending after checking the sent folder
+            self.record(variable_symbol, msg_hash, PENDING, error=str(result['send_status']))
+        else:
+            self.record(variable_symbol, msg_hash, FAILED, error=str(result['send_status']))
+
+    def send(self, mailer: Mailer, payment_emails: Iterable[PaymentEmail],
+             retry_pending: bool = False, **send_kwargs) -> SendReport:
+        """Send the emails not yet sent according to the journal, recording every attempt.
+
+        send_kwargs are passed to `Mailer.send_many`.
+        """
+        # (variable symbol, hash) of messages given to the mailer and still waiting for a result
+        attempted = {}
+
+        def messages():
+            for i, (payment_email, msg_hash) in enumerate(self.pending(payment_emails, retry_pending)):
+                attempted[i] = (payment_email.variable_symbol, msg_hash)
+                yield payment_email.raw
+
+        def on_result(i, result):
+            self.record_result(*attempted.pop(i), result)
+
+        return mailer.send_many(messages(), on_result=on_result, **send_kwargs)
+
+
+def bounced_addresses(workdir: str) -> FrozenSet[str]:
+    """Addresses that bounced in any of the runs in workdir, a bad address is bad for every sheet and mode."""
+    addresses = set()
+    for path in glob.glob(os.path.join(workdir, '*', 'journal*.sqlite')):
+        with SendJournal(path) as journal:
+            addresses |= journal.bounced_addresses()
+    return frozenset(addresses)
@@ -1,20 +1,30 @@
-from typing import Tuple
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Tuple, Iterable, Callable, Optional, Union
 
 from googleapiclient import errors
 import base64
+import email.policy
+import io
 import logging
 
-from prispevky.config import CONFIG
-from prispevky.google_authentication import GOOGLE_CREDENTIALS
-from googleapiclient.discovery import build
+from prispevky.config import cache_per_config, get_config
+from prispevky.email_template import EmailTemplate, TEMPLATE_FIELDS, STS_TEMPLATE_FIELDS
+from prispevky.google_services import get_service
+from prispevky.metrics import METRICS
 
 from prispevky.payment_info import PaymentInfo
-from prispevky.qr_code import qr_platba_string, QRCode
+from prispevky.qr_code import qr_platba_string, QR_CACHE
+from prispevky.settings import get_settings
 
+from email import message_from_bytes
 from email.message import EmailMessage
 from email.headerregistry import Address
 from email.utils import make_msgid
-import html2text as html2text
 import importlib.resources as resources
 
 """ Inspired by
@@ -23,33 +33,93 @@ and
 https://docs.python.org/3/library/email.examples.html
 """
 
-SENDER = Address(CONFIG['mailer']['sender_name'], addr_spec=CONFIG['mailer']['sender_address'])
-SUBJECT = CONFIG['mailer']['subject']
-with open(resources.files('prispevky.templates')/CONFIG['mailer']['html_template'], 'rt', encoding="utf-8") as f:
-    MESSAGE_HTML_TEMPLATE = f.read()
 
+def get_sender() -> Address:
+    return get_settings().sender
 
-class PaymentEmail:
-    email_template = MESSAGE_HTML_TEMPLATE
 
+def get_subject() -> str:
+    return get_settings().subject
+
+
+@cache_per_config
+def get_message_html_template() -> str:
+    with open(resources.files('prispevky.templates')/get_config()['mailer']['html_template'], 'rt',
+              encoding="utf-8") as f:
+        return f.read()
+
+
+@cache_per_config
+def get_email_template() -> EmailTemplate:
+    """Template compiled and validated once, fails early if it uses a field that is not provided."""
+    fields = TEMPLATE_FIELDS + (STS_TEMPLATE_FIELDS if get_settings().has_sts else ())
+    return EmailTemplate(get_message_html_template(), fields)
+
+
+def __getattr__(name):
+    # settings from the config and the template are loaded on first use, not on import
+    if name == 'SENDER':
+        return get_sender()
+    if name == 'SUBJECT':
+        return get_subject()
+    if name == 'MESSAGE_HTML_TEMPLATE':
+        return get_message_html_template()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Gmail API per-user quota is 250 units/s, messages.send costs 100 units,
+# see https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+GMAIL_SEND_QUOTA_UNITS = 100
+SENDS_PER_SECOND = GMAIL_QUOTA_UNITS_PER_SECOND / GMAIL_SEND_QUOTA_UNITS
+# Gmail recommends batches of at most 50 requests
+MAX_BATCH_SIZE = 50
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class PaymentEmail:
     def __init__(self,
                  payment_info: PaymentInfo,
                  recipient_addresses: Tuple[Address],
-                 subject: str = SUBJECT,
-                 sender_email_address: Address = SENDER,
+                 subject: str = None,
+                 sender_email_address: Address = None,
                  testmode=False):
+        subject = subject if subject is not None else get_subject()
+        sender_email_address = sender_email_address if sender_email_address is not None else get_sender()
 
         if testmode:
             ccs = sender_email_address
         else:
             ccs = Address(payment_info.troop.leader_name, addr_spec=payment_info.troop.leader_email)
 
-        self.msg = self.create_email(subject, sender_email_address, payment_info, recipient_addresses, ccs)
+        self.variable_symbol = payment_info.variable_symbol
+        with METRICS.stage('mime_build'):
+            self._msg = self.create_email(subject, sender_email_address, payment_info, recipient_addresses, ccs)
+        self._raw = None
+
+    @property
+    def msg(self) -> EmailMessage:
+        """The message, parsed back from `raw` once it was serialized."""
+        if self._msg is None:
+            self._msg = message_from_bytes(self._raw, policy=email.policy.default)
+        return self._msg
+
+    @property
+    def raw(self) -> bytes:
+        """
+        The RFC 822 bytes, serialized only once and then used for hashing, spooling and sending.
+        The message tree with its HTML and PNG is released at that point, only the bytes stay in memory.
+        """
+        if self._raw is None:
+            with METRICS.stage('serialize'):
+                self._raw = self._msg.as_bytes()
+            self._msg = None
+        return self._raw
 
     def save_copy(self, filename):
         # Make a local copy of what we are going to send.
         with open(f'{filename}.eml', 'wb') as f:
-            f.write(bytes(self.msg))
+            f.write(self.raw)
 
     @staticmethod
     def create_email(subject: str, sender: Address, pi: PaymentInfo, recepients: Tuple[Address], ccs: Address):
@@ -62,70 +132,321 @@ class PaymentEmail:
         qr_code_cid = make_msgid()
         # we needed to peel the <> off the msgid for use in the html.
 
-        usecase_specific_kwargs = {}
-        if CONFIG.has_section('sts'):
-            usecase_specific_kwargs = dict(number_of_sts_phones=pi.number_of_sts_phones)
-
-        html_message = MESSAGE_HTML_TEMPLATE.format(troop=pi.troop.name,
-                                                    payment_message=pi.payment_message,
-                                                    variable_symbol=pi.variable_symbol,
-                                                    specific_symbol=pi.specific_symbol,
-                                                    amount_czk=pi.amount_czk,
-                                                    human_account_number=pi.human_account_number,
-                                                    human_due_date=pi.human_due_date,
-                                                    qr_code_cid=qr_code_cid[1:-1],
-                                                    **usecase_specific_kwargs)
-
-        msg.set_content(html2text.html2text(html_message))
+        values = dict(troop=pi.troop.name,
+                      payment_message=pi.payment_message,
+                      variable_symbol=pi.variable_symbol,
+                      specific_symbol=pi.specific_symbol,
+                      amount_czk=pi.amount_czk,
+                      human_account_number=pi.human_account_number,
+                      human_due_date=pi.human_due_date,
+                      qr_code_cid=qr_code_cid[1:-1])
+        if get_settings().has_sts:
+            values.update(number_of_sts_phones=pi.number_of_sts_phones)
+
+        text_message, html_message = get_email_template().render(**values)
+
+        msg.set_content(text_message)
         msg.add_alternative(html_message, subtype='html')
 
-        qr_code = QRCode(qr_platba_string(pi))
-        msg.get_payload()[1].add_related(qr_code.get_image_bytes(), 'image', 'png',
+        msg.get_payload()[1].add_related(QR_CACHE.get(qr_platba_string(pi)), 'image', 'png',
                                          cid=qr_code_cid)
 
         return msg
 
 
+class RateLimiter:
+    """Thread safe token bucket.
+
+    Tokens are refilled continuously at `rate` tokens per second up to `capacity`,
+    `acquire` blocks until the requested number of tokens is available.
+    """
+
+    def __init__(self, rate: float = SENDS_PER_SECOND, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        # Take the tokens right away, possibly going into debt, and sleep until the debt is repaid.
+        # Requests bigger than the bucket (e.g. a whole batch) thus simply wait longer.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= tokens
+            wait_time = -self._tokens / self.rate
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def transport_errors() -> tuple:
+    """Connection failures and timeouts below the API, the request may or may not have reached Gmail."""
+    # httplib2 is loaded with the first service, not on import
+    import httplib2
+    return OSError, httplib2.HttpLib2Error
+
+
+def connect_errors() -> tuple:
+    """Failures to connect (refused, unknown host), nothing was sent to Gmail."""
+    import socket
+    import httplib2
+    return ConnectionRefusedError, socket.gaierror, httplib2.ServerNotFoundError
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Error answered by Gmail with a retryable status or a failure to connect. Timeouts and dropped connections
+    are not retried, Gmail may have accepted the message already and a retry would send it twice.
+    """
+    if isinstance(error, errors.HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, connect_errors())
+
+
+def is_ambiguous(error: Exception) -> bool:
+    """The connection failed after the request may have reached Gmail, the message may or may not be sent."""
+    return isinstance(error, transport_errors()) and not isinstance(error, connect_errors())
+
+
+def failed_result(error: Exception, retries: int = 0) -> dict:
+    return dict(sent_msg=None, send_status=error, retries=retries, ambiguous=is_ambiguous(error))
+
+
+def describe_error(error: Exception) -> str:
+    return f"HTTP error {error.resp.status}" if isinstance(error, errors.HttpError) else repr(error)
+
+
+def backoff_delay(attempt: int, base: float = 1, cap: float = 32) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+@dataclass
+class SendReport:
+    """Summary of one `send_many` run."""
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    # failed with an error after which the message may have been sent anyway, included in failed
+    ambiguous: int = 0
+    retries: int = 0
+    errors: Counter = field(default_factory=Counter)
+    elapsed: float = 0
+    results: list = field(default_factory=list, repr=False)
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def add(self, result: dict):
+        self.total += 1
+        self.retries += result.get('retries', 0)
+        if result['send_status'] == "OK":
+            self.sent += 1
+        else:
+            self.failed += 1
+            self.ambiguous += bool(result.get('ambiguous'))
+            error = result['send_status']
+            self.errors[error.resp.status if isinstance(error, errors.HttpError) else type(error).__name__] += 1
+
+    def summary(self):
+        return (f"Sent {self.sent}/{self.total} messages in {self.elapsed:.1f}s "
+                f"({self.throughput:.2f} msg/s), {self.retries} retries, "
+                f"failed: {self.failed} {dict(self.errors)}"
+                + (f", {self.ambiguous} of them possibly sent" if self.ambiguous else ''))
+
+
 class Mailer:
-    def __init__(self, credentials=GOOGLE_CREDENTIALS, user_id=SENDER.addr_spec):
+    def __init__(self, credentials=None, user_id=None,
+                 rate_limiter: RateLimiter = None, max_retries: int = 5):
         """
         Args:
         user_id: User's email address. The special value "me"
-        can be used to indicate the authenticated user.
-        credentials:
+        can be used to indicate the authenticated user. Defaults to the sender address from the config.
+        credentials: defaults to the credentials of the logged in user
+        rate_limiter: shared limiter for all sends, defaults to the Gmail per-user quota
+        max_retries: how many times to retry a send failing with 429 or 5xx
         """
-        self.user_id = user_id
+        self.user_id = user_id if user_id is not None else get_sender().addr_spec
+        self.credentials = credentials
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = max_retries
         try:
-            self.service = build('gmail', 'v1', credentials=credentials)
+            self.service = get_service('gmail', 'v1', credentials)
         except Exception as e:
             logging.error(e)
             raise
 
+    def _thread_service(self):
+        # httplib2 is not thread safe, each worker thread sends through its own service and connection
+        if threading.current_thread() is threading.main_thread():
+            return self.service
+        return get_service('gmail', 'v1', self.credentials)
+
     @staticmethod
-    def encode_email_to_gmail_message(email: EmailMessage):
-        b = base64.urlsafe_b64encode(email.as_bytes())
-        gmail_message = {'raw': b.decode('utf-8')}
+    def encode_email_to_gmail_message(message: Union[EmailMessage, bytes]):
+        """Accepts the message or its already serialized RFC 822 bytes."""
+        with METRICS.stage('encode'):
+            b = base64.urlsafe_b64encode(message if isinstance(message, bytes) else message.as_bytes())
+            gmail_message = {'raw': b.decode('ascii')}
+        METRICS.inc('bytes_encoded', len(b))
         return gmail_message
 
-    def send_message(self, message):
+    def _send_with_retry(self, raw: bytes) -> dict:
+        from googleapiclient.http import MediaIoBaseUpload
+
+        retries = 0
+        while True:
+            self.rate_limiter.acquire()
+            METRICS.inc('gmail_api_calls')
+            try:
+                with METRICS.stage('gmail_send'):
+                    # the RFC 822 bytes go as they are through the media upload endpoint, without base64 and json
+                    upload = MediaIoBaseUpload(io.BytesIO(raw), mimetype='message/rfc822')
+                    sent_message = (self._thread_service().users().messages().send(userId=self.user_id,
+                                                                                  media_body=upload)
+                                    .execute())
+                logging.info(f'Message Id: {sent_message["id"]} sent.')
+                result = dict(sent_msg=sent_message, send_status="OK", retries=retries)
+                break
+            except (errors.HttpError, *transport_errors()) as error:
+                if is_retryable(error) and retries < self.max_retries:
+                    delay = backoff_delay(retries)
+                    retries += 1
+                    METRICS.inc('retries')
+                    logging.warning(f'{describe_error(error)}, retry {retries} in {delay:.1f}s')
+                    time.sleep(delay)
+                    continue
+                logging.error(f'Sending failed: {error!r}')
+                result = failed_result(error, retries)
+                break
+        METRICS.inc('bytes_uploaded', len(raw))
+        return result
+
+    def send_message(self, message: Union[EmailMessage, bytes]):
         """Send an email html_message.
 
       Args:
-        user_id: User's email address. The special value "me"
-        can be used to indicate the authenticated user.
-        message: valid email html_message, with field such as recipient, body, etc.
+        message: valid email html_message, with field such as recipient, body, etc., or its RFC 822 bytes
 
       Returns:
-        Sent Message.
+        Result with the sent message ids (`sent_msg`) and the send status.
       """
-        message = self.encode_email_to_gmail_message(message)
+        return self._send_with_retry(message if isinstance(message, bytes) else message.as_bytes())
+
+    def send_many(self, emails: Iterable[Union[EmailMessage, bytes]], workers: int = 4, batch_size: int = None,
+                  on_result: Optional[Callable[[int, dict], None]] = None, keep_results: bool = True) -> SendReport:
+        """Send many emails concurrently, respecting the rate limiter.
+
+        Args:
+          emails: messages or their RFC 822 bytes, consumed lazily so it can be a generator
+          workers: number of sending threads
+          batch_size: if set, send using Gmail HTTP batch requests of this size instead of the thread pool.
+            The batch parts are JSON, so each message is base64 encoded into a JSON body
+            (`encode_email_to_gmail_message`) instead of uploading the raw bytes as they are: more memory
+            and CPU per message than without batches
+          on_result: called in the calling thread with (index, result) as soon as each message is done
+          keep_results: keep all results in the report, turn off to keep memory flat for long streams
+
+        Returns:
+          SendReport with results ordered as the input emails
+        """
+        report = SendReport()
+        results = {}
+
+        def done(i, result):
+            if keep_results:
+                results[i] = result
+            report.add(result)
+            METRICS.inc('messages_sent' if result['send_status'] == "OK" else 'send_errors')
+            if on_result is not None:
+                on_result(i, result)
+
+        start = time.monotonic()
+        if batch_size:
+            self._send_batches(emails, min(batch_size, MAX_BATCH_SIZE), done)
+        else:
+            self._send_pooled(emails, workers, done)
+        report.elapsed = time.monotonic() - start
+        report.results = [results[i] for i in sorted(results)]
+        logging.info(report.summary())
+        return report
+
+    @staticmethod
+    def _future_result(future) -> dict:
+        # an unexpected error fails its message only, the other messages in flight still get their results
         try:
-            sent_message = (self.service.users().messages().send(userId=self.user_id, body=message)
-                            .execute())
-            status = "OK"
-            logging.info(f'Message Id: {sent_message["id"]} sent.')
-        except errors.HttpError as error:
-            logging.error(f'An HTTP error occurred: {error}')
-            sent_message = None
-            status = error
-        return dict(sent_msg=sent_message, attempted_message=message, send_status=status)
+            return future.result()
+        except Exception as error:
+            logging.exception(f'Sending failed: {error!r}')
+            return failed_result(error)
+
+    def _send_pooled(self, emails, workers, done):
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mailer') as pool:
+            for i, message in enumerate(emails):
+                # backpressure: do not pull more emails than the workers can handle
+                while len(in_flight) >= 2 * workers:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done(in_flight.pop(future), self._future_result(future))
+                in_flight[pool.submit(self.send_message, message)] = i
+            for future in list(in_flight):
+                done(in_flight.pop(future), self._future_result(future))
+
+    def _send_batches(self, emails, batch_size, done):
+        batch = []
+        for i, message in enumerate(emails):
+            batch.append((i, self.encode_email_to_gmail_message(message)))
+            if len(batch) == batch_size:
+                self._send_batch(batch, done)
+                batch = []
+        if batch:
+            self._send_batch(batch, done)
+
+    def _send_batch(self, batch, done):
+        """Send one batch of (index, gmail message) pairs, retrying the retryable failures."""
+        pending = {str(i): (i, message) for i, message in batch}
+        retries = 0
+        while pending:
+            responses = {}
+
+            def callback(request_id, response, exception):
+                responses[request_id] = (response, exception)
+
+            http_batch = self.service.new_batch_http_request(callback=callback)
+            for request_id, (i, message) in pending.items():
+                http_batch.add(self.service.users().messages().send(userId=self.user_id, body=message),
+                               request_id=request_id)
+            self.rate_limiter.acquire(len(pending))
+            METRICS.inc('gmail_api_calls')
+            try:
+                with METRICS.stage('gmail_batch'):
+                    http_batch.execute()
+            except (errors.HttpError, *transport_errors()) as error:
+                # the batch request itself failed, the messages without a response are retried or fail with
+                # its error
+                logging.warning(f'Batch request failed: {describe_error(error)}')
+                for request_id in pending:
+                    responses.setdefault(request_id, (None, error))
+
+            retry = {}
+            for request_id, (i, message) in pending.items():
+                response, exception = responses[request_id]
+                if exception is None:
+                    logging.info(f'Message Id: {response["id"]} sent.')
+                    done(i, dict(sent_msg=response, send_status="OK", retries=retries))
+                elif is_retryable(exception) and retries < self.max_retries:
+                    retry[request_id] = (i, message)
+                else:
+                    logging.error(f'Sending failed: {exception!r}')
+                    done(i, failed_result(exception, retries))
+            pending = retry
+            if pending:
+                delay = backoff_delay(retries)
+                retries += 1
+                METRICS.inc('retries', len(pending))
+                logging.warning(f'{len(pending)} messages in batch failed, retry {retries} in {delay:.1f}s')
+                time.sleep(delay)
@@ -0,0 +1,141 @@
+import bisect
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+"""
+Lightweight run metrics: per-stage timers, counters and latency histograms.
+
+Disabled by default, then `stage` returns a shared no-op context manager and `inc`/`observe` return right away.
+Enable with `METRICS.enable()` and export with `to_json`/`to_prometheus` at the end of the run.
+
+    METRICS.enable(profile_stages=['qr_render'])
+    ...
+    METRICS.write('metrics.prom')
+"""
+
+# Upper bounds of the latency histogram buckets in seconds, Prometheus style
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+_DISABLED = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return dict(count=self.count, sum=self.sum,
+                    buckets={str(bound): count for bound, count in zip(self.buckets, self.counts)})
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.profile_stages = set()
+        self.profiles = {}
+        self._profiling = False
+        self._lock = threading.Lock()
+
+    def enable(self, profile_stages=()):
+        """Start collecting. Stages named in profile_stages are also profiled with cProfile."""
+        self.enabled = True
+        self.profile_stages = set(profile_stages)
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.profiles.clear()
+
+    def inc(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def stage(self, name: str):
+        """Context manager timing one execution of a stage into the `name` histogram."""
+        if not self.enabled:
+            return _DISABLED
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name: str):
+        profiler = None
+        # only one profiler can be active at a time, nested stages and worker threads are not profiled separately
+        if name in self.profile_stages and not self._profiling \
+                and threading.current_thread() is threading.main_thread():
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+            self._profiling = True
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+
+    def to_json(self) -> str:
+        with self._lock:
+            return json.dumps(dict(counters=self.counters,
+                                   stages={name: h.to_dict() for name, h in self.histograms.items()}), indent=1)
+
+    def to_prometheus(self, prefix: str = 'prispevky') -> str:
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{metric}_sum {histogram.sum}")
+                lines.append(f"{metric}_count {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """Write the metrics as Prometheus text for .prom/.txt files, as json otherwise."""
+        text = self.to_prometheus() if os.path.splitext(path)[1] in ('.prom', '.txt') else self.to_json()
+        with open(path, 'wt', encoding='utf-8') as f:
+            f.write(text)
+
+    def dump_profiles(self, directory: str):
+        """Write the collected cProfile stats, one `<stage>.prof` file per profiled stage."""
+        os.makedirs(directory, exist_ok=True)
+        for name, profiler in self.profiles.items():
+            profiler.dump_stats(os.path.join(directory, f"{name}.prof"))
+
+
+METRICS = Metrics()
@@ -1,12 +1,18 @@
 import dataclasses
+import functools
+import importlib.util
 import logging
-from dataclasses import dataclass
+import re
+import warnings
+from dataclasses import dataclass, field
+from email.errors import HeaderParseError
 from email.headerregistry import Address
-from typing import Tuple
+from typing import Collection, Tuple
 
 import pandas as pd
 
-from prispevky.config import CONFIG
+from prispevky.config import get_config
+from prispevky.metrics import METRICS
 
 
 @dataclass(order=True)
@@ -23,8 +29,8 @@ class NeededColumns:
     email3: str = 'Matka: mail'
     email4: str = 'E-mail (další)'
     email5: str = 'Ostatní: mail'
-    amount_due: str = CONFIG['sheet_columns']['amount_due']
-    amount_paid: str = CONFIG['sheet_columns']['amount_paid']
+    amount_due: str = field(default_factory=lambda: get_config()['sheet_columns']['amount_due'])
+    amount_paid: str = field(default_factory=lambda: get_config()['sheet_columns']['amount_paid'])
 
     def colnames(self):
         return dataclasses.astuple(self)
@@ -48,7 +54,7 @@ def get_lists_of_emails(row: pd.Series, email_cols) -> pd.Series:
     raw_addresses_list = ((col, emails)
                           for col, emails in
                           zip(email_cols, row[email_cols].values)
-                          if emails)  # if email not None or ''
+                          if isinstance(emails, str) and emails)  # if email not None, NA or ''
 
     address_list = []
     invalid_emails = []
@@ -60,7 +66,8 @@ def get_lists_of_emails(row: pd.Series, email_cols) -> pd.Series:
                 # don't add duplicate email addresses
                 if address.addr_spec not in [addr.addr_spec for addr in address_list]:
                     address_list.append(address)
-            except ValueError as e:
+            # HeaderParseError for fragments like '' (a trailing comma), 'a@' or 'jan@x..cz'
+            except (ValueError, HeaderParseError) as e:
                 logging.warning(f"Incorrect email address read: '{col}': '{email}'; {e}")
                 invalid_emails.append((col, email))
 
@@ -69,15 +76,125 @@ def get_lists_of_emails(row: pd.Series, email_cols) -> pd.Series:
     return new_row
 
 
+# Plain dot-atom addresses, which the `Address` parser always accepts unchanged
+SIMPLE_ADDRESS = re.compile(r"([A-Za-z0-9_%+-]+(?:\.[A-Za-z0-9_%+-]+)*)@([A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*)")
+
+
+@functools.lru_cache(maxsize=None)
+def parse_address(email: str):
+    """
+    Memoized email validation, returns (username, domain, addr_spec, error).
+    For invalid address the first three are None and error holds the reason.
+    """
+    simple = SIMPLE_ADDRESS.fullmatch(email)
+    if simple:
+        return simple.group(1), simple.group(2), email, None
+    try:
+        address = Address(addr_spec=email)
+        return address.username, address.domain, address.addr_spec, None
+    except (ValueError, HeaderParseError) as e:
+        return None, None, None, str(e)
+
+
+def extract_addresses(df: pd.DataFrame, email_cols, bounced: Collection[str] = frozenset()) -> pd.DataFrame:
+    """
+    Columnar equivalent of applying `get_lists_of_emails` to every row.
+
+    Emails from all the columns are exploded into one long table (one fragment per line, in the order of
+    the rows and of email_cols), each unique fragment is validated once and duplicates within a person
+    are dropped keeping the first occurrence. Addresses in bounced (lower case) are invalid.
+    """
+    n_rows = len(df)
+    parts = []
+    for order, col in enumerate(email_cols):
+        emails = pd.Series(df[col].to_numpy(dtype=object, na_value=None), index=range(n_rows))
+        emails = emails[emails.notna() & (emails != '')]  # if email not None or ''
+        parts.append(pd.DataFrame({'col': col, 'order': order, 'email': emails.str.split(',')}))
+    long = (pd.concat(parts)
+            .rename_axis('row')
+            .reset_index()
+            .sort_values(['row', 'order'], kind='stable')
+            .explode('email'))
+    long['email'] = long['email'].str.strip()
+
+    parsed = {email: parse_address(email) for email in long['email'].unique()}
+    if bounced:
+        parsed = {email: (None, None, None, "bounced before")
+                  if result[2] is not None and result[2].lower() in bounced else result
+                  for email, result in parsed.items()}
+    long['addr_spec'] = long['email'].map(lambda email: parsed[email][2])
+    is_valid = long['addr_spec'].notna()
+
+    invalid = long.loc[~is_valid]
+    invalid_addresses = {}
+    for row, col, email in zip(invalid['row'], invalid['col'], invalid['email']):
+        logging.warning(f"Incorrect email address read: '{col}': '{email}'; {parsed[email][3]}")
+        invalid_addresses.setdefault(row, []).append((col, email))
+
+    valid = long.loc[is_valid].drop_duplicates(['row', 'addr_spec'])
+    valid_addresses = {}
+    for row, col, email in zip(valid['row'], valid['col'], valid['email']):
+        username, domain, _, _ = parsed[email]
+        valid_addresses.setdefault(row, []).append(Address(col, username, domain))
+
+    return pd.DataFrame({'valid_addresses': [tuple(valid_addresses.get(i, ())) for i in range(n_rows)],
+                         'invalid_addresses': [tuple(invalid_addresses.get(i, ())) for i in range(n_rows)]},
+                        index=df.index)
+
+
+@functools.cache
+def string_dtype() -> pd.StringDtype:
+    """Arrow backed strings when pyarrow is installed, they take a fraction of the memory of Python strings."""
+    if importlib.util.find_spec('pyarrow') is not None:
+        return pd.StringDtype('pyarrow')
+    return pd.StringDtype()
+
+
+def amount_column(values: pd.Series) -> pd.Series:
+    """Amounts in CZK, empty cells are 0. Integers unless some amount has a fractional part."""
+    amounts = pd.to_numeric(values.replace({'': None})).fillna(0)
+    if (amounts % 1 == 0).all():
+        return amounts.astype('int64')
+    return amounts.astype('float64')
+
+
+def is_normalized(df: pd.DataFrame, cols: NeededColumns) -> bool:
+    return (isinstance(df[cols.troop].dtype, pd.CategoricalDtype)
+            and all(pd.api.types.is_numeric_dtype(df[col]) for col in cols.czk_amounts))
+
+
+def normalize_payments(df: pd.DataFrame, cols: NeededColumns) -> pd.DataFrame:
+    """
+    The needed columns of a fetched sheet as typed columns: categorical troop, int amounts (empty is 0) and
+    strings with missing values for empty cells. Done once, an already normalized frame is returned as it is,
+    so that a loaded snapshot (see `prispevky.sheet_snapshot`) is not copied again.
+    """
+    assert set(cols.colnames()).issubset(df.columns), \
+        f"Sheets don't have the needed column: {set(cols.colnames()) - set(df.columns)} (have following: \n {df.columns})"
+    if is_normalized(df, cols):
+        return df if list(df.columns) == list(cols.colnames()) else df.loc[:, cols.colnames()]
+    columns = {}
+    for col in cols.colnames():
+        if col in cols.czk_amounts:
+            columns[col] = amount_column(df[col])
+        elif col == cols.troop:
+            columns[col] = df[col].replace({'': None}).astype('category')
+        else:
+            columns[col] = df[col].astype(string_dtype()).replace('', pd.NA)
+    return pd.DataFrame(columns, index=df.index)
+
+
 class PaymentsDataFrame:
     def __init__(self, sheet_df: pd.DataFrame,
-                 needed_cols: NeededColumns):
+                 needed_cols: NeededColumns, bounced_addresses: Collection[str] = frozenset()):
+        """bounced_addresses: lower case addresses that bounced before (see `journal.bounced_addresses`)"""
         self.cols = needed_cols
         df = self.prepare_needed_columns(sheet_df, needed_cols)
 
         # Extract emails into lists of valid and invalid email addresses
-        emails = df.apply(get_lists_of_emails, args=(self.cols.emails,), axis=1)
-        df = pd.concat([df, emails], axis=1)
+        with METRICS.stage('email_extraction'):
+            emails = extract_addresses(df, self.cols.emails, bounced_addresses)
+        df = pd.concat([df, emails], axis=1, copy=False)
 
         # TODO: instead of splitting the df into different dataframes for emailable, paid, ..., I could just use one
         #  dataframes with flags, and filter depending on the flag.
@@ -86,11 +203,11 @@ class PaymentsDataFrame:
         df_with_email = df.loc[emailable]
         self.df_missing_email = df.loc[~emailable]
 
-        df_with_email = self.convert_currency_columns_to_number_and_fill_na(df_with_email, self.cols)
-
         self.df_emailable_unpaid, self.df_emailable_paid = self.split_unpaid_rows(df_with_email, self.cols)
 
         n_invalid_addresses = df.invalid_addresses.apply(len).sum()
+        METRICS.inc('rows_processed', len(df))
+        METRICS.inc('invalid_addresses', int(n_invalid_addresses))
         logging.info(f"Of {len(df)} people, missing email: {len(self.df_missing_email)},\n"
                      f"\temailable paid: {len(self.df_emailable_paid)}\n"
                      f"\temailable unpaid: {len(self.df_emailable_unpaid)}.\n "
@@ -98,18 +215,16 @@ class PaymentsDataFrame:
 
     @staticmethod
     def prepare_needed_columns(df: pd.DataFrame, cols: NeededColumns) -> pd.DataFrame:
-        assert set(cols.colnames()).issubset(df.columns), \
-            f"Sheets don't have the needed column: {set(cols.colnames()) - set(df.columns)} (have following: \n {df.columns})"
-        df = df.loc[:, cols.colnames()]
-        df.replace({'': None}, inplace=True)
-        return df
+        return normalize_payments(df, cols)
 
     @staticmethod
     def convert_currency_columns_to_number_and_fill_na(df: pd.DataFrame, cols: NeededColumns) -> pd.DataFrame:
+        """Deprecated, `prepare_needed_columns` already converts the amounts (see `amount_column`)."""
+        warnings.warn("convert_currency_columns_to_number_and_fill_na is deprecated, the amounts are converted "
+                      "by prepare_needed_columns", DeprecationWarning, stacklevel=2)
         df_fixed = df.copy()
-        payments = df.loc[:, cols.czk_amounts].fillna(0)
         for col in cols.czk_amounts:
-            df_fixed.loc[:, col] = pd.to_numeric(payments.loc[:, col])
+            df_fixed[col] = amount_column(df_fixed[col])
         return df_fixed
 
     @staticmethod
@@ -1,41 +1,75 @@
 import datetime
+import functools
 from dataclasses import dataclass
+from typing import List
+
 import pandas as pd
 from unidecode import unidecode
 
-from prispevky.config import CONFIG
 from prispevky.payment_data import NeededColumns
+# Troop is defined with the settings, it is re-exported here where it always was
+from prispevky.settings import IbanParts, Troop, get_settings
 
-IBAN_ACC_NUMBER = CONFIG['payment']['iban']
-SS_PREFIX = CONFIG['payment']['ss_prefix']
-DUE_DATE = datetime.date.today() + datetime.timedelta(days=6)
-PAYMENT_MESSAGE = CONFIG['payment']['message_template']
 
+@functools.cache
+def get_due_date():
+    # computed once, so that all emails of a run have the same due date
+    return datetime.date.today() + datetime.timedelta(days=6)
 
-@dataclass
-class Troop:
-    name: str
-    text_code: str
-    num_code: str
-    leader_name: str
-    leader_email: str
 
-    @property
-    def specific_symbol(self):
-        return f"{SS_PREFIX}{self.num_code}"
+def get_troops():
+    return get_settings().troops
 
-    @classmethod
-    def from_string(cls, coma_separated_fields: str):
-        args = [v.strip() for v in coma_separated_fields.split(',')]
-        return cls(*args)
+
+def __getattr__(name):
+    # module constants of the config are evaluated lazily, so that importing does not read the config
+    if name == 'TROOPS':
+        return get_troops()
+    if name == 'DUE_DATE':
+        return get_due_date()
+    if name == 'IBAN_ACC_NUMBER':
+        return get_settings().iban
+    if name == 'SS_PREFIX':
+        return get_settings().ss_prefix
+    if name == 'PAYMENT_MESSAGE':
+        return get_settings().message_template
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def human_account_number(iban_account_number: str) -> str:
+    """Parses IBAN format into human form, see `IbanParts`."""
+    return IbanParts.parse(iban_account_number).human
 
 
-troops = [Troop.from_string(v) for k, v in CONFIG['troops'].items()]
-TROOPS = {troop.name: troop for troop in troops}
+def payment_message(troop_code: str, name: str) -> str:
+    # Unidecode to get rid of accents, trimmed to the 60 characters allowed in the QR payment
+    return unidecode(get_settings().message_template.format(troop_code=troop_code, name=name))[:60]
 
 
-@dataclass
+def sts_rate():
+    """CZK per STS phone number, None without the [sts] section in the config."""
+    return get_settings().sts_rate
+
+
+def unidecode_column(values: pd.Series) -> List[str]:
+    # unidecode works character by character, so each distinct non-ascii character of the whole column
+    # is replaced at once
+    values = values.astype(str).tolist()
+    joined = '\n'.join(values)
+    for char in {char for char in set(joined) if not char.isascii()}:
+        joined = joined.replace(char, unidecode(char))
+    decoded = joined.split('\n')
+    if len(decoded) != len(values):
+        decoded = [unidecode(value) for value in values]
+    return decoded
+
+
+@dataclass(slots=True)
 class PaymentInfo:
+    """
+    Payment of one person. The derived fields are computed once when it is created, so the fields must not be
+    changed afterwards. It is not frozen, that would slow down `from_dataframe` on large sheets.
+    """
     _name: str
     troop: Troop
     variable_symbol: str
@@ -44,49 +78,27 @@ class PaymentInfo:
     iban_account_number: str
     _amount_due: str
     _amount_paid: str
+    name: str = None
+    specific_symbol: str = None
+    payment_message: str = None
+    human_account_number: str = None
+    _number_of_sts_phones: str = None
 
     def __post_init__(self):
         assert len(self._name) > 5
         assert len(self.variable_symbol) > 2
         assert int(self.amount_czk) > 0
-
-    @property
-    def name(self):
-        return unidecode(self._name)
-
-    @property
-    def specific_symbol(self):
-        return self.troop.specific_symbol
-
-    @property
-    def payment_message(self):
-        # Unidecode to get rid of accents
-        msg = unidecode(PAYMENT_MESSAGE.format(troop_code=self.troop.text_code, name=self.name))
-        # trim to 60 characters
-        msg = msg[:61]
-        assert len(msg) <= 60
-        return msg
-
-    @property
-    def human_account_number(self):
-        """Parses IBAN format into human form.
-
-        CZkk bbbb ssss sscc cccc cccc
-        Where:
-        b = National bank code
-        s = Account number prefix
-        c = Account number
-
-        See https://en.wikipedia.org/wiki/International_Bank_Account_Number"""
-        country = self.iban_account_number[:2]
-        checksum = self.iban_account_number[2:4]
-        bank = self.iban_account_number[4:8]
-        prefix = self.iban_account_number[8:14]
-        account_number = self.iban_account_number[14:24]
-
-        assert f"{country}{checksum}{bank}{prefix}{account_number}" == self.iban_account_number
-
-        return f"{prefix}-{account_number}/{bank}"
+        # `from_dataframe` passes all the derived fields
+        if self.name is None:
+            settings = get_settings()
+            self.name = unidecode(self._name)
+            self.specific_symbol = self.troop.specific_symbol
+            self.payment_message = payment_message(self.troop.text_code, self.name)
+            self.human_account_number = settings.human_account_number \
+                if self.iban_account_number == settings.iban else human_account_number(self.iban_account_number)
+            rate = settings.sts_rate
+            if rate is not None:
+                self._number_of_sts_phones = str(int(int(self._amount_due) / rate))
 
     @property
     def qr_code_due_date(self):
@@ -98,20 +110,48 @@ class PaymentInfo:
 
     @property
     def number_of_sts_phones(self):
-        if CONFIG.has_section('sts'):
-            return str(int(int(self._amount_due)/int(CONFIG.get('sts', 'STS_payment_per_number'))))
-        else:
+        if self._number_of_sts_phones is None:
             raise ValueError("Number of STS phones should only be checked with STS settings")
+        return self._number_of_sts_phones
 
     @classmethod
     def from_df_row(cls, row: pd.Series, needed_cols: NeededColumns):
-        troop = TROOPS[row.loc[needed_cols.troop]]
+        troop = get_troops()[row.loc[needed_cols.troop]]
         amount_czk = row.loc[needed_cols.amount_due] - row.loc[needed_cols.amount_paid]
         return cls(row.loc[needed_cols.name],
                    troop,
                    row.loc[needed_cols.reg_num],
-                   DUE_DATE,
+                   get_due_date(),
                    amount_czk,
-                   IBAN_ACC_NUMBER,
+                   get_settings().iban,
                    row.loc[needed_cols.amount_due],
                    row.loc[needed_cols.amount_paid])
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, needed_cols: NeededColumns) -> List['PaymentInfo']:
+        """Payment infos of all rows of df, with the derived fields computed column-wise."""
+        settings = get_settings()
+        troops = df[needed_cols.troop].map(settings.troops)
+        if troops.isna().any():
+            unknown = set(df.loc[troops.isna(), needed_cols.troop])
+            raise KeyError(f"Unknown troops: {sorted(unknown, key=str)}")
+        due = df[needed_cols.amount_due]
+        paid = df[needed_cols.amount_paid]
+        amounts = (due - paid).tolist()
+        names = unidecode_column(df[needed_cols.name])
+        message_template = settings.ascii_message_template
+        messages = [message_template.format(troop_code=unidecode(troop.text_code), name=name)[:60]
+                    for troop, name in zip(troops, names)]
+        rate = settings.sts_rate
+        sts_phones = [None] * len(df) if rate is None else \
+            (due.astype(int) / rate).astype(int).astype(str).tolist()
+
+        specific_symbols = {troop.name: troop.specific_symbol for troop in settings.troops.values()}
+        due_date = get_due_date()
+        iban = settings.iban
+        account_number = settings.human_account_number
+        return [cls(raw_name, troop, variable_symbol, due_date, amount, iban, amount_due, amount_paid,
+                    name, specific_symbols[troop.name], message, account_number, n_sts_phones)
+                for raw_name, troop, variable_symbol, amount, amount_due, amount_paid, name, message, n_sts_phones
+                in zip(df[needed_cols.name].tolist(), troops.tolist(), df[needed_cols.reg_num].tolist(), amounts,
+                       due.tolist(), paid.tolist(), names, messages, sts_phones)]
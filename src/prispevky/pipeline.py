@@ -0,0 +1,47 @@
+from typing import Iterable, Iterator
+
+import pandas as pd
+
+from prispevky.journal import SendJournal
+from prispevky.mailer import Mailer, PaymentEmail, SendReport
+from prispevky.payment_data import PaymentsDataFrame, NeededColumns
+from prispevky.payment_info import PaymentInfo
+
+"""
+Streaming pipeline from sheet rows to sent messages.
+
+Every stage is a generator, so only the messages currently being built or sent are in memory.
+`Mailer.send_many` pulls the next message only while fewer than two per worker are in flight (backpressure),
+so building a message in the calling thread overlaps with the network sends of the previous ones.
+"""
+
+
+def payment_emails(df: pd.DataFrame, needed_cols: NeededColumns, n_recipients: int = None,
+                   testmode: bool = False, chunk_size: int = 1000) -> Iterator[PaymentEmail]:
+    """
+    Args:
+      df: rows of `PaymentsDataFrame`, with the valid_addresses column
+      n_recipients: send to at most this many of the valid addresses, all of them if None
+      chunk_size: payment infos are built column-wise for this many rows at a time
+    """
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        for payment_info, addresses in zip(PaymentInfo.from_dataframe(chunk, needed_cols), chunk.valid_addresses):
+            recipients = addresses if n_recipients is None else addresses[:n_recipients]
+            yield PaymentEmail(payment_info, recipients, testmode=testmode)
+
+
+def send_stream(mailer: Mailer, emails: Iterable[PaymentEmail], journal: SendJournal = None,
+                **send_kwargs) -> SendReport:
+    """Send the emails as they are built without keeping the results, optionally recording them in a journal."""
+    send_kwargs.setdefault('keep_results', False)
+    if journal is not None:
+        return journal.send(mailer, emails, **send_kwargs)
+    return mailer.send_many((email.raw for email in emails), **send_kwargs)
+
+
+def send_unpaid(pdf: PaymentsDataFrame, needed_cols: NeededColumns, mailer: Mailer, journal: SendJournal = None,
+                n_recipients: int = 2, testmode: bool = False, **send_kwargs) -> SendReport:
+    """Build and send the payment emails to all emailable unpaid rows in one streaming pass."""
+    emails = payment_emails(pdf.df_emailable_unpaid, needed_cols, n_recipients=n_recipients, testmode=testmode)
+    return send_stream(mailer, emails, journal=journal, **send_kwargs)
@@ -1,7 +1,24 @@
 import base64
+import functools
+import hashlib
 import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Tuple
+
+import numpy as np
 import qrcode
+from qrcode import base
+from qrcode.exceptions import DataOverflowError
 
+from prispevky.config import cache_per_config, get_config
+from prispevky.metrics import METRICS
+from prispevky.payment_data import PaymentsDataFrame, NeededColumns
 from prispevky.payment_info import PaymentInfo
 
 PAYMENT_CODE_TEMPLATE = r"SPD*1.0*ACC:{acc_number}*AM:{amount_czk:.2f}*CC:CZK" \
@@ -44,3 +61,373 @@ class QRCode:
         base64_encoded_result_bytes = base64.b64encode(self.get_image_bytes())
         base64_encoded_result_str = base64_encoded_result_bytes.decode('ascii')
         return base64_encoded_result_str
+
+
+ERROR_CORRECTION = dict(L=qrcode.constants.ERROR_CORRECT_L, M=qrcode.constants.ERROR_CORRECT_M,
+                        Q=qrcode.constants.ERROR_CORRECT_Q, H=qrcode.constants.ERROR_CORRECT_H)
+
+# 1:1:3:1:1 finder-like pattern followed by four light modules, penalized by the mask evaluation
+FINDER_LIKE = np.array([1, 0, 1, 1, 1, 0, 1, 0, 0, 0, 0], dtype=bool)
+
+
+@dataclass(frozen=True)
+class QRSettings:
+    """
+    QR code rendering, read from the optional [qr] config section.
+
+    The payment strings have the same structure and nearly the same length, so the fast path encodes them in
+    one byte mode segment at a pinned version (falling back to larger versions for longer strings), scores
+    the masks with numpy unless one is given and writes a 1-bit PNG at a small box size. It builds the function
+    patterns with private `qrcode` methods, so it is opt-in (fast=yes) and tests/test_qr_code.py decodes its
+    output with an independent decoder. By default images are rendered by `qrcode.make`.
+    """
+    fast: bool = False
+    # up to 152 bytes in byte mode with error correction M, the payment strings have 120-150 bytes
+    version: int = 8
+    error_correction: str = 'M'
+    box_size: int = 4
+    border: int = 4
+    mask: int = None
+
+    @classmethod
+    def from_config(cls, config) -> 'QRSettings':
+        if not config.has_section('qr'):
+            return cls()
+        section = config['qr']
+        mask = section.get('mask', 'auto')
+        return cls(fast=section.getboolean('fast', cls.fast),
+                   version=section.getint('version', cls.version),
+                   error_correction=section.get('error_correction', cls.error_correction).upper(),
+                   box_size=section.getint('box_size', cls.box_size),
+                   border=section.getint('border', cls.border),
+                   mask=None if mask == 'auto' else int(mask))
+
+
+@cache_per_config
+def get_qr_settings() -> QRSettings:
+    return QRSettings.from_config(get_config())
+
+
+def mask_patterns(n: int):
+    """The eight QR mask patterns over an n x n symbol, True where the module is flipped."""
+    i, j = np.indices((n, n))
+    return [(i + j) % 2 == 0,
+            i % 2 == 0,
+            j % 3 == 0,
+            (i + j) % 3 == 0,
+            (i // 2 + j // 3) % 2 == 0,
+            (i * j) % 2 + (i * j) % 3 == 0,
+            ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+            ((i * j) % 3 + (i + j) % 2) % 2 == 0]
+
+
+def _gf_tables():
+    exp = [0] * 512
+    log = [0] * 256
+    value = 1
+    for i in range(255):
+        exp[i] = exp[i + 255] = value
+        log[value] = i
+        value <<= 1
+        if value & 0x100:
+            value ^= 0x11d
+    return exp, log
+
+
+# GF(256) of the QR Reed-Solomon codes
+GF_EXP, GF_LOG = _gf_tables()
+
+
+def gf_mul(a: int, b: int) -> int:
+    return 0 if a == 0 or b == 0 else GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+@functools.cache
+def _rs_table(degree: int) -> list:
+    """The generator polynomial of degree without its leading term, times each byte value, as big ints."""
+    generator = [1]
+    for i in range(degree):
+        # multiply by (x - a^i)
+        generator = [a ^ gf_mul(b, GF_EXP[i]) for a, b in zip(generator + [0], [0] + generator)]
+    return [int.from_bytes(bytes(gf_mul(factor, c) for c in generator[1:]), 'big') for factor in range(256)]
+
+
+def rs_ecc(data: bytes, degree: int) -> bytes:
+    """Reed-Solomon error correction codewords of data, the remainder is kept in a single int."""
+    table = _rs_table(degree)
+    shift = 8 * (degree - 1)
+    mask = (1 << 8 * degree) - 1
+    remainder = 0
+    for byte in data:
+        remainder = ((remainder << 8) & mask) ^ table[byte ^ (remainder >> shift)]
+    return remainder.to_bytes(degree, 'big')
+
+
+def encode_codewords(data: bytes, version: int, error_correction: int) -> bytes:
+    """
+    Interleaved data and error correction codewords of data in a single byte mode segment.
+
+    Raises:
+      DataOverflowError: if data does not fit the version
+    """
+    blocks = base.rs_blocks(version, error_correction)
+    capacity = sum(block.data_count for block in blocks)
+    count_bits = 8 if version < 10 else 16
+    n_bits = 4 + count_bits + 8 * len(data)
+    if n_bits > 8 * capacity:
+        raise DataOverflowError(f"{len(data)} bytes do not fit version {version}")
+    value = (((0b0100 << count_bits) | len(data)) << 8 * len(data)) | int.from_bytes(data, 'big')
+    # terminator of up to four zero bits, then zero bits up to the byte boundary and the pad codewords
+    padding = min(4, 8 * capacity - n_bits)
+    padding += -(n_bits + padding) % 8
+    stream = (value << padding).to_bytes((n_bits + padding) // 8, 'big')
+    stream += (bytes([0xec, 0x11]) * capacity)[:capacity - len(stream)]
+
+    data_blocks, ecc_blocks = [], []
+    offset = 0
+    for block in blocks:
+        data_blocks.append(stream[offset:offset + block.data_count])
+        ecc_blocks.append(rs_ecc(data_blocks[-1], block.total_count - block.data_count))
+        offset += block.data_count
+    codewords = bytearray()
+    for words in (data_blocks, ecc_blocks):
+        for i in range(max(len(block) for block in words)):
+            codewords.extend(block[i] for block in words if i < len(block))
+    return bytes(codewords)
+
+
+@functools.cache
+def _symbol_tables(version: int, error_correction: int):
+    """
+    Returns:
+      coordinates of the data modules in the placement order, the mask patterns restricted to the data
+      modules and, for each mask, the symbol with only the function patterns and format information set
+    """
+    n = version * 4 + 17
+    qr = qrcode.QRCode(version=version, error_correction=error_correction)
+    qr.modules_count = n
+    qr.modules = [[None] * n for _ in range(n)]
+    qr.setup_position_probe_pattern(0, 0)
+    qr.setup_position_probe_pattern(n - 7, 0)
+    qr.setup_position_probe_pattern(0, n - 7)
+    qr.setup_position_adjust_pattern()
+    qr.setup_timing_pattern()
+    function_patterns = []
+    for mask in range(8):
+        qr.setup_type_info(False, mask)
+        if version >= 7:
+            qr.setup_type_number(False)
+        function_patterns.append(np.array([[bool(module) for module in row] for row in qr.modules]))
+    data_region = np.array([[module is None for module in row] for row in qr.modules])
+
+    # two columns wide zigzag from the bottom right corner, skipping the vertical timing pattern
+    positions = []
+    upwards = True
+    for col in range(n - 1, 0, -2):
+        col = col - 1 if col <= 6 else col
+        for row in (range(n - 1, -1, -1) if upwards else range(n)):
+            positions.extend((row, c) for c in (col, col - 1) if data_region[row, c])
+        upwards = not upwards
+    rows, cols = np.array(positions).T
+
+    patterns = np.stack([pattern & data_region for pattern in mask_patterns(n)])
+    return (rows, cols), patterns, np.stack(function_patterns), data_region
+
+
+def mask_penalties(symbols: np.ndarray) -> np.ndarray:
+    """Penalty scores of a stack of symbols by the four rules of ISO 18004, lower is better."""
+    k, n, _ = symbols.shape
+    scores = np.zeros(k, dtype=np.int64)
+    for lines in (symbols, symbols.transpose(0, 2, 1)):
+        # runs of five or more modules of the same color, a separator value ends the runs at each line end
+        cells = np.concatenate([lines.astype(np.int8), np.full((k, n, 1), 2, dtype=np.int8)], axis=2).ravel()
+        starts = np.flatnonzero(np.diff(cells, prepend=-1))
+        runs = np.diff(np.append(starts, len(cells)))
+        long = runs >= 5
+        scores += np.bincount(starts[long] // (n * (n + 1)), weights=runs[long] - 2, minlength=k).astype(np.int64)
+        # finder-like patterns
+        width = n - len(FINDER_LIKE) + 1
+        forward = np.ones((k, n, width), dtype=bool)
+        backward = np.ones((k, n, width), dtype=bool)
+        for offset, (value, reversed_value) in enumerate(zip(FINDER_LIKE, FINDER_LIKE[::-1])):
+            window = lines[:, :, offset:offset + width]
+            forward &= window == value
+            backward &= window == reversed_value
+        scores += 40 * (forward | backward).sum(axis=(1, 2))
+    # 2x2 blocks of the same color
+    corner = symbols[:, :-1, :-1]
+    blocks = (corner == symbols[:, 1:, :-1]) & (corner == symbols[:, :-1, 1:]) & (corner == symbols[:, 1:, 1:])
+    scores += 3 * blocks.sum(axis=(1, 2))
+    # proportion of dark modules
+    scores += 10 * (np.abs(symbols.mean(axis=(1, 2)) * 100 - 50) // 5).astype(np.int64)
+    return scores
+
+
+def qr_matrix(code: str, settings: QRSettings) -> np.ndarray:
+    """Modules of the QR code of code, True for dark."""
+    error_correction = ERROR_CORRECTION[settings.error_correction]
+    data = code.encode('utf-8')
+    version = settings.version
+    while True:
+        try:
+            codewords = encode_codewords(data, version, error_correction)
+            break
+        except DataOverflowError:
+            if version == 40:
+                raise
+            version += 1
+    if version != settings.version:
+        METRICS.inc('qr_version_fallbacks')
+
+    (rows, cols), patterns, function_patterns, data_region = _symbol_tables(version, error_correction)
+    bits = np.unpackbits(np.frombuffer(codewords, dtype=np.uint8)).astype(bool)
+    unmasked = np.zeros(data_region.shape, dtype=bool)
+    # the remainder bits after the last codeword stay light
+    unmasked[rows[:len(bits)], cols[:len(bits)]] = bits
+    masks = list(range(8)) if settings.mask is None else [settings.mask]
+    symbols = np.where(data_region, unmasked ^ patterns[masks], function_patterns[masks])
+    return symbols[np.argmin(mask_penalties(symbols))] if len(masks) > 1 else symbols[0]
+
+
+def matrix_png(matrix: np.ndarray, box_size: int, border: int) -> bytes:
+    """1-bit PNG of the modules with border light modules around."""
+    # PIL is slow to import, only import it when rendering
+    from PIL import Image
+
+    pixels = np.pad(~matrix, border, constant_values=True)
+    pixels = np.repeat(np.repeat(pixels, box_size, axis=0), box_size, axis=1)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _render(code: str, settings: QRSettings) -> bytes:
+    if settings.fast:
+        return matrix_png(qr_matrix(code, settings), settings.box_size, settings.border)
+    return QRCode(code).get_image_bytes()
+
+
+def _render_timed(code: str, settings: QRSettings) -> Tuple[bytes, float]:
+    # runs in a worker process, whose METRICS are lost, so the time is returned to be recorded by the parent
+    start = time.perf_counter()
+    png = _render(code, settings)
+    return png, time.perf_counter() - start
+
+
+def render_png(code: str, settings: QRSettings = None) -> bytes:
+    settings = settings if settings is not None else get_qr_settings()
+    with METRICS.stage('qr_render'):
+        png = _render(code, settings)
+    METRICS.inc('qr_png_bytes', len(png))
+    return png
+
+
+class QRImageCache:
+    """
+    Content addressed cache of QR code PNGs keyed by the payment string.
+
+    Keeps the last `maxsize` images in memory and, if `cache_dir` is given, all of them on disk.
+    Images are rendered with settings, by default with the settings from the config.
+    """
+
+    def __init__(self, maxsize: int = 4096, cache_dir: str = None, settings: QRSettings = None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._settings = settings
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def settings(self) -> QRSettings:
+        return self._settings if self._settings is not None else get_qr_settings()
+
+    @settings.setter
+    def settings(self, settings: QRSettings):
+        """None to use the settings from the config again."""
+        self._settings = settings
+
+    def key(self, code: str) -> str:
+        # images rendered with other settings, e.g. in the disk cache of an earlier run, are not reused
+        return hashlib.sha256(f"{self.settings}\n{code}".encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def __contains__(self, code: str) -> bool:
+        key = self.key(code)
+        return key in self._images or (self.cache_dir is not None and os.path.exists(self._path(key)))
+
+    def get(self, code: str) -> bytes:
+        key = self.key(code)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                METRICS.inc('qr_cache_hits')
+                return self._images[key]
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as f:
+                png = f.read()
+            self._remember(key, png)
+            METRICS.inc('qr_cache_hits')
+            return png
+        METRICS.inc('qr_cache_misses')
+        png = render_png(code, self.settings)
+        self.put(code, png)
+        return png
+
+    def put(self, code: str, png: bytes):
+        key = self.key(code)
+        if self.cache_dir is not None:
+            # write to temporary file first so that concurrent readers never see a partial image
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, self._path(key))
+        self._remember(key, png)
+
+    def clear(self):
+        """Forget the images kept in memory, the disk cache is kept."""
+        with self._lock:
+            self._images.clear()
+
+    def _remember(self, key: str, png: bytes):
+        with self._lock:
+            self._images[key] = png
+            self._images.move_to_end(key)
+            while len(self._images) > self.maxsize:
+                self._images.popitem(last=False)
+
+    def prerender(self, codes: Iterable[str], workers: int = None):
+        """
+        Render all codes missing from the cache in a process pool, using all cores by default.
+        Without a cache_dir, maxsize is raised to hold all the codes, otherwise the first ones would be evicted.
+        """
+        codes = list(dict.fromkeys(codes))
+        if self.cache_dir is None and len(codes) > self.maxsize:
+            logging.info(f"Raising the QR image cache size from {self.maxsize} to {len(codes)} to keep all "
+                         f"prerendered codes in memory.")
+            self.maxsize = len(codes)
+        missing = [code for code in codes if code not in self]
+        if not missing:
+            return
+        workers = workers or os.cpu_count()
+        chunksize = max(1, len(missing) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            render = functools.partial(_render_timed, settings=self.settings)
+            for code, (png, seconds) in zip(missing, pool.map(render, missing, chunksize=chunksize)):
+                METRICS.observe('qr_render', seconds)
+                METRICS.inc('qr_png_bytes', len(png))
+                self.put(code, png)
+
+
+QR_CACHE = QRImageCache()
+
+
+def prerender_payments(pdf: PaymentsDataFrame, needed_cols: NeededColumns,
+                       cache: QRImageCache = QR_CACHE, workers: int = None):
+    """Render QR codes for all unpaid emailable rows before the messages are assembled."""
+    codes = [qr_platba_string(payment_info)
+             for payment_info in PaymentInfo.from_dataframe(pdf.df_emailable_unpaid, needed_cols)]
+    cache.prerender(codes, workers=workers)
@@ -0,0 +1,120 @@
+import datetime
+import itertools
+import logging
+import sqlite3
+
+import pandas as pd
+
+from prispevky.journal import PENDING, SendJournal, message_hash
+from prispevky.mailer import Mailer, SendReport
+from prispevky.payment_data import PaymentsDataFrame, NeededColumns
+from prispevky.pipeline import payment_emails
+
+"""
+Incremental reminder waves.
+
+The snapshot stores, for every person keyed by the registration number, the amounts of the last mailed
+reminder and the hash of that email. A new wave only builds and sends emails for unpaid rows whose balance
+changed since, or whose last reminder is older than the reminder interval. Given the send journal of the
+sheet, the reminders are also recorded there like the first emails, as pending before each send.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminders (
+    reg_num TEXT PRIMARY KEY,
+    amount_due REAL NOT NULL,
+    amount_paid REAL NOT NULL,
+    message_hash TEXT NOT NULL,
+    sent_at TEXT NOT NULL
+)
+"""
+
+
+def snapshot_filename(testmode: bool = False) -> str:
+    # test waves must not count as reminded for the real ones
+    return 'reminders_test.sqlite' if testmode else 'reminders.sqlite'
+
+
+class ReminderSnapshot:
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def to_dataframe(self) -> pd.DataFrame:
+        df = pd.read_sql_query('SELECT * FROM reminders', self.conn)
+        df['sent_at'] = pd.to_datetime(df['sent_at'])
+        return df.set_index('reg_num')
+
+    def record(self, reg_num: str, amount_due: float, amount_paid: float, msg_hash: str,
+               sent_at: datetime.datetime = None):
+        sent_at = sent_at if sent_at is not None else datetime.datetime.now()
+        self.conn.execute('INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?, ?)',
+                          (reg_num, float(amount_due), float(amount_paid), msg_hash, sent_at.isoformat()))
+        self.conn.commit()
+
+    def due_rows(self, df: pd.DataFrame, cols: NeededColumns, interval: datetime.timedelta,
+                 now: datetime.datetime = None) -> pd.DataFrame:
+        """
+        Rows of df (unpaid rows of `PaymentsDataFrame`) that need a reminder: never reminded,
+        balance changed since the last reminder, or last reminder older than interval.
+        """
+        now = now if now is not None else datetime.datetime.now()
+        snapshot = self.to_dataframe().reindex(df[cols.reg_num].astype(str))
+        due = df[cols.amount_due].to_numpy(dtype=float)
+        paid = df[cols.amount_paid].to_numpy(dtype=float)
+        never_sent = snapshot['sent_at'].isna().to_numpy()
+        changed = (snapshot['amount_due'].to_numpy() != due) | (snapshot['amount_paid'].to_numpy() != paid)
+        expired = (now - snapshot['sent_at'] >= interval).to_numpy()
+        selected = df.loc[never_sent | changed | expired]
+        logging.info(f"Reminders: {len(selected)} of {len(df)} unpaid rows changed or are due "
+                     f"({int(never_sent.sum())} never reminded).")
+        return selected
+
+    def send(self, mailer: Mailer, pdf: PaymentsDataFrame, cols: NeededColumns, interval: datetime.timedelta,
+             n_recipients: int = 2, testmode: bool = False, journal: SendJournal = None, retry_pending: bool = False,
+             **send_kwargs) -> SendReport:
+        """
+        Build and send reminders only for the due rows, recording every successful send.
+
+        With a journal, rows whose last send was interrupted are skipped unless retry_pending.
+        """
+        rows = self.due_rows(pdf.df_emailable_unpaid, cols, interval)
+        # (row position, variable symbol, hash) of the reminders given to the mailer and still waiting for a result
+        attempted = {}
+
+        def emails():
+            indices = itertools.count()
+            for position, payment_email in enumerate(payment_emails(rows, cols, n_recipients=n_recipients,
+                                                                    testmode=testmode)):
+                vs = payment_email.variable_symbol
+                msg_hash = message_hash(payment_email.raw)
+                if journal is not None:
+                    if journal.status(vs) == PENDING and not retry_pending:
+                        logging.warning(f"Send of {vs} was interrupted, skipping its reminder. "
+                                        f"Check the sent folder and rerun with retry_pending=True if it was not sent.")
+                        continue
+                    journal.record(vs, msg_hash, PENDING)
+                attempted[next(indices)] = (position, vs, msg_hash)
+                yield payment_email.raw
+
+        def on_result(i, result):
+            position, vs, msg_hash = attempted.pop(i)
+            if journal is not None:
+                journal.record_result(vs, msg_hash, result)
+            if result['send_status'] == "OK":
+                row = rows.iloc[position]
+                self.record(str(row[cols.reg_num]), row[cols.amount_due], row[cols.amount_paid], msg_hash)
+
+        send_kwargs.setdefault('keep_results', False)
+        return mailer.send_many(emails(), on_result=on_result, **send_kwargs)
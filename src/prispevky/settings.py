@@ -0,0 +1,183 @@
+import re
+import types
+from dataclasses import dataclass
+from email.headerregistry import Address
+from typing import Mapping, Optional
+
+import pandas as pd
+from unidecode import unidecode
+
+from prispevky.config import cache_per_config, get_config
+from prispevky.payment_data import NeededColumns
+
+"""
+Settings compiled once from the config: the troop index, the parsed IBAN, the STS rate, the sender and the
+subject, validated when they are built so that a bad config fails before the run instead of in its middle.
+
+`preflight` validates the troop and the amounts of all sheet rows at once, before anything is rendered or sent.
+"""
+
+# CZkk bbbb ssss sscc cccc cccc, see `IbanParts`
+CZECH_IBAN = re.compile(r'([A-Z]{2})(\d{2})(\d{4})(\d{6})(\d{10})')
+
+
+@dataclass(frozen=True)
+class Troop:
+    name: str
+    text_code: str
+    num_code: str
+    leader_name: str
+    leader_email: str
+    ss_prefix: str = ''
+
+    @property
+    def specific_symbol(self):
+        return f"{self.ss_prefix}{self.num_code}"
+
+    @classmethod
+    def from_string(cls, coma_separated_fields: str, ss_prefix: str = None):
+        args = [v.strip() for v in coma_separated_fields.split(',')]
+        if len(args) != 5:
+            raise ValueError(f"Troop needs 5 fields (name, code, num_code, leaders name, leaders email), "
+                             f"got {coma_separated_fields!r}")
+        return cls(*args, ss_prefix=ss_prefix if ss_prefix is not None else get_config()['payment']['ss_prefix'])
+
+
+@dataclass(frozen=True)
+class IbanParts:
+    """
+    CZkk bbbb ssss sscc cccc cccc
+    Where:
+    b = National bank code
+    s = Account number prefix
+    c = Account number
+
+    See https://en.wikipedia.org/wiki/International_Bank_Account_Number
+    """
+    country: str
+    checksum: str
+    bank: str
+    prefix: str
+    account_number: str
+
+    @classmethod
+    def parse(cls, iban: str) -> 'IbanParts':
+        match = CZECH_IBAN.fullmatch(iban)
+        if match is None:
+            raise ValueError(f"Invalid IBAN {iban!r}, expected CZkk bbbb ssss sscc cccc cccc without spaces")
+        return cls(*match.groups())
+
+    @property
+    def human(self) -> str:
+        return f"{self.prefix}-{self.account_number}/{self.bank}"
+
+
+@dataclass(frozen=True)
+class Settings:
+    troops: Mapping[str, Troop]
+    iban: str
+    iban_parts: IbanParts
+    ss_prefix: str
+    message_template: str
+    # the template with the accents removed, unidecode is character-wise so it can be formatted with
+    # unidecoded values
+    ascii_message_template: str
+    # CZK per STS phone number, None without the [sts] section
+    sts_rate: Optional[int]
+    sender: Address
+    subject: str
+
+    @property
+    def has_sts(self) -> bool:
+        return self.sts_rate is not None
+
+    @property
+    def human_account_number(self) -> str:
+        return self.iban_parts.human
+
+    @classmethod
+    def from_config(cls, config) -> 'Settings':
+        def option(section, name):
+            if not config.has_option(section, name):
+                raise ValueError(f"Missing {name} in the [{section}] section of the config")
+            return config.get(section, name)
+
+        ss_prefix = option('payment', 'ss_prefix')
+        if not ss_prefix.isdigit():
+            raise ValueError(f"ss_prefix must be digits, got {ss_prefix!r}")
+        if not config.has_section('troops') or not config['troops']:
+            raise ValueError("No troops in the [troops] section of the config")
+        troops = [Troop.from_string(value, ss_prefix) for value in config['troops'].values()]
+        iban = option('payment', 'iban')
+        message_template = option('payment', 'message_template')
+        sts_rate = None
+        if config.has_section('sts'):
+            sts_rate = int(option('sts', 'STS_payment_per_number'))
+            if sts_rate <= 0:
+                raise ValueError(f"STS_payment_per_number must be positive, got {sts_rate}")
+        return cls(troops=types.MappingProxyType({troop.name: troop for troop in troops}),
+                   iban=iban,
+                   iban_parts=IbanParts.parse(iban),
+                   ss_prefix=ss_prefix,
+                   message_template=message_template,
+                   ascii_message_template=unidecode(message_template),
+                   sts_rate=sts_rate,
+                   sender=Address(option('mailer', 'sender_name'), addr_spec=option('mailer', 'sender_address')),
+                   subject=option('mailer', 'subject'))
+
+
+@cache_per_config
+def get_settings() -> Settings:
+    return Settings.from_config(get_config())
+
+
+class PreflightError(ValueError):
+    def __init__(self, problems: pd.DataFrame):
+        self.problems = problems
+        super().__init__(f"{len(problems)} problems in the sheet:\n{format_problems(problems)}")
+
+
+def preflight(df: pd.DataFrame, cols: NeededColumns, settings: Settings = None) -> pd.DataFrame:
+    """
+    Problems of all rows of the sheet (fetched or normalized) at once: unknown troops and missing, non-numeric
+    or negative amounts. One row per problem with the row label, the column, the value and the problem.
+    """
+    settings = settings if settings is not None else get_settings()
+    problems = []
+
+    def add(mask, column, problem):
+        if mask.any():
+            problems.append(pd.DataFrame({'row': df.index[mask], 'column': column,
+                                          'value': df.loc[mask, column].astype(object).to_numpy(),
+                                          'problem': problem}))
+
+    troops = df[cols.troop]
+    add((~troops.isin(list(settings.troops))).to_numpy(), cols.troop, "unknown troop")
+    for col in cols.czk_amounts:
+        values = df[col]
+        if pd.api.types.is_numeric_dtype(values):
+            amounts, empty = values, values.isna()
+        else:
+            empty = values.isna() | (values.astype(object) == '')
+            amounts = pd.to_numeric(values.where(~empty), errors='coerce')
+        # an empty amount counts as 0
+        add((~empty & amounts.isna()).to_numpy(), col, "not a number")
+        add((amounts < 0).to_numpy(), col, "negative amount")
+    if not problems:
+        return pd.DataFrame(columns=['row', 'column', 'value', 'problem'])
+    return pd.concat(problems, ignore_index=True).sort_values(['row', 'column'], kind='stable', ignore_index=True)
+
+
+def format_problems(problems: pd.DataFrame, limit: int = 20) -> str:
+    lines = [f"  row {row}: {column} {value!r}: {problem}"
+             for row, column, value, problem in problems.head(limit).itertuples(index=False)]
+    if len(problems) > limit:
+        lines.append(f"  ... and {len(problems) - limit} more")
+    return '\n'.join(lines)
+
+
+def check_sheet(df: pd.DataFrame, cols: NeededColumns, settings: Settings = None):
+    """Raise `PreflightError` listing all problems of the sheet, before anything is rendered or sent."""
+    problems = preflight(df, cols, settings)
+    if len(problems):
+        raise PreflightError(problems)
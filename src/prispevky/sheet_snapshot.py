@@ -0,0 +1,46 @@
+import importlib.util
+import logging
+
+import pandas as pd
+
+from prispevky.metrics import METRICS
+from prispevky.payment_data import NeededColumns, normalize_payments
+
+"""
+Parquet snapshots of fetched sheets, with the needed columns already typed (see `payment_data.normalize_payments`).
+
+Reloading a snapshot restores the categorical, integer and Arrow string columns without parsing, and
+`PaymentsDataFrame` works on them without another conversion. Needs the optional pyarrow package, without it
+the CLI keeps the csv.
+"""
+
+
+def parquet_available() -> bool:
+    # pyarrow is slow to import, it is only looked up here
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def _require_pyarrow():
+    if not parquet_available():
+        raise ImportError("Parquet snapshots need pyarrow, install it with `uv sync --extra parquet`")
+
+
+def write_snapshot(df: pd.DataFrame, path: str, cols: NeededColumns = None) -> pd.DataFrame:
+    """Normalize the fetched sheet and save it, returns the normalized frame."""
+    _require_pyarrow()
+    df = normalize_payments(df, cols if cols is not None else NeededColumns())
+    with METRICS.stage('snapshot_write'):
+        df.to_parquet(path, engine='pyarrow', index=False)
+    logging.info(f"Saved a snapshot of {len(df)} rows to {path}")
+    return df
+
+
+def read_snapshot(path: str) -> pd.DataFrame:
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # the pandas metadata only says "string", without the mapper the strings would become Python objects
+    arrow_strings = {pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+    with METRICS.stage('snapshot_read'):
+        return pq.read_table(path, memory_map=True).to_pandas(types_mapper=arrow_strings.get)
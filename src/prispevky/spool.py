@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List
+
+import pandas as pd
+
+from prispevky.config import get_config_paths, set_config_paths
+from prispevky.journal import SendJournal
+from prispevky.mailer import Mailer, PaymentEmail, SendReport
+from prispevky.payment_data import PaymentsDataFrame, NeededColumns
+from prispevky.payment_info import PaymentInfo
+
+"""
+Offline rendering of payment emails into a spool directory, and sending from it.
+
+`render_spool` builds the messages in a process pool and writes one `<variable symbol>.eml` per person plus
+a `manifest.json` with content hashes. The spool can be reviewed before `send_spool` streams the exact same
+bytes to Gmail, so resending is cheap and sends what was reviewed.
+"""
+
+MANIFEST = 'manifest.json'
+
+
+@dataclass
+class SpooledEmail:
+    """Serialized message from the spool, duck types `PaymentEmail` for `SendJournal.send`."""
+    variable_symbol: str
+    raw: bytes
+
+
+def _render_one(payment_info: PaymentInfo, addresses, spool_dir: str, n_recipients: int, testmode: bool) -> dict:
+    recipients = addresses if n_recipients is None else addresses[:n_recipients]
+    raw = PaymentEmail(payment_info, recipients, testmode=testmode).raw
+
+    filename = f"{payment_info.variable_symbol}.eml"
+    tmp_path = os.path.join(spool_dir, f"{filename}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(raw)
+    os.replace(tmp_path, os.path.join(spool_dir, filename))
+    return dict(variable_symbol=payment_info.variable_symbol, file=filename,
+                sha256=hashlib.sha256(raw).hexdigest(), size=len(raw),
+                to=[str(address) for address in recipients], amount_czk=str(payment_info.amount_czk))
+
+
+def _render_chunk(rows: pd.DataFrame, needed_cols, spool_dir, n_recipients, testmode) -> List[dict]:
+    return [_render_one(payment_info, addresses, spool_dir, n_recipients, testmode)
+            for payment_info, addresses in zip(PaymentInfo.from_dataframe(rows, needed_cols), rows.valid_addresses)]
+
+
+def render_spool(pdf: PaymentsDataFrame, needed_cols: NeededColumns, spool_dir: str, workers: int = None,
+                 n_recipients: int = 2, testmode: bool = False, chunk_size: int = 50) -> List[dict]:
+    """
+    Render emails to all emailable unpaid rows into spool_dir using all cores.
+
+    Returns:
+      manifest entries, also written to `spool_dir/manifest.json`
+    """
+    rows = pdf.df_emailable_unpaid
+    # the messages are stored and sent by variable symbol, one would overwrite the other
+    variable_symbols = rows[needed_cols.reg_num]
+    duplicated = variable_symbols[variable_symbols.duplicated()]
+    if len(duplicated):
+        raise ValueError(f"Duplicate variable symbols, fix them in the sheet before rendering: "
+                         f"{sorted(set(duplicated.astype(str)))}")
+    os.makedirs(spool_dir, exist_ok=True)
+    chunks = [rows.iloc[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    manifest = []
+    # workers read the same config as this process, also when started with spawn
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_config_paths,
+                             initargs=(get_config_paths(),)) as pool:
+        futures = [pool.submit(_render_chunk, chunk, needed_cols, spool_dir, n_recipients, testmode)
+                   for chunk in chunks]
+        for future in futures:
+            manifest.extend(future.result())
+
+    with open(os.path.join(spool_dir, MANIFEST), 'wt', encoding='utf-8') as f:
+        json.dump(dict(testmode=testmode, emails=manifest), f, indent=1, ensure_ascii=False)
+    logging.info(f"Rendered {len(manifest)} emails to {spool_dir}.")
+    return manifest
+
+
+def read_manifest(spool_dir: str) -> dict:
+    with open(os.path.join(spool_dir, MANIFEST), 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _read_checked(spool_dir: str, entry: dict) -> bytes:
+    with open(os.path.join(spool_dir, entry['file']), 'rb') as f:
+        raw = f.read()
+    if hashlib.sha256(raw).hexdigest() != entry['sha256']:
+        raise ValueError(f"{entry['file']} was modified after rendering, render the spool again.")
+    return raw
+
+
+def verify_spool(spool_dir: str) -> dict:
+    """Check all spooled messages against their hashes, returns the manifest."""
+    manifest = read_manifest(spool_dir)
+    for entry in manifest['emails']:
+        _read_checked(spool_dir, entry)
+    return manifest
+
+
+def iter_spool(spool_dir: str) -> Iterator[SpooledEmail]:
+    """
+    Spooled messages in manifest order. All of them are checked against their hashes before the first one is
+    yielded, so a modified spool sends nothing, and each one again as it is read.
+    """
+    for entry in verify_spool(spool_dir)['emails']:
+        yield SpooledEmail(entry['variable_symbol'], _read_checked(spool_dir, entry))
+
+
+def send_spool(mailer: Mailer, spool_dir: str, journal: SendJournal = None, **send_kwargs) -> SendReport:
+    """Stream the spooled bytes to Gmail, skipping already sent ones if a journal is given."""
+    send_kwargs.setdefault('keep_results', False)
+    if journal is not None:
+        return journal.send(mailer, iter_spool(spool_dir), **send_kwargs)
+    return mailer.send_many((email.raw for email in iter_spool(spool_dir)), **send_kwargs)
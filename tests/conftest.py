@@ -0,0 +1,36 @@
+import contextlib
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+
+from prispevky import mailer as mailer_module
+from prispevky.config import API_ENDPOINT_ENV
+from prispevky.fake_google import FakeGoogleServer
+from prispevky.mailer import Mailer, RateLimiter
+
+
+@pytest.fixture
+def fake_google(monkeypatch):
+    """Starts `FakeGoogleServer(**options)` and points the Google clients to it."""
+    with contextlib.ExitStack() as stack:
+        def start(**options) -> FakeGoogleServer:
+            google = stack.enter_context(FakeGoogleServer(**options))
+            monkeypatch.setenv(API_ENDPOINT_ENV, google.url)
+            return google
+
+        yield start
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(mailer_module, 'backoff_delay', lambda attempt, **kwargs: 0.0)
+
+
+@pytest.fixture
+def make_mailer():
+    def make(max_retries: int = 5, rate: float = 1e6) -> Mailer:
+        # new credentials, so that the mailer gets its own connections to the current endpoint
+        return Mailer(credentials=AnonymousCredentials(), user_id='me', rate_limiter=RateLimiter(rate=rate),
+                      max_retries=max_retries)
+
+    return make
@@ -0,0 +1,40 @@
+import asyncio
+import uuid
+from email.message import EmailMessage
+
+from prispevky.bounces import BounceWatcher, failed_recipients, send_and_watch
+from prispevky.fake_google import BOUNCE_TEMPLATE
+from prispevky.journal import SendJournal
+from prispevky.spool import SpooledEmail
+
+REASON = '5.1.1 550 5.1.1 The email account that you tried to reach does not exist.'
+
+
+def spooled(vs: str, to: str) -> SpooledEmail:
+    msg = EmailMessage()
+    msg['From'], msg['To'], msg['Subject'] = 'sender@example.com', to, f'Payment {vs}'
+    msg.set_content('Pay please')
+    return SpooledEmail(vs, msg.as_bytes())
+
+
+def test_reason_is_from_the_delivery_status():
+    raw = BOUNCE_TEMPLATE.format(sender='sender@example.com', address='nobody@example.com',
+                                 boundary=uuid.uuid4().hex).encode()
+    assert failed_recipients(raw) == [('nobody@example.com', REASON)]
+
+
+def test_send_and_watch_in_a_running_event_loop(fake_google, make_mailer, tmp_path):
+    # e.g. in Jupyter, where asyncio.run would fail
+    fake_google(bounce_addresses=['nobody@example.com'], bounce_delay=0.1)
+    with SendJournal(tmp_path/'journal.sqlite') as journal:
+        watcher = BounceWatcher(journal, interval=0.1)
+        emails = [spooled('1001', 'parent@example.com'), spooled('1002', 'nobody@example.com')]
+        mailer = make_mailer()
+
+        async def notebook_cell():
+            return send_and_watch(lambda: journal.send(mailer, emails), watcher, linger=1.0)
+
+        report = asyncio.run(notebook_cell())
+        assert report.sent == 2
+        assert watcher.bounces == [('1002', 'nobody@example.com', REASON)]
+        assert journal.bounces() == [('1002', 'nobody@example.com', REASON)]
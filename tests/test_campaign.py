@@ -0,0 +1,92 @@
+import io
+from email import message_from_bytes, policy
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from PIL import Image
+
+from prispevky.campaign import Campaign, Job, in_config, round_robin
+from prispevky.config import CONFIG_FILEPATH, get_config
+from prispevky.journal import SENT, SendJournal
+from synthetic import skautis_export
+
+CFG_DIR = CONFIG_FILEPATH.parent
+# the STS config with the sender and the account of another unit on top
+OTHER_UNIT = """
+[mailer]
+sender_address=oddil@example.com
+[payment]
+iban=CZ6020100000002400529789
+"""
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    (tmp_path/'other_unit.cfg').write_text(OTHER_UNIT, encoding='utf-8')
+    return [Job('prispevky', (str(CFG_DIR/'config_prispevky.cfg'),), spreadsheet_id='prispevky', sheet='List'),
+            Job('sts', (str(CFG_DIR/'config_sts.cfg'), str(tmp_path/'other_unit.cfg')), spreadsheet_id='sts',
+                sheet='List'),
+            Job('missing', (str(CFG_DIR/'config_prispevky.cfg'),), spreadsheet_id='missing', sheet='List')]
+
+
+def test_round_robin_takes_turns():
+    assert ''.join(round_robin(['aaaa', 'b', '', 'ccc'])) == 'abcacaca'
+
+
+def test_in_config_keeps_the_config_of_each_job(jobs):
+    def subjects():
+        while True:
+            yield get_config()['mailer']['subject']
+
+    default_subject = get_config()['mailer']['subject']
+    interleaved = round_robin([in_config(jobs[1], subjects()), in_config(jobs[0], subjects())])
+    assert [next(interleaved) for _ in range(4)] == ['4.PVS - výzva k platbě STS na rok 2023',
+                                                     '4.PVS - členské příspěvky podzim 2025'] * 2
+    assert get_config()['mailer']['subject'] == default_subject
+
+
+def qr_account(msg) -> str:
+    zxingcpp = pytest.importorskip('zxingcpp')
+    image = next(part for part in msg.walk() if part.get_content_type() == 'image/png')
+    code = zxingcpp.read_barcodes(Image.open(io.BytesIO(image.get_content())))[0].text
+    return next(field[len('ACC:'):] for field in code.split('*') if field.startswith('ACC:'))
+
+
+def test_jobs_are_sent_in_turns_with_their_config(jobs, fake_google, make_mailer, tmp_path):
+    google = fake_google(keep_messages=True)
+    google.add_dataframe('prispevky', 'List', skautis_export(12, seed=1))
+    sts = skautis_export(10, seed=2).rename(columns={'Poplatek': 'STS', 'Zaplaceno': 'Zaplaceno STS'})
+    # not a troop in the STS config
+    sts = sts[sts['Jednotka'] != 'Myšky']
+    google.add_dataframe('sts', 'List', sts)
+
+    campaign = Campaign(jobs, workdir=str(tmp_path), credentials=AnonymousCredentials())
+    runs = campaign.fetch()
+    # the failed fetch is kept with its error and does not block the other jobs
+    assert runs['missing'].error is not None
+    assert runs['prispevky'].error is None and runs['sts'].error is None
+
+    report = campaign.send(mailer=make_mailer(), testmode=True, workers=1)
+    n_prispevky = len(runs['prispevky'].pdf.df_emailable_unpaid)
+    n_sts = len(runs['sts'].pdf.df_emailable_unpaid)
+    assert min(n_prispevky, n_sts) > 1
+    assert (report.sent, report.failed) == (n_prispevky + n_sts, 0)
+
+    expected = {'prispevky': ('4pvs@skaut.cz', '4.PVS - členské příspěvky podzim 2025', 'CZ2220100000002101999393'),
+                'sts': ('oddil@example.com', '4.PVS - výzva k platbě STS na rok 2023', 'CZ6020100000002400529789')}
+    by_subject = {subject: job for job, (_, subject, _) in expected.items()}
+    sent_jobs = []
+    for raw in google.messages:
+        msg = message_from_bytes(raw, policy=policy.default)
+        job = by_subject[msg['Subject']]
+        sender, _, account = expected[job]
+        assert msg['From'].addresses[0].addr_spec == sender
+        assert qr_account(msg) == account
+        sent_jobs.append(job)
+    # one worker sends in the order the messages are taken, the jobs alternate until the smaller one runs out
+    n_turns = 2 * min(n_prispevky, n_sts)
+    assert sent_jobs[:n_turns] == [job for _ in range(n_turns // 2) for job in ('prispevky', 'sts')]
+
+    for job in jobs[:2]:
+        with SendJournal(campaign.journal_path(job, testmode=True)) as journal:
+            assert set(journal.summary()) == {SENT}
@@ -0,0 +1,24 @@
+from importlib import resources
+
+import pytest
+
+from prispevky import config, mailer, settings
+
+CFG = resources.files('prispevky.cfg')
+
+
+@pytest.fixture
+def restore_config_paths():
+    paths = config.get_config_paths()
+    yield
+    config.set_config_paths(paths)
+
+
+def test_set_config_paths_clears_the_derived_caches(restore_config_paths):
+    config.set_config_paths([CFG/'config_prispevky.cfg'])
+    assert mailer.get_subject() == '4.PVS - členské příspěvky podzim 2025'
+    template = mailer.get_email_template()
+    config.set_config_paths([CFG/'config_sts.cfg'])
+    assert mailer.get_subject() == '4.PVS - výzva k platbě STS na rok 2023'
+    assert settings.get_settings().has_sts
+    assert mailer.get_email_template() is not template
@@ -0,0 +1,63 @@
+import re
+
+import html2text
+import pytest
+
+from prispevky.config import CONFIG_FILEPATH, use_config
+from prispevky.email_template import EmailTemplate
+from prispevky.mailer import get_email_template, get_message_html_template
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.payment_info import PaymentInfo
+from synthetic import skautis_export
+
+
+def template_values(pi: PaymentInfo, has_sts: bool) -> dict:
+    # as in `PaymentEmail.create_email`
+    values = dict(troop=pi.troop.name, payment_message=pi.payment_message, variable_symbol=pi.variable_symbol,
+                  specific_symbol=pi.specific_symbol, amount_czk=pi.amount_czk,
+                  human_account_number=pi.human_account_number, human_due_date=pi.human_due_date,
+                  qr_code_cid='1760000000.1.abc@example.com')
+    if has_sts:
+        values.update(number_of_sts_phones=pi.number_of_sts_phones)
+    return values
+
+
+def unwrapped_html2text(html: str) -> str:
+    converter = html2text.HTML2Text()
+    converter.body_width = 0
+    return converter.handle(html)
+
+
+def unescape(text: str) -> str:
+    # html2text escapes markdown in the values too, e.g. '4. přístav' as '4\. přístav', the compiled template
+    # splices them as they are
+    return re.sub(r'\\([-\\`*_{}\[\]()#+.!])', r'\1', text)
+
+
+@pytest.mark.parametrize('config_name', ['config_prispevky.cfg', 'config_sts.cfg'])
+def test_renders_as_format_and_html2text(config_name):
+    with use_config([CONFIG_FILEPATH.parent/config_name]):
+        cols = NeededColumns()
+        df = skautis_export(40, cols=cols).rename(columns={'Poplatek': cols.amount_due,
+                                                           'Zaplaceno': cols.amount_paid})
+        df = df[df[cols.troop] != 'Myšky']
+        payment_infos = PaymentInfo.from_dataframe(PaymentsDataFrame(df, cols).df_emailable_unpaid, cols)
+        html = get_message_html_template()
+        template = get_email_template()
+        for pi in payment_infos:
+            values = template_values(pi, config_name == 'config_sts.cfg')
+            text, rendered_html = template.render(**values)
+            assert rendered_html == html.format(**values)
+            assert unescape(text) == unescape(unwrapped_html2text(html.format(**values)))
+            # the old path wrapped the text at 78 columns, otherwise it is the same
+            assert unescape(text).split() == unescape(html2text.html2text(html.format(**values))).split()
+
+
+def test_braces_in_the_text_stay_literal():
+    template = EmailTemplate('<p>{{VS}}: <b>{variable_symbol}</b></p>', ['variable_symbol'])
+    assert template.render(variable_symbol='411000') == ('{VS}: **411000**\n', '<p>{VS}: <b>411000</b></p>')
+
+
+def test_unknown_placeholder():
+    with pytest.raises(ValueError, match='amount'):
+        EmailTemplate('<p>{amount}</p>', ['amount_czk'])
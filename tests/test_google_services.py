@@ -0,0 +1,64 @@
+import threading
+import time
+
+import httplib2
+
+from prispevky.google_services import refresh_shared, thread_http
+
+
+class RevokedCredentials:
+    """Look valid until the server answers 401, like an access token revoked before its expiry."""
+
+    def __init__(self):
+        self.token, self.valid, self.refreshes = 'old', True, 0
+
+    def refresh(self, request):
+        time.sleep(0.05)
+        self.refreshes += 1
+        self.token, self.valid = f'new{self.refreshes}', True
+
+    def before_request(self, request, method, url, headers):
+        if not self.valid:
+            self.refresh(request)
+        headers['authorization'] = f'Bearer {self.token}'
+
+
+class Server:
+    """httplib2.Http answering 401 to the old token."""
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        status = 401 if headers['authorization'] == 'Bearer old' else 200
+        return httplib2.Response({'status': status}), b''
+
+
+def in_threads(target, n: int = 8):
+    results = [None] * n
+
+    def run(i):
+        results[i] = target()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_refreshes_refresh_once():
+    credentials = RevokedCredentials()
+    in_threads(lambda: refresh_shared(credentials, None, 'old'))
+    assert (credentials.refreshes, credentials.token) == (1, 'new1')
+
+
+def test_transports_of_all_threads_refresh_once_after_401(monkeypatch):
+    credentials = RevokedCredentials()
+    monkeypatch.setattr(httplib2, 'Http', lambda timeout: Server())
+
+    def get():
+        return thread_http(credentials).request('https://example.com/')[0].status
+
+    assert in_threads(get) == [200] * 8
+    assert credentials.refreshes == 1
+    # the credentials themselves are not modified
+    assert 'refresh' not in vars(credentials)
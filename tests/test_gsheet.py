@@ -0,0 +1,120 @@
+import json
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from prispevky import google_authentication
+from prispevky.google_authentication import DRIVE_METADATA_SCOPE, SCOPES
+from prispevky.gsheet import Sheets
+
+HEADER = ['Jméno', 'Zaplaceno']
+
+
+def rows(n: int, paid: str = '0'):
+    return [[f'Člen {i}', paid] for i in range(n)]
+
+
+def test_cache_is_used_while_unchanged(fake_google, tmp_path):
+    google = fake_google()
+    google.add_sheet('sheet', 'List', [HEADER] + rows(3))
+    header, values = Sheets('sheet', cache_dir=tmp_path).get_values('List')
+    assert (header, values) == (HEADER, rows(3))
+    fetched = google.stats['requests']
+    assert Sheets('sheet', cache_dir=tmp_path).get_values('List') == (HEADER, rows(3))
+    # only the Drive version was read
+    assert google.stats['requests'] == fetched + 1
+
+
+def test_incremental_appends_new_rows(fake_google, tmp_path):
+    google = fake_google()
+    google.add_sheet('sheet', 'List', [HEADER] + rows(3))
+    Sheets('sheet', cache_dir=tmp_path).get_values('List')
+    google.add_sheet('sheet', 'List', [HEADER] + rows(5))
+    assert Sheets('sheet', cache_dir=tmp_path).get_values('List', incremental=True) == (HEADER, rows(5))
+
+
+def test_incremental_refetches_when_the_last_row_changed(fake_google, tmp_path):
+    google = fake_google()
+    google.add_sheet('sheet', 'List', [HEADER] + rows(3))
+    Sheets('sheet', cache_dir=tmp_path).get_values('List')
+    google.add_sheet('sheet', 'List', [HEADER] + rows(5, paid='1200'))
+    assert Sheets('sheet', cache_dir=tmp_path).get_values('List', incremental=True) == (HEADER, rows(5, paid='1200'))
+
+
+def test_token_without_drive_scope_fetches_uncached(fake_google, tmp_path, caplog):
+    google = fake_google()
+    google.add_sheet('sheet', 'List', [HEADER] + rows(3))
+    credentials = Credentials(token='token', scopes=SCOPES)
+    for _ in range(2):
+        assert Sheets('sheet', credentials=credentials, cache_dir=tmp_path).get_values('List') == (HEADER, rows(3))
+    assert google.stats['requests'] == 2
+    assert DRIVE_METADATA_SCOPE in caplog.text
+
+
+class FakeFlow:
+    def __init__(self, scopes):
+        self.scopes = scopes
+
+    def run_local_server(self, port):
+        return Credentials(token='new', refresh_token='refresh', scopes=self.scopes)
+
+
+@pytest.fixture
+def token_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(google_authentication, 'credentials_folder', lambda: tmp_path)
+    flows = []
+
+    def from_client_secrets_file(credentials_file, scopes):
+        flows.append(scopes)
+        return FakeFlow(scopes)
+
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    monkeypatch.setattr(InstalledAppFlow, 'from_client_secrets_file', from_client_secrets_file)
+    return tmp_path, flows
+
+
+def write_token(folder, scopes):
+    (folder / 'token.json').write_text(json.dumps(dict(token='old', refresh_token='refresh', client_id='id',
+                                                       client_secret='secret', scopes=scopes,
+                                                       expiry='2020-01-01T00:00:00Z')))
+
+
+def load(folder):
+    return google_authentication.load_or_generate_credentials(
+        SCOPES, credentials_file=folder / 'client.json', optional_scopes=[DRIVE_METADATA_SCOPE])
+
+
+def test_old_token_is_refreshed_with_its_own_scopes(token_folder, monkeypatch):
+    folder, flows = token_folder
+    write_token(folder, SCOPES)
+    refreshed = []
+
+    def refresh(self, request):
+        refreshed.append(list(self.scopes))
+        self.token, self.expiry = 'refreshed', None
+
+    monkeypatch.setattr(Credentials, 'refresh', refresh)
+    credentials = load(folder)
+    assert (credentials.token, refreshed, flows) == ('refreshed', [SCOPES], [])
+    assert json.loads((folder / 'token.json').read_text())['token'] == 'refreshed'
+
+
+def test_failed_refresh_logs_in_again(token_folder, monkeypatch):
+    from google.auth.exceptions import RefreshError
+    folder, flows = token_folder
+    write_token(folder, SCOPES)
+
+    def refresh(self, request):
+        raise RefreshError('invalid_scope')
+
+    monkeypatch.setattr(Credentials, 'refresh', refresh)
+    credentials = load(folder)
+    assert credentials.token == 'new'
+    assert flows == [SCOPES + [DRIVE_METADATA_SCOPE]]
+
+
+def test_token_without_required_scopes_logs_in_again(token_folder):
+    folder, flows = token_folder
+    write_token(folder, SCOPES[:1])
+    assert load(folder).token == 'new'
+    assert len(flows) == 1
@@ -0,0 +1,16 @@
+import pytest
+
+from import_time import BUDGET_MS, MODULES, OWN_BUDGET_MS, measure
+
+
+@pytest.mark.parametrize('module', MODULES)
+def test_import_has_no_side_effects(module):
+    # raises when the config was read or a forbidden module was imported
+    measure(module)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize('module', MODULES)
+def test_import_time_budget(module):
+    total, own = measure(module)
+    assert total <= BUDGET_MS and own <= OWN_BUDGET_MS, f"{module}: total {total:.1f} ms, own {own:.1f} ms"
@@ -0,0 +1,58 @@
+from prispevky import cli
+from prispevky.journal import FAILED, PENDING, SENT, SendJournal, bounced_addresses
+from prispevky.spool import SpooledEmail
+
+
+def test_test_sends_have_their_own_journal(tmp_path):
+    test_args = cli.parse_args(['send', '--test', '--workdir', str(tmp_path), '--sheet', 'List'])
+    real_args = cli.parse_args(['send', '--workdir', str(tmp_path), '--sheet', 'List'])
+    assert cli.journal_path(test_args) != cli.journal_path(real_args)
+
+    (tmp_path/'List').mkdir()
+    with SendJournal(cli.journal_path(test_args)) as journal:
+        journal.record('1001', 'hash', 'SENT', gmail_id='m1', thread_id='t1')
+        journal.record_bounce('1001', 'Nobody@example.com', 'b1')
+    with SendJournal(cli.journal_path(real_args)) as journal:
+        assert journal.should_send('1001')
+    # a bad address is bad also for the real sends
+    assert bounced_addresses(tmp_path) == {'nobody@example.com'}
+
+
+def spooled(n: int):
+    return [SpooledEmail(str(1000 + i), f'Subject: Platba {i}\r\nTo: rodic@example.com\r\n\r\nZaplatte {i}.'.encode())
+            for i in range(n)]
+
+
+def test_rerun_skips_sent_and_retries_failed(fake_google, make_mailer, no_backoff, tmp_path):
+    emails = spooled(4)
+    google = fake_google()
+    with SendJournal(str(tmp_path/'journal.sqlite')) as journal:
+        journal.record('1000', 'hash', SENT, gmail_id='m1')
+        journal.record('1001', 'hash', FAILED, error='<HttpError 500>')
+        report = journal.send(make_mailer(), emails)
+        assert (report.sent, report.failed) == (3, 0)
+        assert google.stats['messages_sent'] == 3
+        assert all(journal.status(email.variable_symbol) == SENT for email in emails)
+
+        report = journal.send(make_mailer(), emails)
+        assert report.total == 0
+        assert google.stats['messages_sent'] == 3
+
+
+def test_rerun_skips_pending_unless_asked(fake_google, make_mailer, tmp_path):
+    emails = spooled(3)
+    google = fake_google()
+    with SendJournal(str(tmp_path/'journal.sqlite')) as journal:
+        # a crash after the record before the send, the message may have been sent
+        journal.record('1001', 'hash', PENDING)
+        report = journal.send(make_mailer(), emails)
+        assert report.sent == 2
+        assert journal.status('1001') == PENDING
+
+        report = journal.send(make_mailer(), emails, retry_pending=True)
+        assert (report.total, report.sent) == (1, 1)
+        assert journal.status('1001') == SENT
+    assert google.stats['messages_sent'] == 3
+    # the journal is read back from the file
+    with SendJournal(str(tmp_path/'journal.sqlite')) as journal:
+        assert not any(journal.should_send(email.variable_symbol, retry_pending=True) for email in emails)
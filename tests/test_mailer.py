@@ -0,0 +1,127 @@
+from email.message import EmailMessage
+
+import pytest
+
+from prispevky import mailer as mailer_module
+from prispevky.journal import SendJournal
+from prispevky.spool import SpooledEmail
+
+
+def messages(n: int, to: str = 'rodic@example.com'):
+    for i in range(n):
+        msg = EmailMessage()
+        msg['From'] = 'pokladnik@example.com'
+        msg['To'] = to
+        msg['Subject'] = f'Platba {i}'
+        msg.set_content(f'Zaplaťte prosím příspěvek {i}.')
+        yield msg.as_bytes()
+
+
+def test_sends_all(fake_google, make_mailer):
+    google = fake_google()
+    report = make_mailer().send_many(messages(10), workers=3)
+    assert (report.sent, report.failed, report.retries) == (10, 0, 0)
+    assert google.stats['messages_sent'] == 10
+    assert len({result['sent_msg']['id'] for result in report.results}) == 10
+
+
+def test_retries_rate_limit(fake_google, make_mailer, monkeypatch):
+    google = fake_google(sends_per_second=5)
+    monkeypatch.setattr(mailer_module, 'backoff_delay', lambda attempt, **kwargs: 0.2)
+    report = make_mailer(max_retries=20).send_many(messages(15), workers=4)
+    assert (report.sent, report.failed) == (15, 0)
+    assert report.retries == google.stats['status_429'] > 0
+
+
+def test_retries_server_errors(fake_google, make_mailer, no_backoff):
+    google = fake_google(error_rate=0.3, seed=1)
+    report = make_mailer(max_retries=20).send_many(messages(20), workers=2)
+    assert (report.sent, report.failed) == (20, 0)
+    assert report.retries == google.stats['injected_errors'] > 0
+
+
+@pytest.mark.parametrize('batch_size', [None, 4])
+def test_error_breakdown(fake_google, make_mailer, no_backoff, batch_size):
+    fake_google(reject_addresses=['neexistuje@example.com'])
+    emails = list(messages(3)) + list(messages(2, to='neexistuje@example.com'))
+    report = make_mailer().send_many(emails, batch_size=batch_size)
+    assert (report.total, report.sent, report.failed, report.retries) == (5, 3, 2, 0)
+    assert report.errors == {400: 2}
+    assert [result['send_status'] == "OK" for result in report.results] == [True] * 3 + [False] * 2
+
+
+def test_batches_retry_failed_parts(fake_google, make_mailer, no_backoff):
+    google = fake_google(error_rate=0.2, seed=2)
+    report = make_mailer(max_retries=20).send_many(messages(25), batch_size=10)
+    assert (report.sent, report.failed) == (25, 0)
+    assert google.stats['batches'] >= 3
+    assert report.retries > 0
+    assert len({result['sent_msg']['id'] for result in report.results}) == 25
+
+
+@pytest.mark.parametrize('batch_size', [None, 4])
+def test_connection_errors_are_retried_then_failed(fake_google, make_mailer, no_backoff, batch_size):
+    google = fake_google()
+    # nothing listens on the port any more
+    google.__exit__()
+    report = make_mailer(max_retries=2).send_many(messages(3), batch_size=batch_size)
+    assert (report.sent, report.failed) == (0, 3)
+    assert report.errors == {'ConnectionRefusedError': 3}
+    assert all(result['retries'] == 2 for result in report.results)
+
+
+def test_unexpected_error_fails_only_its_message(fake_google, make_mailer, monkeypatch):
+    fake_google()
+    mailer = make_mailer()
+    send_message = mailer.send_message
+
+    def flaky_send(message):
+        if b'Platba 2' in message:
+            raise RuntimeError('broken message')
+        return send_message(message)
+
+    monkeypatch.setattr(mailer, 'send_message', flaky_send)
+    results = {}
+    report = mailer.send_many(messages(6), workers=2, on_result=results.__setitem__)
+    assert (report.sent, report.failed) == (5, 1)
+    assert report.errors == {'RuntimeError': 1}
+    # every message got its result, none is left pending
+    assert sorted(results) == list(range(6))
+
+
+def test_failed_batch_request_is_retried(fake_google, make_mailer, no_backoff):
+    google = fake_google(batch_errors=[503, 429])
+    report = make_mailer().send_many(messages(6), batch_size=4)
+    assert (report.sent, report.failed) == (6, 0)
+    assert google.stats['batch_status_503'] == google.stats['batch_status_429'] == 1
+    assert google.stats['messages_sent'] == 6
+
+
+def test_failed_batch_request_fails_its_messages(fake_google, make_mailer, no_backoff):
+    google = fake_google(batch_errors=[403])
+    results = {}
+    report = make_mailer().send_many(messages(6), batch_size=4, on_result=results.__setitem__)
+    assert (report.sent, report.failed, report.retries) == (2, 4, 0)
+    assert report.errors == {403: 4}
+    assert sorted(results) == list(range(6))
+    assert google.stats['messages_sent'] == 2
+
+
+def test_timeout_is_not_retried_and_stays_pending(fake_google, make_mailer, tmp_path, monkeypatch):
+    fake_google()
+    mailer = make_mailer()
+    send_message = mailer.send_message
+
+    def timing_out_send(message):
+        if b'Platba 1' in message:
+            # the request may have reached Gmail before the connection timed out
+            raise TimeoutError('timed out')
+        return send_message(message)
+
+    monkeypatch.setattr(mailer, 'send_message', timing_out_send)
+    emails = [SpooledEmail(str(1000 + i), raw) for i, raw in enumerate(messages(3))]
+    with SendJournal(str(tmp_path/'journal.sqlite')) as journal:
+        report = journal.send(mailer, emails)
+        assert (report.sent, report.failed, report.ambiguous, report.retries) == (2, 1, 1, 0)
+        assert [journal.should_send(email.variable_symbol) for email in emails] == [False, False, False]
+        assert journal.should_send('1001', retry_pending=True)
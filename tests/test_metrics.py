@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from prispevky import cli
+from prispevky.config import get_config
+from prispevky.metrics import METRICS, Metrics
+from synthetic import skautis_export
+
+
+@pytest.fixture
+def metrics():
+    metrics = Metrics()
+    metrics.enable()
+    return metrics
+
+
+def test_json(metrics):
+    metrics.inc('messages_sent')
+    metrics.inc('bytes_uploaded', 1500)
+    metrics.observe('gmail_send', 0.003)
+    metrics.observe('gmail_send', 0.2)
+    with metrics.stage('qr_render'):
+        pass
+    data = json.loads(metrics.to_json())
+    assert data['counters'] == {'messages_sent': 1, 'bytes_uploaded': 1500}
+    gmail_send = data['stages']['gmail_send']
+    assert (gmail_send['count'], gmail_send['sum']) == (2, pytest.approx(0.203))
+    assert gmail_send['buckets']['0.005'] == gmail_send['buckets']['0.25'] == 1
+    assert sum(gmail_send['buckets'].values()) == 2
+    assert data['stages']['qr_render']['count'] == 1
+
+
+def test_prometheus(metrics):
+    metrics.inc('retries', 2)
+    metrics.observe('gmail_send', 0.003)
+    metrics.observe('gmail_send', 20)
+    lines = metrics.to_prometheus().splitlines()
+    assert lines[:2] == ['# TYPE prispevky_retries_total counter', 'prispevky_retries_total 2']
+    assert '# TYPE prispevky_gmail_send_seconds histogram' in lines
+    # the buckets are cumulative
+    assert 'prispevky_gmail_send_seconds_bucket{le="0.001"} 0' in lines
+    assert 'prispevky_gmail_send_seconds_bucket{le="0.005"} 1' in lines
+    assert 'prispevky_gmail_send_seconds_bucket{le="10"} 1' in lines
+    assert 'prispevky_gmail_send_seconds_bucket{le="+Inf"} 2' in lines
+    assert lines[-2:] == ['prispevky_gmail_send_seconds_sum 20.003', 'prispevky_gmail_send_seconds_count 2']
+
+
+def test_disabled_records_nothing():
+    metrics = Metrics()
+    metrics.inc('messages_sent')
+    metrics.observe('gmail_send', 0.1)
+    with metrics.stage('qr_render'):
+        pass
+    assert (metrics.counters, metrics.histograms) == ({}, {})
+    # the shared no-op context manager, nothing is allocated per call
+    assert metrics.stage('qr_render') is metrics.stage('mime_build')
+
+
+def test_cli_writes_metrics_and_profiles(fake_google, tmp_path):
+    google = fake_google()
+    google.add_dataframe(get_config()['spreadsheet']['id'], 'List', skautis_export(20))
+    try:
+        cli.main(['fetch', '--format', 'csv', '--workdir', str(tmp_path), '--sheet', 'List',
+                  '--metrics', str(tmp_path/'metrics.prom'), '--profile', 'sheets_fetch'])
+    finally:
+        METRICS.disable()
+        METRICS.reset()
+    lines = (tmp_path/'metrics.prom').read_text(encoding='utf-8').splitlines()
+    assert 'prispevky_sheets_fetch_seconds_count 1' in lines
+    assert any(line.startswith('prispevky_sheets_api_calls_total ') for line in lines)
+    assert (tmp_path/'profiles'/'sheets_fetch.prof').exists()
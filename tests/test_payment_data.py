@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame, extract_addresses, get_lists_of_emails
+from synthetic import skautis_export
+
+
+def test_deprecated_currency_conversion():
+    cols = NeededColumns(amount_due='Předpis', amount_paid='Zaplaceno')
+    df = pd.DataFrame({cols.amount_due: ['1200', '800'], cols.amount_paid: ['', None], 'other': ['a', 'b']})
+    with pytest.deprecated_call():
+        converted = PaymentsDataFrame.convert_currency_columns_to_number_and_fill_na(df, cols)
+    assert converted[cols.amount_due].tolist() == [1200, 800]
+    assert converted[cols.amount_paid].tolist() == [0, 0]
+    assert df[cols.amount_paid].tolist() == ['', None]
+
+
+def test_extract_addresses_matches_get_lists_of_emails():
+    cols = NeededColumns()
+    df = skautis_export(50, cols=cols)
+    df.loc[0, cols.email1] = 'jan@example.com,'
+    df.loc[1, cols.email2] = 'a@, @x.cz'
+    df.loc[2, cols.email3] = 'jan@x..cz, Jan@Example.com'
+    df.loc[3, cols.email4] = ' , neplatny email'
+    df.loc[4, cols.email5] = None
+    df.loc[5, cols.email1] = '"jan novak"@example.com'
+
+    extracted = extract_addresses(df, cols.emails)
+    expected = df.apply(get_lists_of_emails, axis=1, args=(cols.emails,))
+    assert extracted['valid_addresses'].tolist() == expected['valid_addresses'].tolist()
+    assert extracted['invalid_addresses'].tolist() == expected['invalid_addresses'].tolist()
+    assert (cols.email1, '') in extracted.loc[0, 'invalid_addresses']
+    assert [email for _, email in extracted.loc[1, 'invalid_addresses']] == ['a@', '@x.cz']
+    assert (cols.email3, 'jan@x..cz') in extracted.loc[2, 'invalid_addresses']
@@ -0,0 +1,32 @@
+import pytest
+
+from prispevky.config import CONFIG_FILEPATH, use_config
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.payment_info import PaymentInfo
+from synthetic import skautis_export
+
+
+@pytest.mark.parametrize('config_name', ['config_prispevky.cfg', 'config_sts.cfg'])
+def test_from_dataframe_matches_from_df_row(config_name):
+    with use_config([CONFIG_FILEPATH.parent/config_name]):
+        cols = NeededColumns()
+        df = skautis_export(300, cols=cols).rename(columns={'Poplatek': cols.amount_due,
+                                                            'Zaplaceno': cols.amount_paid})
+        if config_name == 'config_sts.cfg':
+            # not a troop in the STS config
+            df = df[df[cols.troop] != 'Myšky']
+        unpaid = PaymentsDataFrame(df, cols).df_emailable_unpaid
+        assert len(unpaid) > 100
+        expected = [PaymentInfo.from_df_row(row, cols) for _, row in unpaid.iterrows()]
+        assert PaymentInfo.from_dataframe(unpaid, cols) == expected
+
+
+def test_unknown_troop():
+    cols = NeededColumns()
+    unpaid = PaymentsDataFrame(skautis_export(20, cols=cols), cols).df_emailable_unpaid.copy()
+    unpaid[cols.troop] = unpaid[cols.troop].cat.add_categories(['Sloni'])
+    unpaid.loc[unpaid.index[3], cols.troop] = 'Sloni'
+    with pytest.raises(KeyError, match='Sloni'):
+        PaymentInfo.from_dataframe(unpaid, cols)
+    with pytest.raises(KeyError, match='Sloni'):
+        PaymentInfo.from_df_row(unpaid.iloc[3], cols)
@@ -0,0 +1,26 @@
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.pipeline import payment_emails, send_stream
+from synthetic import skautis_export
+
+
+def test_messages_are_built_while_the_previous_ones_are_sent(fake_google, make_mailer):
+    fake_google(latency=0.02)
+    cols = NeededColumns()
+    pdf = PaymentsDataFrame(skautis_export(40, cols=cols), cols)
+    workers = 2
+    done = []
+    # number of messages sent but without a result when each message was taken
+    in_flight = []
+
+    def emails():
+        for i, email in enumerate(payment_emails(pdf.df_emailable_unpaid, cols, n_recipients=1, testmode=True)):
+            in_flight.append(i - len(done))
+            yield email
+
+    report = send_stream(make_mailer(), emails(), workers=workers, on_result=lambda i, result: done.append(i))
+    assert report.sent == len(pdf.df_emailable_unpaid) > 4 * workers
+    # taken lazily, never more than two messages per worker wait for the network
+    assert max(in_flight) <= 2 * workers
+    # and the messages were built while the previous ones were being sent
+    assert sum(n > 0 for n in in_flight) > len(in_flight) // 2
+    assert report.results == []
@@ -0,0 +1,91 @@
+import io
+
+import pytest
+from PIL import Image
+
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.payment_info import PaymentInfo
+from prispevky.metrics import METRICS
+from prispevky.qr_code import QRImageCache, QRSettings, qr_platba_string, render_png
+
+from synthetic import skautis_export
+
+# an independent decoder, the fast path must not be checked by its own tables
+zxingcpp = pytest.importorskip('zxingcpp')
+
+FAST = QRSettings(fast=True)
+
+
+def decode(png: bytes):
+    barcodes = zxingcpp.read_barcodes(Image.open(io.BytesIO(png)))
+    assert len(barcodes) == 1
+    assert barcodes[0].format == zxingcpp.BarcodeFormat.QRCode
+    return barcodes[0]
+
+
+@pytest.fixture(scope='module')
+def payment_strings():
+    cols = NeededColumns()
+    pdf = PaymentsDataFrame(skautis_export(60, cols=cols), cols)
+    return [qr_platba_string(pi) for pi in PaymentInfo.from_dataframe(pdf.df_emailable_unpaid, cols)]
+
+
+def test_fast_path_is_opt_in():
+    assert not QRSettings().fast
+
+
+def test_fast_path_decodes_to_the_payment(payment_strings):
+    for code in payment_strings:
+        barcode = decode(render_png(code, FAST))
+        assert barcode.text == code
+        assert code.startswith('SPD*1.0*')
+        assert (barcode.extra['Version'], barcode.ec_level) == ('8', 'M')
+
+
+@pytest.mark.parametrize('mask', range(8))
+def test_fast_path_masks(payment_strings, mask):
+    barcode = decode(render_png(payment_strings[0], QRSettings(fast=True, mask=mask)))
+    assert barcode.text == payment_strings[0]
+    assert barcode.extra['DataMask'] == mask
+
+
+@pytest.mark.parametrize('error_correction', 'LMQH')
+def test_fast_path_error_correction(payment_strings, error_correction):
+    barcode = decode(render_png(payment_strings[0], QRSettings(fast=True, error_correction=error_correction)))
+    assert barcode.text == payment_strings[0]
+    assert barcode.ec_level == error_correction
+
+
+def test_fast_path_falls_back_to_larger_versions(payment_strings):
+    code = payment_strings[0] + '*X-SELF:' + 'A' * 200
+    barcode = decode(render_png(code, FAST))
+    assert barcode.text == code
+    assert int(barcode.extra['Version']) > 8
+
+
+def test_fast_path_matches_qrcode_make(payment_strings):
+    code = payment_strings[0]
+    assert decode(render_png(code, FAST)).text == decode(render_png(code, QRSettings(fast=False))).text == code
+
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    METRICS.enable()
+    yield METRICS
+    METRICS.disable()
+    METRICS.reset()
+
+
+def test_prerender_keeps_all_codes_and_their_timings(payment_strings, metrics):
+    cache = QRImageCache(maxsize=4, settings=FAST)
+    cache.prerender(payment_strings[:10], workers=2)
+    assert cache.maxsize == 10
+    assert all(code in cache for code in payment_strings[:10])
+    # rendered in the workers, timed in the parent
+    assert metrics.histograms['qr_render'].count == 10
+    assert metrics.counters['qr_png_bytes'] > 0
+    for code in payment_strings[:10]:
+        cache.get(code)
+    assert metrics.counters['qr_cache_hits'] == 10
+    assert 'qr_cache_misses' not in metrics.counters
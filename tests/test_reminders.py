@@ -0,0 +1,82 @@
+import datetime
+
+import pytest
+
+from prispevky import cli
+from prispevky.journal import FAILED, PENDING, SENT, SendJournal
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.reminders import ReminderSnapshot
+from synthetic import skautis_export
+
+NOW = datetime.datetime(2025, 11, 1, 12)
+INTERVAL = datetime.timedelta(days=14)
+
+
+@pytest.fixture
+def payments():
+    cols = NeededColumns()
+    return PaymentsDataFrame(skautis_export(20, cols=cols), cols), cols
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    with ReminderSnapshot(str(tmp_path/'reminders.sqlite')) as snapshot:
+        yield snapshot
+
+
+def remind_all(snapshot, df, cols, sent_at):
+    for _, row in df.iterrows():
+        snapshot.record(str(row[cols.reg_num]), row[cols.amount_due], row[cols.amount_paid], 'hash', sent_at)
+
+
+def test_never_reminded_rows_are_due(payments, snapshot):
+    pdf, cols = payments
+    due = snapshot.due_rows(pdf.df_emailable_unpaid, cols, INTERVAL, now=NOW)
+    assert due.index.equals(pdf.df_emailable_unpaid.index)
+
+
+def test_unchanged_rows_wait_for_the_interval(payments, snapshot):
+    pdf, cols = payments
+    df = pdf.df_emailable_unpaid
+    remind_all(snapshot, df, cols, NOW - INTERVAL + datetime.timedelta(hours=1))
+    assert snapshot.due_rows(df, cols, INTERVAL, now=NOW).empty
+    assert snapshot.due_rows(df, cols, INTERVAL, now=NOW + datetime.timedelta(hours=1)).index.equals(df.index)
+
+
+def test_rows_with_changed_balance_are_due(payments, snapshot):
+    pdf, cols = payments
+    df = pdf.df_emailable_unpaid.copy()
+    remind_all(snapshot, df, cols, NOW)
+    df.loc[df.index[0], cols.amount_due] += 100
+    df.loc[df.index[3], cols.amount_paid] += 50
+    assert list(snapshot.due_rows(df, cols, INTERVAL, now=NOW).index) == [df.index[0], df.index[3]]
+
+
+def test_only_successful_reminders_are_recorded(payments, snapshot, fake_google, make_mailer, tmp_path):
+    pdf, cols = payments
+    df = pdf.df_emailable_unpaid
+    rejected = df.iloc[2]
+    google = fake_google(reject_addresses=[rejected.valid_addresses[0].addr_spec])
+    with SendJournal(str(tmp_path/'journal.sqlite')) as journal:
+        # the variable symbol is the registration number
+        journal.record(str(df.iloc[4][cols.reg_num]), 'hash', PENDING)
+        report = snapshot.send(make_mailer(), pdf, cols, INTERVAL, journal=journal)
+        assert (report.sent, report.failed) == (len(df) - 2, 1)
+        assert google.stats['messages_sent'] == len(df) - 2
+
+        reminded = set(snapshot.to_dataframe().index)
+        assert reminded == set(df[cols.reg_num].astype(str)) - {str(rejected[cols.reg_num]),
+                                                                  str(df.iloc[4][cols.reg_num])}
+        assert journal.status(str(rejected[cols.reg_num])) == FAILED
+        assert journal.status(str(df.iloc[4][cols.reg_num])) == PENDING
+        assert journal.status(str(df.iloc[0][cols.reg_num])) == SENT
+
+        # the next wave retries only the failed one, the interrupted one is still skipped
+        report = snapshot.send(make_mailer(), pdf, cols, INTERVAL, journal=journal)
+        assert (report.sent, report.failed) == (0, 1)
+
+
+def test_test_reminders_have_their_own_snapshot(tmp_path):
+    test_args = cli.parse_args(['remind', '--test', '--workdir', str(tmp_path), '--sheet', 'List'])
+    real_args = cli.parse_args(['remind', '--workdir', str(tmp_path), '--sheet', 'List'])
+    assert cli.reminders_path(test_args) != cli.reminders_path(real_args)
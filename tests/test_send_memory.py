@@ -0,0 +1,12 @@
+import pytest
+
+from send_memory import growth_after_warmup, send_traced
+
+
+@pytest.mark.slow
+def test_memory_stays_flat_over_10k_messages():
+    # about 10 minutes under tracemalloc, mostly building the messages; the fast QR path halves it
+    report, samples, peak, seconds = send_traced(10_000, fast_qr=True)
+    assert (report.sent, report.failed) == (10_000, 0)
+    growth, messages = growth_after_warmup(samples)
+    assert growth < 2.0, f"memory grew by {growth:.2f} MB over {messages} messages"
@@ -0,0 +1,87 @@
+import configparser
+
+import pytest
+
+from prispevky.config import CONFIG_FILEPATH, get_config
+from prispevky.payment_data import NeededColumns, normalize_payments
+from prispevky.settings import PreflightError, Settings, check_sheet, get_settings, preflight
+from synthetic import skautis_export
+
+
+@pytest.fixture
+def sheet():
+    cols = NeededColumns()
+    return skautis_export(10, cols=cols), cols
+
+
+def test_valid_sheet_has_no_problems(sheet):
+    df, cols = sheet
+    assert preflight(df, cols).empty
+    check_sheet(df, cols)
+
+
+def test_all_problems_are_reported_at_once(sheet):
+    df, cols = sheet
+    df.loc[1, cols.troop] = 'Sloni'
+    df.loc[2, cols.amount_due] = 'tisíc'
+    df.loc[3, cols.amount_paid] = '-100'
+    df.loc[4, cols.amount_paid] = ''
+    problems = preflight(df, cols)
+    assert problems.values.tolist() == [[1, cols.troop, 'Sloni', 'unknown troop'],
+                                        [2, cols.amount_due, 'tisíc', 'not a number'],
+                                        [3, cols.amount_paid, '-100', 'negative amount']]
+    with pytest.raises(PreflightError, match='3 problems') as raised:
+        check_sheet(df, cols)
+    assert raised.value.problems.equals(problems)
+
+
+def test_numeric_amounts(sheet):
+    df, cols = sheet
+    df = normalize_payments(df, cols)
+    df.loc[5, cols.amount_due] = -700
+    assert preflight(df, cols).values.tolist() == [[5, cols.amount_due, -700, 'negative amount']]
+
+
+def test_valid_config():
+    settings = Settings.from_config(get_config())
+    assert settings == get_settings()
+    assert settings.human_account_number == '000000-2101999393/2010'
+    assert settings.troops['Bobříci'].specific_symbol == '2512444'
+
+
+@pytest.fixture
+def config():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILEPATH, encoding='utf-8')
+    return config
+
+
+@pytest.mark.parametrize('section, name, value, error', [
+    ('payment', 'iban', 'CZ22 2010 0000 0021 0199 9393', 'Invalid IBAN'),
+    ('payment', 'iban', '2101999393/2010', 'Invalid IBAN'),
+    # the account number is one digit short
+    ('payment', 'iban', 'CZ222010000000210199939', 'Invalid IBAN'),
+    ('payment', 'ss_prefix', '25a', 'ss_prefix must be digits'),
+    ('troops', 'ALB', 'Albatrosové, ALB, 01, Nemo', 'Troop needs 5 fields'),
+    ('sts', 'STS_payment_per_number', '0', 'must be positive'),
+])
+def test_invalid_config_values(config, section, name, value, error):
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, name, value)
+    with pytest.raises(ValueError, match=error):
+        Settings.from_config(config)
+
+
+@pytest.mark.parametrize('section, name', [('payment', 'iban'), ('payment', 'message_template'),
+                                           ('mailer', 'sender_address'), ('mailer', 'subject')])
+def test_missing_config_key(config, section, name):
+    config.remove_option(section, name)
+    with pytest.raises(ValueError, match=f"Missing {name} in the \\[{section}\\] section"):
+        Settings.from_config(config)
+
+
+def test_missing_troops(config):
+    config.remove_section('troops')
+    with pytest.raises(ValueError, match='No troops'):
+        Settings.from_config(config)
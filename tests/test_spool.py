@@ -0,0 +1,34 @@
+import pytest
+
+from prispevky.payment_data import NeededColumns, PaymentsDataFrame
+from prispevky.spool import render_spool, send_spool
+from synthetic import skautis_export
+
+
+@pytest.fixture
+def payments():
+    cols = NeededColumns()
+    return skautis_export(20, cols=cols), cols
+
+
+def test_modified_spool_sends_nothing(payments, fake_google, make_mailer, tmp_path):
+    df, cols = payments
+    manifest = render_spool(PaymentsDataFrame(df, cols), cols, tmp_path, workers=1, testmode=True)
+    assert len(manifest) > 2
+    # the last message is edited after the review
+    with open(tmp_path/manifest[-1]['file'], 'ab') as f:
+        f.write(b'\nPS: pay to another account')
+    google = fake_google()
+    with pytest.raises(ValueError, match=manifest[-1]['file']):
+        send_spool(make_mailer(), tmp_path)
+    assert google.stats['messages_sent'] == 0
+
+
+def test_duplicate_variable_symbols_are_rejected(payments, tmp_path):
+    df, cols = payments
+    pdf = PaymentsDataFrame(df, cols)
+    unpaid = pdf.df_emailable_unpaid.index
+    df.loc[unpaid[1], cols.reg_num] = df.loc[unpaid[0], cols.reg_num]
+    with pytest.raises(ValueError, match=df.loc[unpaid[0], cols.reg_num]):
+        render_spool(PaymentsDataFrame(df, cols), cols, tmp_path / 'spool', workers=1)
+    assert not (tmp_path / 'spool').exists()